@@ -1,16 +1,38 @@
 import os
 import re
+import json
+import hashlib
+import time
 import requests
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, send_from_directory, jsonify
+from threading import BoundedSemaphore
+from flask import Flask, Request, Response, abort, render_template, request, flash, redirect, session, g, url_for, send_from_directory, jsonify
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from psycopg2 import IntegrityError
 from datetime import datetime
 from forms import SignupForm, LoginForm, SearchForm, EditProfileForm, MessageForm, PasswordUpdateForm
-from models import  db, connect_db, User,  Instrument, Genre, Follows, User_Instrument, User_Genre, Message, Notification, bcrypt
+from models import  db, connect_db, User,  Instrument, Genre, Follows, User_Instrument, User_Genre, Message, Notification, Thread, ThreadSummary, Upload, SavedSearch
 from flask_uploads import configure_uploads, IMAGES, UploadSet
+from werkzeug.exceptions import RequestEntityTooLarge, TooManyRequests, UnsupportedMediaType
 from werkzeug.utils import secure_filename
 import uuid as uuid
-from sqlalchemy import exc
+import click
+from sqlalchemy import exc, event, or_
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, joinedload, make_transient_to_detached, selectinload
+from zip_radius import get_engine as get_zip_radius_engine, normalize_zip
+from cache import TwoTierCache, SharedStore, SHARED_CACHE_PATH
+from pagination import encode_cursor, decode_cursor, get_page_size
+from events import EventLog
+from search_index import SearchIndex, mark_users_changed, watch_user_changes
+from message_search import MessageSearchIndex, watch_message_changes
+from saved_searches import SavedSearchIndex, watch_saved_search_changes
+from pubsub import Broker
+from vocabulary import get_vocabularies
+from passwords import password_hasher
+from ratelimit import RateLimiter, MemoryCounters, SharedCounters
+from images import ImagePipeline, HEADER_VARIANTS, PROFILE_VARIANTS
+from uploads import UploadStore, UPLOADS_URL, STORED_NAME, upload_url
 
 CURR_USER_KEY = "curr_user"
 
@@ -27,13 +49,83 @@ app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'thisIsasupersecretkey9afswooooo097yup')
 
+# Password hashing: how many hashes run at once, how many may wait, and how long one should take.
+# Setting BCRYPT_LOG_ROUNDS fixes the cost instead of measuring it at startup.
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+app.config['PASSWORD_HASH_QUEUE'] = int(os.environ.get('PASSWORD_HASH_QUEUE', 16))
+app.config['PASSWORD_HASH_TARGET_SECONDS'] = float(os.environ.get('PASSWORD_HASH_TARGET_SECONDS', 0.25))
+# The lowest cost calibration may pick; raise it to the cost already in use so no host hashes weaker
+app.config['PASSWORD_HASH_MIN_ROUNDS'] = int(os.environ.get('PASSWORD_HASH_MIN_ROUNDS', 12))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ['BCRYPT_LOG_ROUNDS']) if os.environ.get('BCRYPT_LOG_ROUNDS') else None
+password_hasher.init_app(app)
+
+# Caches, shared rate limit counters and the event log live in one SQLite file per host
+app.config['SHARED_CACHE_PATH'] = os.environ.get('SHARED_CACHE_PATH', SHARED_CACHE_PATH)
+shared_store = SharedStore(app.config['SHARED_CACHE_PATH'])
+
+# Limits per route and scope, checked before any password is hashed or message written.
+# RATE_LIMIT_BACKEND=shared counts across all workers on the host instead of per worker.
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': '20/minute', 'user': '5/minute'},
+    'send_message': {'ip': '30/minute', 'user': '10/minute'},
+}
+app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+# How many proxies in front of the app append to X-Forwarded-For. None by default, since the
+# header is whatever the client sent when nothing in front rewrites it; set 1 on Render.
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+rate_limiter = RateLimiter(app.config['RATE_LIMITS'],
+                           SharedCounters(app.config['SHARED_CACHE_PATH']) if app.config['RATE_LIMIT_BACKEND'] == 'shared' else MemoryCounters())
+
 BASE_DIRECTORY = 'https://hook-find-musicians.onrender.com/'
 UPLOAD_FOLDER = 'static/uploads/'
 app.config['UPLOAD_FOLDER']=UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Uploads are named by their content, so browsers may cache them for good
+UPLOAD_MAX_AGE = 365 * 24 * 60 * 60
+app.config['UPLOAD_GC_GRACE_HOURS'] = 24
+
+upload_store = UploadStore(UPLOAD_FOLDER)
+image_pipeline = ImagePipeline(UPLOAD_FOLDER, url_path=UPLOADS_URL)
+
+
+class UploadRequest(Request):
+    """A request whose uploaded files are streamed straight into the upload store.
+
+    Each file is written to disk chunk by chunk while the body is parsed, and
+    parsing stops with a 413 or 415 as soon as a file is too large or its
+    first bytes show it isn't an image.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.incoming_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_bytes = app.config['MAX_CONTENT_LENGTH']
+        if content_length and content_length > max_bytes:
+            raise RequestEntityTooLarge()
+        if filename and content_type and not content_type.startswith('image/') and content_type != 'application/octet-stream':
+            raise UnsupportedMediaType()
+
+        incoming = upload_store.incoming(max_bytes)
+        self.incoming_files.append(incoming)
+        return incoming
+
+    def close(self):
+        # Files parsed before a rejected one never reach `request.files`, so close them here too
+        super().close()
+        for incoming in self.incoming_files:
+            incoming.close()
+
+
+app.request_class = UploadRequest
+
 POSTS_PER_PAGE = 10
 app.config['POSTS_PER_PAGE']=POSTS_PER_PAGE
+app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+app.config['SEARCH_RESULTS_MAX_PER_PAGE'] = 100
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
@@ -55,19 +147,171 @@ def get_file_contents(filename):
 API_KEY = os.environ.get('API_KEY', get_file_contents(filename))
 RADIUS_BASE_URL = f'https://www.zipcodeapi.com/rest/{API_KEY}/radius.json'
 
+# Only ask ZipCodeAPI about zip codes missing from the bundled dataset
+app.config['RADIUS_API_FALLBACK'] = bool(API_KEY)
+app.config['RADIUS_API_TIMEOUT'] = 5
+app.config['RADIUS_CACHE_TTL'] = 7 * 24 * 60 * 60
+app.config['RADIUS_CACHE_MAX_ENTRIES'] = 512
+
+radius_cache = TwoTierCache('radius', ttl=app.config['RADIUS_CACHE_TTL'],
+                            max_entries=app.config['RADIUS_CACHE_MAX_ENTRIES'], store=shared_store)
+
+# Submitted searches are kept server-side under a short id instead of in the cookie
+app.config['SEARCH_TTL'] = 24 * 60 * 60
+app.config['SEARCH_MAX_ENTRIES'] = 1024
+
+searches = TwoTierCache('search', ttl=app.config['SEARCH_TTL'],
+                        max_entries=app.config['SEARCH_MAX_ENTRIES'], store=shared_store)
+
+# Per-worker bitmap index of users, kept in step with other workers through the event log
+event_log = EventLog(app.config['SHARED_CACHE_PATH'])
+search_index = SearchIndex(events=event_log)
+watch_user_changes(event_log)
+
+# Postgres searches messages with its own full-text index; other databases get an in-process one
+message_search_index = None
+if make_url(uri).get_backend_name() != 'postgresql':
+    message_search_index = MessageSearchIndex(events=event_log)
+    watch_message_changes(event_log)
+
+# Notifications are pushed to open tabs over SSE; the event log carries them between workers
+app.config['NOTIFICATION_STREAM_HEARTBEAT'] = 15
+app.config['NOTIFICATION_STREAM_MAX_SECONDS'] = 5 * 60
+app.config['NOTIFICATION_STREAM_RETRY_MS'] = 3000
+# Each open stream holds one of the worker's threads, so only up to half of them may;
+# past that the browser is turned away and polls /notifications instead
+app.config['NOTIFICATION_STREAMS_PER_WORKER'] = int(os.environ.get(
+    'NOTIFICATION_STREAMS_PER_WORKER', int(os.environ.get('GUNICORN_THREADS', 32)) // 2))
+
+notification_stream_slots = BoundedSemaphore(app.config['NOTIFICATION_STREAMS_PER_WORKER'])
+
+notification_broker = Broker(events=event_log, topic='notifications')
+
+# Saved searches, indexed by the zip codes they cover so changed profiles are only checked against nearby ones
+saved_search_index = SavedSearchIndex(lambda zip_code, radius: find_zip_codes_in_radius(zip_code, radius),
+                                      events=event_log)
+watch_saved_search_changes(event_log)
+
 @app.route('/favicon.ico') 
 def favicon(): 
     return send_from_directory(os.path.join(app.root_path, 'static'), 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
+# Snapshots of logged in users' rows, so requests that need `g.user` can skip the users table
+app.config['USER_CACHE_TTL'] = 5 * 60
+app.config['USER_CACHE_LOCAL_TTL'] = 5
+app.config['USER_CACHE_MAX_ENTRIES'] = 1024
+
+user_cache = TwoTierCache('user', ttl=app.config['USER_CACHE_TTL'],
+                          local_ttl=app.config['USER_CACHE_LOCAL_TTL'],
+                          max_entries=app.config['USER_CACHE_MAX_ENTRIES'], store=shared_store)
+
+# Never written to the shared file; read from the database if something asks for them
+USER_SNAPSHOT_EXCLUDED = ('password',)
+
+
+def snapshot_user(user):
+    """Return `user`'s column values as a JSON friendly dict (None for no user).
+
+    The password hash is left out, so `User.authenticate` loads it fresh.
+    """
+
+    if user is None:
+        return None
+
+    snapshot = {}
+    for column in User.__table__.columns:
+        if column.key in USER_SNAPSHOT_EXCLUDED:
+            continue
+        value = getattr(user, column.key)
+        snapshot[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return snapshot
+
+
+def restore_user(snapshot):
+    """Attach a user rebuilt from `snapshot` to the session without querying for it."""
+
+    values = {key: value for key, value in snapshot.items() if key not in USER_SNAPSHOT_EXCLUDED}
+    for column in User.__table__.columns:
+        if isinstance(column.type, db.DateTime) and values.get(column.key):
+            values[column.key] = datetime.fromisoformat(values[column.key])
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def load_current_user():
+    """Return the logged in user, from the identity cache when possible."""
+
+    user_id = session.get(CURR_USER_KEY)
+    if user_id is None:
+        return None
+
+    snapshot = user_cache.get_or_load(str(user_id), lambda: snapshot_user(User.query.get(user_id)))
+    return snapshot and restore_user(snapshot)
+
+
+def forget_user(user_id):
+    """Drop a user's cached snapshot after changing their row."""
+
+    user_cache.delete(str(user_id))
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def forget_deleted_users(delete_context):
+    """Bulk deletes don't say which users went, so forget them all."""
+
+    if delete_context.mapper.class_ is User:
+        user_cache.clear()
+
+
+class AppGlobals(_AppCtxGlobals):
+    """Flask's `g`, except `g.user` is loaded the first time something reads it."""
+
+    def __getattr__(self, name):
+        if name == 'user':
+            self.user = load_current_user()
+            return self.user
+        return super().__getattr__(name)
+
+
+app.app_ctx_globals_class = AppGlobals
+
+
 @app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def reset_user_in_g():
+    """Forget any user loaded by an earlier request, so `g.user` reloads lazily."""
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    g.pop('user', None)
 
-    else:
-        g.user = None
+
+@app.before_request
+def reject_oversized_body():
+    """Turn away a body declared larger than we accept before reading any of it.
+
+    Werkzeug would only refuse it when the form is parsed, after reading it all.
+    """
+
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        abort(413)
+
+
+def client_ip():
+    """The client's address, as seen by the outermost proxy we trust."""
+
+    route = request.access_route
+    proxies = app.config['TRUSTED_PROXIES']
+    if proxies and request.headers.get('X-Forwarded-For') and len(route) >= proxies:
+        return route[-proxies]
+    return request.remote_addr
+
+
+def check_rate_limit(route, **identities):
+    """Count a hit on `route`, stopping the request with a 429 if it is over a limit."""
+
+    wait = rate_limiter.hit(route, ip=client_ip(), **identities)
+    if wait:
+        raise TooManyRequests(f'Too many requests. Please try again in {wait} seconds.', retry_after=wait)
 
 
 def do_login(user):
@@ -103,9 +347,15 @@ def login_form():
     form = LoginForm()
 
     if form.validate_on_submit():
+        check_rate_limit('login', user=form.username.data.lower())
         user = User.authenticate(form.username.data,form.password.data)
 
         if user:
+            if db.session.is_modified(user):
+                # authenticate() upgraded the password hash to the current cost
+                db.session.commit()
+                forget_user(user.id)
+
             do_login(user)
             flash(f"Hello, {user.username}!", "info")
             return redirect("/")
@@ -153,6 +403,7 @@ def signup_form():
             flash('Username or Email already taken', 'danger')
             return render_template('auth.html', form=form, page='Signup')
 
+        percolate_profile(user.id)
         do_login(user)
 
         return redirect(f'/users/{user.id}')
@@ -161,6 +412,41 @@ def signup_form():
         return render_template('auth.html', form=form, page='Signup')
 
 
+def find_zip_codes_in_radius(zip_code, radius):
+    """List (zip_code, distance) pairs within `radius` miles of `zip_code`, nearest first.
+
+    Answered from the bundled zip code dataset. ZipCodeAPI is only called for
+    zip codes the dataset doesn't know about, and only if an API key is set.
+    Results are cached per (zip_code, radius). Returns None if the zip code
+    can't be found at all.
+    """
+
+    zip_code = normalize_zip(zip_code)
+
+    def lookup():
+        zips = get_zip_radius_engine().zips_within(zip_code, radius)
+
+        if zips is None and app.config['RADIUS_API_FALLBACK']:
+            resp = requests.get(f"{RADIUS_BASE_URL}/{zip_code}/{radius}/miles",
+                                timeout=app.config['RADIUS_API_TIMEOUT'])
+            zips = sorted(((zip['zip_code'], zip['distance']) for zip in resp.json()['zip_codes']),
+                          key=lambda pair: (pair[1], pair[0]))
+        return zips
+
+    return radius_cache.get_or_load(f'{zip_code}:{radius}', lookup)
+
+
+def save_search(**params):
+    """Store search parameters server-side and return the search id.
+
+    The id is derived from the parameters, so repeating a search reuses it.
+    """
+
+    search_id = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    searches.set(search_id, params)
+    return search_id
+
+
 @app.route('/search', methods=['GET','POST'])
 def search_musicians():
     """Render search form page."""
@@ -171,29 +457,35 @@ def search_musicians():
     form=SearchForm()   
     if form.validate_on_submit():
 
-        session["searching_for_band"] = form.is_band.data
-        session["searching_instrument"] = form.instruments.data
-        session["searching_genre"] = form.genres.data
         zip_code = form.zip_code.data
-        radius = form.radius.data
+        radius = None if form.nearest.data else form.radius.data
 
         try:
-            resp = requests.get(f"{RADIUS_BASE_URL}/{str(zip_code)}/{radius}/miles")
+            if radius is None:
+                # Closest-match searches walk the search index outward, so the zip code just has to be known
+                zips = [] if zip_code in get_zip_radius_engine() else None
+            else:
+                zips = find_zip_codes_in_radius(zip_code, radius)
 
-            res = resp.json()['zip_codes']
+        except (KeyError, requests.RequestException):
+            flash('API demo request limit has been reached. Please try again in an hour. Sorry for the inconvenience.', 'danger')
+            return render_template('search.html', form=form, page='search')
 
-            zips = []
+        if zips is None:
+            flash('Sorry, we could not find that zip code.', 'danger')
+            return render_template('search.html', form=form, page='search')
 
-            for zip in res:
-                zips.append(zip['zip_code'])
+        search_id = save_search(
+            zip_code=normalize_zip(zip_code),
+            radius=radius,
+            is_band=str(form.is_band.data) == 'True',
+            instruments=form.instruments.data,
+            genres=form.genres.data,
+            match_all_instruments=form.match_all_instruments.data,
+            keywords=form.keywords.data.strip() or None
+        )
 
-            session['response_zip_codes'] = zips
-
-        except KeyError:
-            flash('API demo request limit has been reached. Please try again in an hour. Sorry for the inconvenience.', 'danger')
-            return render_template('search.html', form=form, page='search')
-        
-        return redirect ('/results')
+        return redirect(url_for('search_results', search=search_id))
 
     else:
         return render_template('search.html', form=form, page='search')
@@ -201,23 +493,204 @@ def search_musicians():
     
 
 
+@app.route('/search/cache-stats')
+def search_cache_stats():
+    """Show this worker's radius cache hit/miss counters. Only served in debug mode."""
+
+    if not app.debug:
+        return render_template('404.html'), 404
+
+    return jsonify(radius_cache.stats())
+
+
 @app.route('/results')
 def search_results():
-    """Display search results on the page"""
+    """Display search results for the search id in the query string"""
     
     if not g.user:
         return render_template('home-anon.html')
 
-    instrument = Instrument.query.filter_by(name = session["searching_instrument"]).one()
-    genre = Genre.query.filter_by(name = session["searching_genre"]).one()
+    search = searches.get(request.args.get('search', ''))
 
-    users = db.session.query(User).filter(
-        User.zip_code.in_(session["response_zip_codes"]),
-        User.is_band == session["searching_for_band"], 
-        User.instruments.any(Instrument.id == instrument.id),
-        User.genres.any(Genre.id == genre.id))
-    
-    return render_template('search-results.html', users=users, page='search')
+    try:
+        if search and search['radius'] is None:
+            zips = search_index.nearby_zips(search['zip_code'])
+        else:
+            zips = search and find_zip_codes_in_radius(search['zip_code'], search['radius'])
+    except (KeyError, requests.RequestException):
+        zips = None
+
+    if zips is None:
+        flash('That search has expired. Please search again.', 'info')
+        return redirect('/search')
+
+    vocabularies = get_vocabularies()
+    instrument_ids = vocabularies.instruments.ids(search["instruments"])
+    genre_ids = vocabularies.genres.ids(search["genres"])
+
+    per_page = get_page_size(request.args.get('per_page', type=int),
+                             app.config['SEARCH_RESULTS_PER_PAGE'], app.config['SEARCH_RESULTS_MAX_PER_PAGE'])
+
+    search_index.sync()
+
+    # Results are ordered by (distance, id), or (-relevance, id) with keywords;
+    # the cursor is the last row's sort key
+    after = decode_cursor(request.args.get('after'), float, int, max_id=search_index.max_user_id())
+    keywords = search.get('keywords')
+
+    matches = search_index.match(instrument_ids, genre_ids, search["is_band"], search["match_all_instruments"])
+    if keywords:
+        if search['radius'] is not None:
+            matches &= search_index.in_zips(zip_code for zip_code, distance in zips)
+        page_ids = search_index.ranked(keywords, matches, after=after, limit=per_page + 1)
+    else:
+        page_ids = search_index.nearest_first(zips, matches, after=after, limit=per_page + 1)
+
+    next_url = None
+    if len(page_ids) > per_page:
+        page_ids = page_ids[:per_page]
+        last_id, last_key = page_ids[-1]
+        next_url = url_for('search_results', search=request.args['search'], per_page=per_page,
+                           after=encode_cursor(last_key, last_id))
+
+    # Cards list each user's instruments and genres, so load them up front
+    users = User.query.filter(User.id.in_([id for id, key in page_ids])).options(
+        selectinload(User.instruments), selectinload(User.genres))
+    users = {user.id: user for user in users}
+
+    if keywords:
+        engine = get_zip_radius_engine()
+        results = [(users[id], engine.distance(search['zip_code'], users[id].zip_code))
+                   for id, score in page_ids if id in users]
+    else:
+        results = [(users[id], distance) for id, distance in page_ids if id in users]
+
+    # Who's in the area regardless of the filters, so the next search isn't a guess
+    facets = None
+    if search['radius'] is not None and not after:
+        counts = search_index.area_facet_counts(search['zip_code'], search['radius'], zips)
+        facets = dict(
+            counts,
+            instruments=facet_names(counts['instruments'], vocabularies.instruments),
+            genres=facet_names(counts['genres'], vocabularies.genres))
+
+    return render_template('search-results.html', results=results, next_url=next_url, facets=facets,
+                           first_page=not after, search_id=request.args['search'],
+                           savable=search['radius'] is not None and not keywords, page='search')
+
+
+def facet_names(counts, vocabulary):
+    """(name, count) pairs for facet counts by id, most common first."""
+
+    names = ((vocabulary.by_id[id], count) for id, count in counts.items() if id in vocabulary.by_id)
+    return sorted(names, key=lambda pair: (-pair[1], pair[0]))
+
+
+def saved_search_matches(user_id):
+    """Ids of the saved searches `user_id`'s profile, as indexed, matches."""
+
+    search_index.sync()
+    saved_search_index.sync()
+
+    entry = search_index.users.get(user_id)
+    if entry is None:
+        return set()
+    zip_code, is_band, instrument_ids, genre_ids, words = entry
+    return saved_search_index.percolate(user_id, zip_code, is_band, instrument_ids, genre_ids)
+
+
+def percolate_profile(user_id, matched_before=()):
+    """Tell the owners of saved searches that `user_id`'s just committed profile now matches.
+
+    Searches in `matched_before`, which the profile matched before it
+    changed, are skipped.
+    """
+
+    search_ids = saved_search_matches(user_id) - set(matched_before)
+    if not search_ids:
+        return
+
+    notifications = [search.add_match(user_id)
+                     for search in SavedSearch.query.filter(SavedSearch.id.in_(search_ids))]
+    db.session.commit()
+
+    for notification in notifications:
+        if notification is not None:
+            publish_notification(notification)
+
+
+@app.route('/searches', methods=['GET', 'POST'])
+def saved_searches():
+    """List the current user's saved searches, or save the search id posted."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if request.method == 'POST':
+        search = searches.get(request.form.get('search', ''))
+
+        if search is None:
+            flash('That search has expired. Please search again.', 'info')
+            return redirect('/search')
+        if search['radius'] is None or search.get('keywords'):
+            flash('Only searches within a radius and without keywords can be saved.', 'danger')
+            return redirect(url_for('search_results', search=request.form['search']))
+
+        SavedSearch.from_search(g.user.id, search)
+        db.session.commit()
+
+        flash("Search saved. We'll let you know when new musicians match it.", 'success')
+        return redirect(url_for('saved_searches'))
+
+    saved = SavedSearch.query.filter_by(user_id=g.user.id).order_by(SavedSearch.created_at.desc()).all()
+    new_matches = {n.name: len(n.get_data()['user_ids'])
+                   for n in g.user.notifications.filter(Notification.name.like('saved_search:%'))}
+
+    return render_template('saved-searches.html', saved=saved, new_matches=new_matches, page='search')
+
+
+@app.route('/searches/<int:search_id>')
+def show_saved_search(search_id):
+    """Show the profiles that started matching a saved search since it was last looked at."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    saved = SavedSearch.query.filter_by(id=search_id, user_id=g.user.id).first_or_404()
+
+    user_ids = saved.new_matches()
+    users = User.query.filter(User.id.in_(user_ids)).options(
+        selectinload(User.instruments), selectinload(User.genres))
+    users = {user.id: user for user in users}
+
+    engine = get_zip_radius_engine()
+    results = [(users[id], engine.distance(saved.zip_code, users[id].zip_code))
+               for id in reversed(user_ids) if id in users]
+
+    saved.clear_matches()
+    db.session.commit()
+
+    return render_template('saved-search.html', saved=saved, results=results,
+                           search_id=save_search(**saved.search_params()), page='search')
+
+
+@app.route('/searches/<int:search_id>/delete', methods=['POST'])
+def delete_saved_search(search_id):
+    """Delete one of the current user's saved searches."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    saved = SavedSearch.query.filter_by(id=search_id, user_id=g.user.id).first_or_404()
+    saved.clear_matches()
+    db.session.delete(saved)
+    db.session.commit()
+
+    flash('Saved search deleted.', 'success')
+    return redirect(url_for('saved_searches'))
 
 
 
@@ -234,6 +707,105 @@ def user_profile(user_id):
     return render_template('profile.html', user=user,curr_user=curr_user, page='profile')
 
 
+def save_upload(upload, variants):
+    """Store an uploaded image, queue its resized `variants` and return its URL.
+
+    A picture that is already stored is reused rather than saved again.
+    """
+
+    filename, size, is_new = upload_store.add(upload.stream)
+    Upload.record(filename, size)
+
+    url = upload_url(filename)
+    # A reused picture may not have these variants yet, if it was last used as the other kind of image
+    if is_new or image_pipeline.url(url, variants[0]) == url:
+        image_pipeline.submit(filename, variants)
+    return url
+
+
+@app.route('/uploads/<filename>')
+def uploaded_file(filename):
+    """Serve a stored upload or one of its variants.
+
+    A file's name is the hash of its content, so it can be cached for a year
+    and its name is a strong ETag.
+    """
+
+    if not STORED_NAME.match(filename):
+        return render_template('404.html'), 404
+
+    response = send_from_directory(
+        os.path.join(app.root_path, upload_store.folder), filename,
+        mimetype='image/webp' if filename.endswith('.webp') else None,
+        etag=filename,
+        max_age=UPLOAD_MAX_AGE, conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.cli.command('gc-uploads')
+@click.option('--grace-hours', type=float, default=None,
+              help='Keep unused files changed more recently than this.')
+def gc_uploads(grace_hours):
+    """Delete uploaded files no profile uses any more."""
+
+    if grace_hours is None:
+        grace_hours = app.config['UPLOAD_GC_GRACE_HOURS']
+    cutoff = time.time() - grace_hours * 60 * 60
+
+    # Counts drift if a save fails between storing a file and committing the profile
+    Upload.recount()
+    db.session.commit()
+
+    ref_counts = dict(db.session.query(Upload.filename, Upload.ref_count))
+
+    # Files just uploaded may belong to a profile that hasn't been saved yet
+    def unused(filename):
+        if ref_counts.get(filename, 0) > 0:
+            return False
+        return not os.path.exists(upload_store.path(filename)) or upload_store.modified_at(filename) < cutoff
+
+    deleted = sorted(filename for filename in set(upload_store.stored_files()) | set(ref_counts) if unused(filename))
+
+    Upload.query.filter(Upload.filename.in_(deleted)).delete(synchronize_session=False)
+    db.session.commit()
+    # Only once the rows are gone, so no page is left pointing at a missing file
+    for filename in deleted:
+        upload_store.delete(filename)
+
+    click.echo(f'Deleted {len(deleted)} unused uploads.')
+
+
+@app.cli.command('recount-users')
+def recount_users():
+    """Recompute the counters kept on users from the rows they count (after adding the columns)."""
+
+    Follows.recount()
+    User.recount_unread_messages()
+    db.session.commit()
+
+    click.echo('Recounted followers, following and unread messages.')
+
+
+@app.cli.command('backfill-threads')
+def backfill_threads():
+    """Put messages sent before threads existed into threads (after adding messages.thread_id)."""
+
+    before = Message.query.filter(Message.thread_id == None).count()
+    Thread.backfill()
+    db.session.commit()
+
+    click.echo(f'Moved {before} messages into threads.')
+
+
+@app.template_filter('variant')
+def image_variant(url, variant):
+    """`{{ user.profile_image|variant('avatar') }}`: the resized image once it's ready."""
+
+    return image_pipeline.url(url, variant)
+
+
 @app.route('/users/edit', methods=['GET','POST'])
 def edit_user_profile():
     """Render form to edit current user's profile. Submit form and redirect to profile page"""
@@ -249,46 +821,18 @@ def edit_user_profile():
         user = User.authenticate(g.user.username,form.password.data)
 
         if user:
+            matched_before = saved_search_matches(user.id)
             
-            # Upload header image
+            # Save new images; their resized variants are made in the background
             if request.files['header_image']:
+                header_image = save_upload(request.files['header_image'], HEADER_VARIANTS)
+                Upload.replace(g.user.header_image, header_image)
+                g.user.header_image = header_image
 
-                updated_header_img = request.files['header_image']
-                
-                # Grab Image Names
-                header_img_filename = secure_filename(updated_header_img.filename)
-                
-                # Set UUID
-                header_img_uuid_name = str(uuid.uuid1()) + "_" + header_img_filename
-
-                #Save Images
-                updated_header_img.save(os.path.join(app.config['UPLOAD_FOLDER'],header_img_uuid_name))
-
-                #Change it to a string to save to db
-                header_img_filename = BASE_DIRECTORY + UPLOAD_FOLDER + header_img_uuid_name
-
-                g.user.header_image =  header_img_filename or User.header_image.default.arg
-                
-                
-            # Upload profile image
             if request.files['profile_image']:
-
-                updated_profile_img = request.files['profile_image'] 
-                
-                # Grab Image Names
-                profile_img_filename = secure_filename(updated_profile_img.filename)
-
-                # Set UUID
-                profile_img_uuid_name = str(uuid.uuid1()) + "_" + profile_img_filename
-
-                #Save Images
-                updated_profile_img.save(os.path.join(app.config['UPLOAD_FOLDER'],profile_img_uuid_name))
-
-                #Change it to a string to save to db
-                profile_img_filename = BASE_DIRECTORY +UPLOAD_FOLDER + profile_img_uuid_name
-
-                g.user.profile_image = profile_img_filename or User.profile_image.default.arg
-
+                profile_image = save_upload(request.files['profile_image'], PROFILE_VARIANTS)
+                Upload.replace(g.user.profile_image, profile_image)
+                g.user.profile_image = profile_image
 
             # Update username, email, and bio from form data
             g.user.username = form.username.data
@@ -298,29 +842,18 @@ def edit_user_profile():
             g.user.state=form.state.data
             g.user.zip_code=form.zip_code.data
             
-            # Clear current user's instruments list before adding form data
-            g.user.instruments = []
-
-            # Add form data to add instruments to current user's list
-            for instrument in form.instruments.data:
-
-                inst = Instrument.query.filter_by(name = instrument).first()
-                User_Instrument.add_instrument_to_user(user_id=user.id, instrument_id=inst.id)
-                db.session.add(inst)
+            # Only write the instruments and genres that were added or removed
+            vocabularies = get_vocabularies()
+            instruments_changed = g.user.set_instruments(vocabularies.instruments.ids(form.instruments.data))
+            genres_changed = g.user.set_genres(vocabularies.genres.ids(form.genres.data))
+            if instruments_changed or genres_changed:
+                # Bulk statements get past the flush listener that keeps the search index in step
+                mark_users_changed(db.session, [g.user.id])
 
-            # Clear current user's genres list before adding form data
-            g.user.genres = []
-
-            # Add form data to add instruments to current user's list
-            for genre in form.genres.data:
-    
-                gen = Genre.query.filter_by(name = genre).first()
-                User_Genre.add_genre_to_user(user_id=user.id, genre_id=gen.id)
-                db.session.add(gen)
-            
             db.session.commit()
+            forget_user(user.id)
+            percolate_profile(user.id, matched_before)
 
-            print(form.errors)
             flash('Successfully updated profile.', 'success')
             return redirect(f"/users/{user.id}")
         
@@ -331,8 +864,7 @@ def edit_user_profile():
         # Update form fields with user data for instruments and genres
         form.instruments.data = [instrument.name for instrument in g.user.instruments]
         form.genres.data = [genre.name for genre in g.user.genres]
-        
-        print(form.errors)
+
         return render_template('edit.html', form=form, page='profile',user=g.user)
 
 
@@ -353,8 +885,9 @@ def update_password():
 
         if authenticated and form.new_password.data == form.confirm_password.data:
             password = form.new_password.data
-            g.user.password = bcrypt.generate_password_hash(password).decode('UTF-8')
+            g.user.password = password_hasher.hash(password)
             db.session.commit()
+            forget_user(g.user.id)
 
             flash('Successfully updated password.', 'success')
             return redirect(f"/users/{g.user.id}")
@@ -375,20 +908,28 @@ def send_message(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/users/{g.user.id}")
 
+    if request.method == 'POST':
+        check_rate_limit('send_message', user=g.user.id)
+
     recipient = User.query.get_or_404(user_id)
 
     form = MessageForm()
     
     if form.validate_on_submit():
-        
-        recipient.add_notification('unread_message_count', recipient.new_messages())
 
         subject = form.subject.data
         body = form.body.data
-        msg = Message(sender_id=g.user.id, recipient_id = user_id, subject=subject, body=body)
+        msg = Message(sender_id=g.user.id, recipient_id = user_id, subject=subject, body=body,
+                      thread=Thread.between(g.user.id, user_id))
 
         db.session.add(msg)
+        db.session.flush()
+        ThreadSummary.record_message(msg)
+
+        notification = recipient.add_notification('unread_message_count', recipient.increment_unread_messages())
         db.session.commit()
+        forget_user(user_id)
+        publish_notification(notification)
 
         flash("Message sent.", "success")
         return redirect(f'/users/{user_id}')
@@ -404,52 +945,294 @@ def destroy_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/users/{g.user.id}")
 
-    Message.query.filter(Message.id==message_id).delete()
+    message = Message.query.get_or_404(message_id)
+    if g.user.id not in (message.sender_id, message.recipient_id):
+        flash("Access unauthorized.", "danger")
+        return redirect('/messages')
+
+    thread_id = message.thread_id
+    recipient_id = message.recipient_id
+    was_unread = thread_id is not None and ThreadSummary.forget_unread(message)
+    db.session.delete(message)
+    if thread_id:
+        ThreadSummary.refresh_last_message(thread_id)
+
+    notification = None
+    if was_unread:
+        recipient = User.query.get(recipient_id)
+        db.session.expire(recipient, ['unread_message_count'])
+        notification = recipient.add_notification('unread_message_count', recipient.unread_message_count)
     db.session.commit()
 
+    if notification is not None:
+        forget_user(recipient_id)
+        publish_notification(notification)
+
     flash("Message deleted.", "success")
-    return redirect('/messages')
+    return redirect(url_for('show_thread', thread_id=thread_id) if thread_id else '/messages')
+
+def decode_timestamp_cursor(token):
+    """Return the (timestamp, id) sort key in a message or thread page cursor, or None."""
+
+    values = decode_cursor(token, str, int)
+    if values is None:
+        return None
+
+    try:
+        return datetime.fromisoformat(values[0]), values[1]
+    except ValueError:
+        return None
+
+
+def paginate_messages(query, endpoint, **url_args):
+    """Return (messages, next_url, prev_url) for one page of `query`, newest first.
+
+    Pages are keyed on (timestamp, id): `?after=` pages to older messages and
+    `?before=` back to newer ones, so every page is a short index range scan
+    however deep it is.
+    """
+
+    per_page = app.config['POSTS_PER_PAGE']
+    after = decode_timestamp_cursor(request.args.get('after'))
+    before = decode_timestamp_cursor(request.args.get('before'))
+    sort_key = db.tuple_(Message.timestamp, Message.id)
+
+    query = query.options(selectinload(Message.author), selectinload(Message.recipient))
+
+    if before:
+        messages = query.filter(sort_key > before).order_by(
+            Message.timestamp.asc(), Message.id.asc()).limit(per_page + 1).all()
+        has_newer, has_older = len(messages) > per_page, True
+        messages = messages[:per_page][::-1]
+    else:
+        if after:
+            query = query.filter(sort_key < after)
+        messages = query.order_by(
+            Message.timestamp.desc(), Message.id.desc()).limit(per_page + 1).all()
+        has_newer, has_older = bool(after), len(messages) > per_page
+        messages = messages[:per_page]
+
+    next_url = prev_url = None
+    if messages and has_older:
+        next_url = url_for(endpoint, after=encode_cursor(messages[-1].timestamp.isoformat(), messages[-1].id), **url_args)
+    if messages and has_newer:
+        prev_url = url_for(endpoint, before=encode_cursor(messages[0].timestamp.isoformat(), messages[0].id), **url_args)
+
+    return messages, next_url, prev_url
+
 
 @app.route('/messages')
 def messages():
+    """List the current user's conversations, most recently active first."""
+
     if not g.user:
             flash("Access unauthorized.", "danger")
             return redirect("/users/{g.user.id}")
 
+    per_page = app.config['POSTS_PER_PAGE']
+    after = decode_timestamp_cursor(request.args.get('after'))
+
+    # One range scan of the summaries index, with the other user and last message joined in
+    summaries = ThreadSummary.query.filter(ThreadSummary.user_id == session[CURR_USER_KEY]).options(
+        joinedload(ThreadSummary.other_user), joinedload(ThreadSummary.last_message))
+    if after:
+        summaries = summaries.filter(db.tuple_(ThreadSummary.last_activity, ThreadSummary.thread_id) < after)
+    summaries = summaries.order_by(ThreadSummary.last_activity.desc(), ThreadSummary.thread_id.desc()).limit(per_page + 1).all()
+
+    next_url = None
+    if len(summaries) > per_page:
+        summaries = summaries[:per_page]
+        next_url = url_for('messages', after=encode_cursor(summaries[-1].last_activity.isoformat(), summaries[-1].thread_id))
+
+    return render_template('threads.html', summaries=summaries, box='threads', next_url=next_url,
+                           prev_url=url_for('messages') if after else None, page='messages')
+
+
+@app.route('/messages/thread/<int:thread_id>')
+def show_thread(thread_id):
+    """Show the messages in one conversation, newest first, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    thread = Thread.query.get_or_404(thread_id)
+    if not thread.has_participant(g.user.id):
+        flash("Access unauthorized.", "danger")
+        return redirect('/messages')
+
+    if ThreadSummary.mark_read(g.user.id, thread_id):
+        db.session.expire(g.user, ['unread_message_count'])
+        notification = g.user.add_notification('unread_message_count', g.user.unread_message_count)
+        db.session.commit()
+        forget_user(g.user.id)
+        publish_notification(notification)
+
+    other_user = User.query.get(thread.user_high_id if thread.user_low_id == g.user.id else thread.user_low_id)
+    messages, next_url, prev_url = paginate_messages(
+        thread.messages, 'show_thread', thread_id=thread_id)
+    return render_template('messages.html', messages=messages, box='thread', other_user=other_user,
+                           next_url=next_url, prev_url=prev_url, page='messages')
+
+
+@app.route('/messages/received')
+def received_messages():
+    """List every message the current user has received, newest first, and mark them all read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    ThreadSummary.mark_read(g.user.id)
     g.user.last_message_read_time = datetime.utcnow()
-    g.user.add_notification('unread_message_count', 0)
+    g.user.unread_message_count = 0
+    notification = g.user.add_notification('unread_message_count', 0)
     db.session.commit()
+    forget_user(g.user.id)
+    publish_notification(notification)
+
+    messages, next_url, prev_url = paginate_messages(
+        Message.query.filter(Message.recipient_id == session[CURR_USER_KEY]), 'received_messages')
+    return render_template('messages.html', messages=messages, box='received',
+                           next_url=next_url, prev_url=prev_url, page='messages')
+
+
+@app.route('/messages/sent')
+def sent_messages():
+    """List messages the current user has sent, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    page = request.args.get('page', 1, type=int)
-    messages = g.user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    messages, next_url, prev_url = paginate_messages(
+        Message.query.filter(Message.sender_id == g.user.id), 'sent_messages')
+    return render_template('messages.html', messages=messages, box='sent',
                            next_url=next_url, prev_url=prev_url, page='messages')
 
 
+@app.route('/messages/search')
+def search_messages():
+    """Search the subjects and bodies of messages the current user sent or received, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    text = request.args.get('q', '').strip()
+    if not text:
+        return render_template('messages.html', messages=[], box='search', q=text,
+                               next_url=None, prev_url=None, page='messages')
+
+    query = Message.query.filter(or_(Message.recipient_id == g.user.id, Message.sender_id == g.user.id))
+    if message_search_index is None:
+        query = query.filter(Message.matching(text))
+    else:
+        message_search_index.sync()
+        message_ids = message_search_index.search(
+            g.user.id, text, after=decode_timestamp_cursor(request.args.get('after')),
+            before=decode_timestamp_cursor(request.args.get('before')), limit=app.config['POSTS_PER_PAGE'] + 1)
+        query = query.filter(Message.id.in_(message_ids))
+
+    messages, next_url, prev_url = paginate_messages(query, 'search_messages', q=text)
+    return render_template('messages.html', messages=messages, box='search', q=text,
+                           next_url=next_url, prev_url=prev_url, page='messages')
+
+
+def notification_json(notification):
+    return {
+        'name': notification.name,
+        'data': notification.get_data(),
+        'timestamp': notification.timestamp
+    }
+
+
+def publish_notification(notification):
+    """Push a committed notification to its user's open notification streams."""
+
+    notification_broker.publish(f'user:{notification.user_id}', notification_json(notification))
+
+
 @app.route('/notifications')
 def notifications():
     """Update notifications using an AJAX call"""
     
-    if not g.user:
+    # Polled from every open tab, so filter on the session's user id rather than loading the user
+    if CURR_USER_KEY not in session:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     since = request.args.get('since', 0.0, type=float)
 
-    notifications = g.user.notifications.filter(
+    notifications = Notification.query.filter(
+        Notification.user_id == session[CURR_USER_KEY],
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications])
+    return jsonify([notification_json(n) for n in notifications])
+
+
+@app.route('/notifications/stream')
+def notification_stream():
+    """Stream the current user's notifications as Server-Sent Events.
+
+    Sends anything newer than `since` (or the browser's Last-Event-ID on a
+    reconnect) first, then waits on the broker, so an idle stream runs no
+    database queries. Streams end after NOTIFICATION_STREAM_MAX_SECONDS and
+    the browser reconnects.
+
+    Once this worker has NOTIFICATION_STREAMS_PER_WORKER streams open, it
+    answers 503 instead, and app.js falls back to polling.
+    """
+
+    # 204 tells EventSource to stop reconnecting
+    if CURR_USER_KEY not in session:
+        return '', 204
+
+    if not notification_stream_slots.acquire(blocking=False):
+        return Response(f"retry: {app.config['NOTIFICATION_STREAM_RETRY_MS']}\n\n", status=503,
+                        mimetype='text/event-stream', headers={'Retry-After': '30', 'Cache-Control': 'no-cache'})
+
+    user_id = session[CURR_USER_KEY]
+    try:
+        since = float(request.headers.get('Last-Event-ID') or request.args.get('since') or 0)
+    except ValueError:
+        since = 0.0
+
+    try:
+        # Subscribe before reading the backlog so nothing sent in between is missed
+        subscription = notification_broker.subscribe(f'user:{user_id}')
+        backlog = [notification_json(n) for n in Notification.query.filter(
+            Notification.user_id == user_id,
+            Notification.timestamp > since).order_by(Notification.timestamp.asc())]
+    except BaseException:
+        notification_stream_slots.release()
+        raise
+
+    # The stream stays open for minutes; don't hold a database connection for it
+    db.session.remove()
+
+    heartbeat = app.config['NOTIFICATION_STREAM_HEARTBEAT']
+    deadline = time.time() + app.config['NOTIFICATION_STREAM_MAX_SECONDS']
+
+    def format_event(notification):
+        return f"id: {notification['timestamp']}\nevent: notification\ndata: {json.dumps(notification)}\n\n"
+
+    def stream():
+        with subscription:
+            yield f"retry: {app.config['NOTIFICATION_STREAM_RETRY_MS']}\n\n"
+
+            for notification in backlog:
+                yield format_event(notification)
+
+            while time.time() < deadline:
+                notification = subscription.get(timeout=min(heartbeat, max(deadline - time.time(), 0)))
+                yield format_event(notification) if notification else ': keep-alive\n\n'
+
+    resp = Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(subscription.close)
+    resp.call_on_close(notification_stream_slots.release)
+    return resp
 
 
 #Follow Routes
@@ -458,7 +1241,9 @@ def show_follows(user_id):
     """Query and display all follows for a user."""
 
     user = User.query.get_or_404(user_id)
-    users = user.following
+    users = User.query.join(Follows, Follows.user_being_followed_id == User.id).filter(
+        Follows.user_following_id == user_id).options(
+        selectinload(User.instruments), selectinload(User.genres)).order_by(User.id).all()
 
     return render_template('following.html', title='Following', user=user,users=users)
 
@@ -471,11 +1256,20 @@ def follow_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/users/{g.user.id}")
 
+    User.query.get_or_404(user_id)
+
     if not g.user.is_following(user_id):
-        
-        follow = Follows(user_being_followed_id=user_id, user_following_id = g.user.id)
-        db.session.add(follow)
-        db.session.commit()
+        curr_user_id = g.user.id
+
+        try:
+            Follows.follow(curr_user_id, user_id)
+            db.session.commit()
+        except exc.IntegrityError:
+            # Followed from another tab in the meantime
+            db.session.rollback()
+
+        forget_user(curr_user_id)
+        forget_user(user_id)
         return redirect(f"/users/{user_id}")
     return redirect(f"/users/{user_id}")
 
@@ -488,9 +1282,12 @@ def unfollow_user(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/users/{g.user.id}")
     
-    follow = Follows.query.filter(Follows.user_being_followed_id == user_id, Follows.user_following_id == g.user.id).one()
-    db.session.delete(follow)
-    db.session.commit()
+    curr_user_id = g.user.id
+
+    if Follows.unfollow(curr_user_id, user_id):
+        db.session.commit()
+        forget_user(curr_user_id)
+        forget_user(user_id)
     return redirect(f"/users/{user_id}")
 
 
@@ -499,24 +1296,53 @@ def show_follower(user_id):
     """Query and display all followers for a user."""
 
     user = User.query.get_or_404(user_id)
-    users = user.followers
+    users = User.query.join(Follows, Follows.user_following_id == User.id).filter(
+        Follows.user_being_followed_id == user_id).options(
+        selectinload(User.instruments), selectinload(User.genres)).order_by(User.id).all()
 
     return render_template('followers.html', user=user,users=users)
 
 
-@app.errorhandler(413)
-def request_entity_too_large(error):
-    """What happens if a file is too large."""
+def upload_rejected(message, status):
+    """Show the current user's profile with why their upload was refused."""
 
     if not g.user:
-        return render_template('home-anon.html')
+        return render_template('home-anon.html'), status
 
     user = g.user
     curr_user = g.user
     db.session.rollback()
-    flash('The photo upload was too large. Please limit file uploads to <16MB.' + str(error), 'danger')
-    return render_template('profile.html',413, user=user,curr_user=curr_user, page='profile')
-    
+    flash(message, 'danger')
+    return render_template('profile.html', user=user,curr_user=curr_user, page='profile'), status
+
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    """What happens if a file is too large."""
+
+    return upload_rejected('The photo upload was too large. Please limit file uploads to <16MB.', 413)
+
+
+@app.errorhandler(415)
+def unsupported_media_type(error):
+    """What happens if an upload isn't an image."""
+
+    return upload_rejected('Please upload a JPEG, PNG, GIF or WebP image.', 415)
+
+
+
+@app.errorhandler(429)
+def too_many_requests(error):
+    """What happens if a client is over a rate limit."""
+
+    headers = {'Retry-After': str(error.retry_after)}
+
+    if not g.user:
+        # Only logins are limited for anonymous users; show the form again
+        flash(error.description, 'danger')
+        return render_template('/auth.html', form=LoginForm(), page='Login'), 429, headers
+
+    return render_template('404.html', error=error.description), 429, headers
 
 
 @app.errorhandler(404)
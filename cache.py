@@ -0,0 +1,281 @@
+"""Two-tier caching: a per-process LRU in front of a SQLite file every worker shares."""
+
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+SHARED_CACHE_PATH = os.environ.get(
+    'SHARED_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'hook-shared-cache.sqlite3'))
+
+# Expired rows are swept out of the shared store every this many writes
+PURGE_EVERY_WRITES = 1000
+
+# How long another worker's in-flight load is waited on before loading anyway
+LEASE_SECONDS = 10
+LEASE_POLL_SECONDS = 0.05
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Small thread-safe LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, max_entries=256, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if missing or expired."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` under `key`, evicting the least recently used entry if full."""
+
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (time.time() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteFile:
+    """Base for stores kept in a SQLite file shared by every process on the host.
+
+    Subclasses list the statements that create their tables in `SCHEMA`.
+    """
+
+    SCHEMA = ()
+
+    def __init__(self, path=SHARED_CACHE_PATH):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        """Return this thread's connection, reopening it after a fork."""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            self._restrict_permissions()
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+    def _restrict_permissions(self):
+        """Create the file readable by this user only; SQLite gives its -wal and -shm files the same mode."""
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.fchmod(fd, 0o600)
+        except OSError:
+            # Someone else's file; leave it as it is
+            pass
+        finally:
+            os.close(fd)
+
+
+class SharedStore(SQLiteFile):
+    """Key/value store in a SQLite file, readable by every process on the host.
+
+    Values are stored as JSON, so tuples come back as lists.
+    """
+
+    SCHEMA = ("""CREATE TABLE IF NOT EXISTS cache (
+                     namespace TEXT NOT NULL,
+                     key TEXT NOT NULL,
+                     value TEXT NOT NULL,
+                     expires_at REAL NOT NULL,
+                     PRIMARY KEY (namespace, key))""",)
+
+    def __init__(self, path=SHARED_CACHE_PATH):
+        super().__init__(path)
+        self._writes = 0
+
+    def get(self, namespace, key, default=None):
+        row = self._connection().execute(
+            'SELECT value FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?',
+            (namespace, key, time.time())).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, namespace, key, value, ttl):
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), time.time() + ttl))
+
+        self._writes += 1
+        if self._writes % PURGE_EVERY_WRITES == 0:
+            self.purge_expired()
+
+    def add(self, namespace, key, value, ttl):
+        """Store `value` only if `key` is absent or expired. Returns True if stored."""
+
+        conn = self._connection()
+        now = time.time()
+        conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ? AND expires_at <= ?',
+                     (namespace, key, now))
+        cursor = conn.execute(
+            'INSERT OR IGNORE INTO cache (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+            (namespace, key, json.dumps(value), now + ttl))
+        return cursor.rowcount == 1
+
+    def delete(self, namespace, key):
+        self._connection().execute(
+            'DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def clear(self, namespace):
+        self._connection().execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+
+    def purge_expired(self):
+        self._connection().execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+
+class TwoTierCache:
+    """Cache lookups in process memory first, then in a store shared by all workers.
+
+    `get_or_load` coalesces concurrent misses for the same key: threads in this
+    process wait on the one doing the load, and other processes wait on a
+    short lease in the shared store, so the loader runs once per key.
+    """
+
+    def __init__(self, namespace, ttl=3600, max_entries=256, local_ttl=None, store=None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.local = LRUCache(max_entries=max_entries, ttl=ttl if local_ttl is None else local_ttl)
+        self.shared = store or SharedStore()
+        self.counters = {'local_hits': 0, 'shared_hits': 0, 'misses': 0, 'loads': 0, 'coalesced': 0}
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def get(self, key, default=None):
+        """Return the value cached under `key`, checking memory before the shared store."""
+
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('local_hits')
+            return value
+
+        value = self.shared.get(self.namespace, key, _MISSING)
+        if value is not _MISSING:
+            self._count('shared_hits')
+            self.local.set(key, value)
+            return value
+
+        self._count('misses')
+        return default
+
+    def set(self, key, value):
+        """Cache `value` in both tiers and return it as the shared tier will hand it back."""
+
+        value = json.loads(json.dumps(value))
+        self.shared.set(self.namespace, key, value, self.ttl)
+        self.local.set(key, value)
+        return value
+
+    def delete(self, key):
+        self.shared.delete(self.namespace, key)
+        self.local.delete(key)
+
+    def clear(self):
+        """Drop every key in this namespace (other workers' memory tiers expire on their own)."""
+
+        self.shared.clear(self.namespace)
+        self.local.clear()
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for `key`, calling `loader()` once to fill a miss."""
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not leader:
+            self._count('coalesced')
+            event.wait()
+            value = self.get(key, _MISSING)
+            return loader() if value is _MISSING else value
+
+        try:
+            value = self._load_once_across_workers(key, loader)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+        return value
+
+    def _load_once_across_workers(self, key, loader):
+        lease = f'lease:{key}'
+
+        if not self.shared.add(self.namespace, lease, os.getpid(), LEASE_SECONDS):
+            # Another worker is loading this key: wait for its result
+            deadline = time.time() + LEASE_SECONDS
+            while time.time() < deadline:
+                time.sleep(LEASE_POLL_SECONDS)
+                value = self.shared.get(self.namespace, key, _MISSING)
+                if value is not _MISSING:
+                    self._count('coalesced')
+                    self.local.set(key, value)
+                    return value
+
+        try:
+            self._count('loads')
+            return self.set(key, loader())
+        finally:
+            self.shared.delete(self.namespace, lease)
+
+    def stats(self):
+        """Return hit/miss counters for this process."""
+
+        with self._lock:
+            stats = dict(self.counters)
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['local_hits'] + stats['shared_hits']) / lookups, 3) if lookups else None
+        stats['local_entries'] = len(self.local)
+        return stats
@@ -0,0 +1,88 @@
+"""Append-only event log shared by every worker process on the host.
+
+Workers append events after a change and read everything past the last
+sequence number they have seen, which is how per-process indexes stay in
+step with changes made by other workers.
+"""
+
+import json
+import time
+from cache import SQLiteFile, SHARED_CACHE_PATH
+
+# Events older than this are trimmed; a reader that falls further behind must rebuild
+EVENT_RETENTION_SECONDS = 24 * 60 * 60
+TRIM_EVERY_APPENDS = 1000
+
+
+class EventLog(SQLiteFile):
+    """Topic-tagged events with increasing sequence numbers, stored in SQLite."""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS events (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               topic TEXT NOT NULL,
+               payload TEXT NOT NULL,
+               created_at REAL NOT NULL)""",
+        'CREATE INDEX IF NOT EXISTS ix_events_topic_seq ON events (topic, seq)',
+        """CREATE TABLE IF NOT EXISTS events_horizon (
+               topic TEXT PRIMARY KEY,
+               seq INTEGER NOT NULL)""",
+    )
+
+    def __init__(self, path=SHARED_CACHE_PATH, retention=EVENT_RETENTION_SECONDS):
+        super().__init__(path)
+        self.retention = retention
+        self._appends = 0
+
+    def append(self, topic, payload):
+        """Add an event and return its sequence number."""
+
+        cursor = self._connection().execute(
+            'INSERT INTO events (topic, payload, created_at) VALUES (?, ?, ?)',
+            (topic, json.dumps(payload), time.time()))
+
+        self._appends += 1
+        if self._appends % TRIM_EVERY_APPENDS == 0:
+            self.trim()
+        return cursor.lastrowid
+
+    def read_since(self, topic, seq, limit=1000):
+        """Return up to `limit` (seq, payload) pairs for `topic` after `seq`.
+
+        Returns None if events after `seq` have already been trimmed, meaning
+        the caller missed changes and has to rebuild from scratch.
+        """
+
+        conn = self._connection()
+
+        horizon = conn.execute('SELECT seq FROM events_horizon WHERE topic = ?', (topic,)).fetchone()
+        if horizon and horizon[0] > seq:
+            return None
+
+        rows = conn.execute(
+            'SELECT seq, payload FROM events WHERE topic = ? AND seq > ? ORDER BY seq LIMIT ?',
+            (topic, seq, limit)).fetchall()
+        return [(row_seq, json.loads(payload)) for row_seq, payload in rows]
+
+    def last_seq(self):
+        """Return the newest sequence number across all topics (0 if empty)."""
+
+        row = self._connection().execute('SELECT MAX(seq) FROM events').fetchone()
+        return row[0] or 0
+
+    def trim(self):
+        """Delete events past the retention window, remembering how far each topic was trimmed."""
+
+        conn = self._connection()
+        cutoff = time.time() - self.retention
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute("""INSERT OR REPLACE INTO events_horizon (topic, seq)
+                            SELECT topic, MAX(seq) FROM events WHERE created_at < ? GROUP BY topic""",
+                         (cutoff,))
+            conn.execute('DELETE FROM events WHERE created_at < ?', (cutoff,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
@@ -1,8 +1,7 @@
 import email
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField
-from multiselect_options import INSTRUMENT_CHOICES, GENRE_CHOICES
-from models import Instrument, Genre
+from vocabulary import get_vocabularies
 from wtforms import StringField, IntegerField, PasswordField, BooleanField, IntegerRangeField, RadioField, TextAreaField, SelectMultipleField, SelectField
 from wtforms.validators import DataRequired, Email, Length, NumberRange
 
@@ -19,19 +18,16 @@ class SignupForm(FlaskForm):
     is_band = BooleanField('Is this a band page?')
 
 
-def create_multiform_choices(list):
-    """Create choice tuples to use as multiform choices."""
+def instrument_choices():
+    """Instrument choices, read from the process-wide vocabulary when a form is created."""
 
-    result = []
-   
-    for choice in list:
-        try:
-            result.append((choice, choice.title()))
-        except:pass
-    return result
+    return get_vocabularies().instruments.choices()
 
-instrument_choices = create_multiform_choices(INSTRUMENT_CHOICES)
-genre_choices = create_multiform_choices(GENRE_CHOICES)
+
+def genre_choices():
+    """Genre choices, read from the process-wide vocabulary when a form is created."""
+
+    return get_vocabularies().genres.choices()
 
 
 class EditProfileForm(FlaskForm):
@@ -64,9 +60,12 @@ class SearchForm(FlaskForm):
     (False, 'Musicians'),
     (True, 'Bands')],
     default=False, validators=[DataRequired()])
-    instruments = SelectField('Instrument Played', id='instruments-search', choices=instrument_choices)
-    genres = SelectField('Genre Played', id='genres-search', choices=genre_choices)
+    instruments = SelectMultipleField('Instrument Played', id='instruments-search', choices=instrument_choices, validators=[DataRequired()])
+    match_all_instruments = BooleanField('Must play all of these instruments')
+    genres = SelectMultipleField('Genre Played', id='genres-search', choices=genre_choices, validators=[DataRequired()])
+    keywords = StringField('Keywords (optional)', validators=[Length(max=200)])
     zip_code = IntegerField('Zip Code', validators=[NumberRange(min=00000, max=99999, message='Please enter a valid zip code.'),DataRequired()])
+    nearest = BooleanField('Ignore the radius and show the closest matches')
     radius = IntegerRangeField('Radius in Miles', default=10)
 
 
@@ -0,0 +1,37 @@
+"""Gunicorn settings (picked up automatically from the working directory).
+
+Notification streams hold a request open for minutes, so workers serve
+requests from a thread pool instead of one at a time. Streams may only take
+half of a worker's threads (NOTIFICATION_STREAMS_PER_WORKER); browsers turned
+away past that poll instead.
+
+The app is imported once in the master and read-only lookup data is loaded
+there before the workers are forked, so they start with it instead of each
+reading it again.
+"""
+
+import os
+
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+
+
+def when_ready(server):
+    """Load the instrument/genre vocabularies and zip code data, and pick the bcrypt cost, before forking."""
+
+    from app import app
+    from models import db
+    from passwords import password_hasher
+    from vocabulary import load_vocabularies
+    from zip_radius import get_engine
+
+    with app.app_context():
+        load_vocabularies()
+        db.session.remove()
+        # Workers must open their own database connections, not inherit the master's
+        db.engine.dispose()
+
+    get_engine()
+    password_hasher.calibrate()
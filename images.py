@@ -0,0 +1,138 @@
+"""Resized variants of uploaded profile and header images.
+
+Uploads are saved as they arrive, then a small pool of background threads
+makes fixed-size WebP copies of them, so saving a profile doesn't wait on
+image processing and pages don't send a 16 MB original to fill a 96 px
+circle. Until a variant is ready, templates fall back to the original, as
+they do for good when an upload can't be read or has too many pixels to decode.
+
+Variants sit next to the original: `<name>.<variant>.webp`.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from PIL import Image, ImageOps
+from cache import LRUCache
+
+# Twice the largest size each is shown at, for high density screens
+VARIANTS = {
+    'avatar': (192, 192),
+    'card': (384, 384),
+    'header': (1792, 448),
+}
+PROFILE_VARIANTS = ('avatar', 'card')
+HEADER_VARIANTS = ('header',)
+
+WEBP_QUALITY = 80
+IMAGE_WORKERS = 2
+
+# Larger images are refused before decoding; a tiny, highly compressed file can unpack to gigabytes
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+
+# How long a variant found missing is taken to still be missing, instead of checking the disk on every page
+MISSING_VARIANT_TTL = 10
+MISSING_VARIANT_ENTRIES = 4096
+
+# Variants known to be made, and uploads that couldn't be, for the most recently shown images
+KNOWN_VARIANT_TTL = 24 * 60 * 60
+KNOWN_VARIANT_ENTRIES = 4096
+
+
+def variant_filename(filename, variant):
+    return f'{filename}.{variant}.webp'
+
+
+def make_variants(path, variants, max_pixels=MAX_IMAGE_PIXELS):
+    """Write the `variants` of the image at `path` beside it. Returns the paths written.
+
+    Raises `Image.DecompressionBombError` for images over `max_pixels`,
+    checked from the header before any pixels are decoded.
+    """
+
+    sizes = [VARIANTS[variant] for variant in variants]
+    written = []
+
+    with Image.open(path) as image:
+        width, height = image.size
+        if width * height > max_pixels:
+            raise Image.DecompressionBombError(f'{width}x{height} image is over {max_pixels} pixels')
+
+        # Lets the JPEG decoder scale down while decoding instead of afterwards
+        image.draft('RGB', (max(width for width, height in sizes), max(height for width, height in sizes)))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+
+        for variant, size in zip(variants, sizes):
+            target = os.path.join(os.path.dirname(path), variant_filename(os.path.basename(path), variant))
+            partial = f'{target}.{os.getpid()}.tmp'
+            ImageOps.fit(image, size, Image.LANCZOS).save(partial, 'WEBP', quality=WEBP_QUALITY, method=4)
+            # Never let a page link to a half-written file
+            os.replace(partial, target)
+            written.append(target)
+
+    return written
+
+
+class ImagePipeline:
+    """Makes image variants on a pool of background threads."""
+
+    def __init__(self, folder, url_path=None, max_workers=IMAGE_WORKERS):
+        self.folder = folder
+        # URLs of uploads start with `url_path`; older ones have `folder` in them
+        self.url_path = url_path
+        self.max_workers = max_workers
+        self.ready = LRUCache(max_entries=KNOWN_VARIANT_ENTRIES, ttl=KNOWN_VARIANT_TTL)
+        self.failed = LRUCache(max_entries=KNOWN_VARIANT_ENTRIES, ttl=KNOWN_VARIANT_TTL)
+        self.missing = LRUCache(max_entries=MISSING_VARIANT_ENTRIES, ttl=MISSING_VARIANT_TTL)
+        self._executor = None
+        self._lock = Lock()
+
+    def submit(self, filename, variants):
+        """Queue the variants of an uploaded file. Returns a future of the paths written."""
+
+        with self._lock:
+            # Created on first use, so no threads exist yet if gunicorn forks after importing us
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='images')
+        return self._executor.submit(self._process, filename, variants)
+
+    def _process(self, filename, variants):
+        if self.failed.get(filename):
+            return []
+
+        try:
+            written = make_variants(os.path.join(self.folder, filename), variants)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # Not an image Pillow can read, or too big to; pages keep showing the original
+            self.failed.set(filename, True)
+            return []
+
+        for path in written:
+            self.ready.set(os.path.basename(path), True)
+        return written
+
+    def url(self, url, variant):
+        """The URL of an image's `variant` if it has been made, else `url` itself.
+
+        Only uploads have variants; the default images are already small.
+        """
+
+        if not url or not (self.folder in url or (self.url_path and url.startswith(self.url_path))):
+            return url
+
+        prefix, filename = url.rsplit('/', 1)
+        if self.failed.get(filename):
+            return url
+        name = variant_filename(filename, variant)
+
+        # Another worker may have made it; remember once it's there (variants don't change),
+        # and only look again for a missing one once `MISSING_VARIANT_TTL` has passed
+        if not self.ready.get(name):
+            if self.missing.get(name):
+                return url
+            if not os.path.exists(os.path.join(self.folder, name)):
+                self.missing.set(name, True)
+                return url
+            self.ready.set(name, True)
+        return f'{prefix}/{name}'
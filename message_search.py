@@ -0,0 +1,101 @@
+"""In-process full-text index of messages, for databases without one of their own.
+
+Postgres searches message subjects and bodies with a GIN index on their
+tsvector (see `Message.matching`). Elsewhere, e.g. the SQLite setups tests run
+against, each worker keeps an `InvertedIndex` per user of the messages they
+sent or received, kept in step with other workers through the `EventLog`
+the same way the user `SearchIndex` is.
+
+Matching is on whole words; unlike Postgres there is no stemming.
+"""
+
+import heapq
+from models import db, Message, User
+from synced_index import EventSyncedIndex, watch_changes
+from text_index import InvertedIndex
+
+MESSAGE_CHANGES_TOPIC = 'messages'
+
+
+class MessageSearchIndex(EventSyncedIndex):
+    """An inverted index of subjects and bodies for every user's messages."""
+
+    TOPIC = MESSAGE_CHANGES_TOPIC
+
+    def __init__(self, events=None):
+        super().__init__(events)
+        self.mailboxes = {}
+        self.messages = {}
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add_message(self, message_id, sender_id, recipient_id, timestamp, subject, body):
+        """Index a message in its sender's and recipient's mailboxes."""
+
+        with self._lock:
+            self.remove_message(message_id)
+
+            owners = {sender_id, recipient_id} - {None}
+            for user_id in owners:
+                self.mailboxes.setdefault(user_id, InvertedIndex()).add(message_id, f'{subject} {body}')
+            self.messages[message_id] = ((timestamp, message_id), owners)
+
+    def remove_message(self, message_id):
+        with self._lock:
+            entry = self.messages.pop(message_id, None)
+            if entry is None:
+                return
+
+            for user_id in entry[1]:
+                mailbox = self.mailboxes[user_id]
+                mailbox.remove(message_id)
+                if not len(mailbox):
+                    del self.mailboxes[user_id]
+
+    def search(self, user_id, text, after=None, before=None, limit=None):
+        """Return ids of `user_id`'s messages containing every word of `text`.
+
+        Pages like `paginate_messages`: newest first, starting below the
+        (timestamp, id) cursor `after`, or with `before` the oldest messages
+        newer than it. Only `limit` ids are returned, so the database is asked
+        for one page of rows however many messages match.
+        """
+
+        with self._lock:
+            mailbox = self.mailboxes.get(user_id)
+            if mailbox is None:
+                return []
+
+            keys = (self.messages[message_id][0] for message_id in mailbox.search(text))
+            if before:
+                keys = [key for key in keys if key > before]
+                keys = heapq.nsmallest(limit, keys) if limit else keys
+            else:
+                if after:
+                    keys = [key for key in keys if key < after]
+                keys = heapq.nlargest(limit, keys) if limit else keys
+
+            return [message_id for timestamp, message_id in keys]
+
+    def _clear(self):
+        self.mailboxes, self.messages = {}, {}
+
+    def _forget(self, message_id):
+        self.remove_message(message_id)
+
+    def _load(self, message_ids):
+        messages = db.session.query(Message.id, Message.sender_id, Message.recipient_id,
+                                    Message.timestamp, Message.subject, Message.body)
+        if message_ids is not None:
+            messages = messages.filter(Message.id.in_(message_ids))
+
+        for row in messages:
+            self.add_message(*row)
+
+
+def watch_message_changes(events):
+    """Append the ids of messages sent or deleted to `events` on commit."""
+
+    # Deleting users takes their messages with them
+    watch_changes(events, MESSAGE_CHANGES_TOPIC, Message, 'changed_message_ids', bulk_deletes=(User,))
@@ -1,11 +1,12 @@
 from datetime import datetime
 from flask import g
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event, exc
 import json
 from time import time
+from passwords import password_hasher
+from uploads import UPLOADS_URL, filename_from_url
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -26,6 +27,47 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def exists(cls, user_following_id, user_being_followed_id):
+        """Does the one user follow the other? A primary key lookup."""
+
+        return cls.query.get((user_being_followed_id, user_following_id)) is not None
+
+    @classmethod
+    def follow(cls, user_following_id, user_being_followed_id):
+        """Add a follow and bump both users' counters in the same transaction."""
+
+        db.session.add(cls(user_being_followed_id=user_being_followed_id, user_following_id=user_following_id))
+        db.session.flush()
+        cls._adjust_counts(user_following_id, user_being_followed_id, 1)
+
+    @classmethod
+    def unfollow(cls, user_following_id, user_being_followed_id):
+        """Remove a follow and its counts. Returns False if there was no follow to remove."""
+
+        deleted = cls.query.filter(cls.user_being_followed_id == user_being_followed_id,
+                                   cls.user_following_id == user_following_id).delete(synchronize_session=False)
+        if deleted:
+            cls._adjust_counts(user_following_id, user_being_followed_id, -1)
+        return bool(deleted)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every user's follower and following counts from the follows table."""
+
+        followers = db.select(db.func.count()).where(cls.user_being_followed_id == User.id).scalar_subquery()
+        following = db.select(db.func.count()).where(cls.user_following_id == User.id).scalar_subquery()
+        User.query.update({User.follower_count: followers, User.following_count: following},
+                          synchronize_session=False)
+
+    @staticmethod
+    def _adjust_counts(user_following_id, user_being_followed_id, change):
+        # Incremented in SQL so concurrent follows of the same user can't lose updates
+        User.query.filter(User.id == user_following_id).update(
+            {User.following_count: User.following_count + change}, synchronize_session=False)
+        User.query.filter(User.id == user_being_followed_id).update(
+            {User.follower_count: User.follower_count + change}, synchronize_session=False)
+
 
 
 class User(db.Model):
@@ -96,6 +138,21 @@ class User(db.Model):
         default=datetime.utcnow(),
     )
 
+    # Kept in step by Follows.follow / Follows.unfollow, so profiles don't count rows
+    follower_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
 
     followers = db.relationship(
         "User",
@@ -140,6 +197,14 @@ class User(db.Model):
 
     last_message_read_time = db.Column(db.DateTime)
 
+    # Bumped on send and reset when the inbox is read, so the badge needs no COUNT
+    unread_message_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     notifications = db.relationship(
         'Notification', 
         backref='user',
@@ -150,27 +215,62 @@ class User(db.Model):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
     def is_followed_by(self, other_user):
-        """Is this user followed by `other_user`?"""
+        """Is this user followed by `other_user` (a user or a user id)?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(getattr(other_user, 'id', other_user), self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_user`?"""
+        """Is this user following `other_user` (a user or a user id)?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, getattr(other_user, 'id', other_user))
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        return self.unread_message_count
+
+    def increment_unread_messages(self):
+        """Count one more unread message, incremented in SQL. Returns the new count."""
+
+        User.query.filter(User.id == self.id).update(
+            {User.unread_message_count: User.unread_message_count + 1}, synchronize_session=False)
+        db.session.expire(self, ['unread_message_count'])
+        return self.unread_message_count
+
+    @classmethod
+    def recount_unread_messages(cls):
+        """Recompute every user's unread count from their messages (e.g. after adding the column)."""
+
+        unread = db.select(db.func.count()).where(
+            Message.recipient_id == cls.id,
+            Message.timestamp > db.func.coalesce(cls.last_message_read_time, datetime(1900, 1, 1))).scalar_subquery()
+        cls.query.update({cls.unread_message_count: unread}, synchronize_session=False)
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
+        """Set this user's `name` notification to `data`, updating the existing row if there is one."""
+
+        n = self.notifications.filter_by(name=name).first()
+        if n is None:
+            n = Notification(name=name, user=self)
+            db.session.add(n)
+
+        n.payload_json = json.dumps(data)
+        n.timestamp = time()
         return n
+
+    def set_instruments(self, instrument_ids):
+        """Make this user's instruments exactly `instrument_ids`. Returns True if anything changed."""
+
+        changed = sync_links(User_Instrument, User_Instrument.instrument_id, self.id, instrument_ids)
+        if changed:
+            db.session.expire(self, ['instruments'])
+        return changed
+
+    def set_genres(self, genre_ids):
+        """Make this user's genres exactly `genre_ids`. Returns True if anything changed."""
+
+        changed = sync_links(User_Genre, User_Genre.genre_id, self.id, genre_ids)
+        if changed:
+            db.session.expire(self, ['genres'])
+        return changed
     
 
     @classmethod
@@ -179,7 +279,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_hasher.hash(password)
 
         user = User(
             username=username,
@@ -203,13 +303,16 @@ class User(db.Model):
         It searches for a user whose password hash matches this password
         and, if it finds such a user, returns that user object.
         If can't find matching user (or if password is wrong), returns False.
+        A password hashed at an outdated cost is rehashed; the caller commits.
         """
 
         user = cls.query.filter_by(username=username).first()
         
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_hasher.check(user.password, password)
             if is_auth:
+                if password_hasher.needs_rehash(user.password):
+                    user.password = password_hasher.hash(password)
                 return user
 
         return False
@@ -316,6 +419,9 @@ class User_Instrument(db.Model):
         else:
             return None
 
+MESSAGE_SEARCH_CONFIG = db.literal_column("'english'::regconfig")
+
+
 class Message(db.Model):
     """Messages"""
 
@@ -353,6 +459,428 @@ class Message(db.Model):
         default=datetime.utcnow
     )
 
+    thread_id = db.Column(
+        db.Integer,
+        db.ForeignKey('threads.id', ondelete="cascade"),
+    )
+
+    thread = db.relationship('Thread', backref=db.backref('messages', lazy='dynamic'))
+
+    @classmethod
+    def matching(cls, text):
+        """Condition for messages whose subject or body contain every word of `text` (Postgres only)."""
+
+        document = db.func.to_tsvector(MESSAGE_SEARCH_CONFIG, cls.subject + db.literal_column("' '") + cls.body)
+        return document.op('@@')(db.func.plainto_tsquery(MESSAGE_SEARCH_CONFIG, text))
+
+
+# Inboxes, sent lists and threads are read newest first, a page at a time (see `messages()` in app.py)
+db.Index('ix_messages_recipient_timestamp_id', Message.recipient_id, Message.timestamp.desc(), Message.id.desc())
+db.Index('ix_messages_sender_timestamp_id', Message.sender_id, Message.timestamp.desc(), Message.id.desc())
+db.Index('ix_messages_thread_timestamp_id', Message.thread_id, Message.timestamp.desc(), Message.id.desc())
+
+# Full-text search; the expression must match `Message.matching` for Postgres to use the index.
+# Other databases can't build it, and search messages with `MessageSearchIndex` instead.
+event.listen(Message.__table__, 'after_create', DDL(
+    "CREATE INDEX ix_messages_search ON messages "
+    "USING gin (to_tsvector('english'::regconfig, subject || ' ' || body))"
+).execute_if(dialect='postgresql'))
+
+
+class Thread(db.Model):
+    """A conversation between two users. Every message between them belongs to it."""
+
+    __tablename__ = 'threads'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=True
+    )
+
+    user_low_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    user_high_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (db.UniqueConstraint('user_low_id', 'user_high_id'),)
+
+    def has_participant(self, user_id):
+        return user_id in (self.user_low_id, self.user_high_id)
+
+    @classmethod
+    def between(cls, user_id, other_user_id):
+        """Return the thread between two users, starting one if they have none."""
+
+        low, high = sorted((user_id, other_user_id))
+        thread = cls.query.filter_by(user_low_id=low, user_high_id=high).first()
+        if thread:
+            return thread
+
+        thread = cls(user_low_id=low, user_high_id=high)
+        try:
+            with db.session.begin_nested():
+                db.session.add(thread)
+        except exc.IntegrityError:
+            # Both users sent a first message at the same moment
+            thread = cls.query.filter_by(user_low_id=low, user_high_id=high).one()
+        return thread
+
+    @classmethod
+    def backfill(cls):
+        """Put messages sent before threads existed into threads, and build their summaries."""
+
+        for message in Message.query.filter(Message.thread_id == None).order_by(Message.timestamp, Message.id):
+            message.thread = cls.between(message.sender_id, message.recipient_id)
+            db.session.flush()
+            ThreadSummary.record_message(message, unread=False)
+
+
+class ThreadSummary(db.Model):
+    """A thread as one user's inbox shows it: the latest message and how many are unread.
+
+    Kept up to date as messages are sent, read and deleted, so listing a
+    user's threads never has to group their messages.
+    """
+
+    __tablename__ = 'thread_summaries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    thread_id = db.Column(
+        db.Integer,
+        db.ForeignKey('threads.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    other_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+    last_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="set null"),
+    )
+
+    last_activity = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    unread_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    other_user = db.relationship('User', foreign_keys=[other_user_id])
+    last_message = db.relationship('Message')
+
+    @classmethod
+    def record_message(cls, message, unread=True):
+        """Move a (flushed) message's thread to the top of both participants' inboxes."""
+
+        # A message to yourself only has the one summary
+        participants = {message.sender_id: (message.recipient_id, 0),
+                        message.recipient_id: (message.sender_id, 1 if unread else 0)}
+
+        for user_id, (other_user_id, unread_count) in participants.items():
+            updated = cls.query.filter_by(user_id=user_id, thread_id=message.thread_id).update({
+                cls.last_message_id: message.id,
+                cls.last_activity: message.timestamp,
+                cls.unread_count: cls.unread_count + unread_count,
+            }, synchronize_session=False)
+
+            if not updated:
+                db.session.add(cls(user_id=user_id, thread_id=message.thread_id, other_user_id=other_user_id,
+                                   last_message_id=message.id, last_activity=message.timestamp,
+                                   unread_count=unread_count))
+
+    @classmethod
+    def refresh_last_message(cls, thread_id):
+        """Point a thread's summaries at its newest message, e.g. after one was deleted."""
+
+        latest = Message.query.filter_by(thread_id=thread_id).order_by(
+            Message.timestamp.desc(), Message.id.desc()).first()
+
+        if latest is None:
+            cls.query.filter_by(thread_id=thread_id).delete(synchronize_session=False)
+        else:
+            cls.query.filter_by(thread_id=thread_id).update({
+                cls.last_message_id: latest.id,
+                cls.last_activity: latest.timestamp,
+            }, synchronize_session=False)
+
+    @classmethod
+    def forget_unread(cls, message):
+        """Take a message about to be deleted out of its recipient's unread counts, if it is unread.
+
+        A thread's unread messages are the newest `unread_count` its reader
+        received, since reading it clears the count. Returns whether it was unread.
+        """
+
+        summary = cls.query.filter_by(user_id=message.recipient_id, thread_id=message.thread_id).first()
+        if summary is None or not summary.unread_count:
+            return False
+
+        newer = Message.query.filter(
+            Message.thread_id == message.thread_id, Message.recipient_id == message.recipient_id,
+            db.tuple_(Message.timestamp, Message.id) > (message.timestamp, message.id)).count()
+        if newer >= summary.unread_count:
+            return False
+
+        cls.query.filter_by(user_id=message.recipient_id, thread_id=message.thread_id).update({
+            cls.unread_count: db.case((cls.unread_count > 0, cls.unread_count - 1), else_=0)
+        }, synchronize_session=False)
+        User.query.filter(User.id == message.recipient_id).update({
+            User.unread_message_count: db.case(
+                (User.unread_message_count > 0, User.unread_message_count - 1), else_=0)
+        }, synchronize_session=False)
+        return True
+
+    @classmethod
+    def mark_read(cls, user_id, thread_id=None):
+        """Clear unread counts for one thread (or all of them) and the user's total to match."""
+
+        summaries = cls.query.filter(cls.user_id == user_id, cls.unread_count > 0)
+        if thread_id is not None:
+            summaries = summaries.filter(cls.thread_id == thread_id)
+
+        cleared = sum(summary.unread_count for summary in summaries)
+        if cleared:
+            summaries.update({cls.unread_count: 0}, synchronize_session=False)
+            User.query.filter(User.id == user_id).update({
+                User.unread_message_count: db.case(
+                    (User.unread_message_count > cleared, User.unread_message_count - cleared), else_=0)
+            }, synchronize_session=False)
+        return cleared
+
+
+# The conversation list is one range scan of this index
+db.Index('ix_thread_summaries_user_activity', ThreadSummary.user_id, ThreadSummary.last_activity.desc(),
+         ThreadSummary.thread_id.desc())
+
+
+class Upload(db.Model):
+    """An uploaded image, stored once under the hash of its content (see uploads.py).
+
+    `ref_count` is how many profile and header images point at it; files
+    nothing points at are deleted by `flask gc-uploads`.
+    """
+
+    __tablename__ = 'uploads'
+
+    filename = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    size = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    ref_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def record(cls, filename, size):
+        """Make sure a stored file has a row."""
+
+        if cls.query.get(filename) is not None:
+            return
+
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(filename=filename, size=size))
+        except exc.IntegrityError:
+            # The same picture was uploaded by someone else at the same moment
+            pass
+
+    @classmethod
+    def replace(cls, old_url, new_url):
+        """Move one reference from the image at `old_url` to the one at `new_url`."""
+
+        if old_url == new_url:
+            return
+
+        for url, change in ((old_url, -1), (new_url, 1)):
+            filename = filename_from_url(url)
+            if filename:
+                cls.query.filter(cls.filename == filename).update(
+                    {cls.ref_count: cls.ref_count + change}, synchronize_session=False)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every upload's reference count from the users table."""
+
+        url = UPLOADS_URL + cls.filename
+        uses = (db.select(db.func.count()).where(User.profile_image == url).scalar_subquery()
+                + db.select(db.func.count()).where(User.header_image == url).scalar_subquery())
+        cls.query.update({cls.ref_count: uses}, synchronize_session=False)
+
+
+class SavedSearch(db.Model):
+    """A radius search a user saved, to hear about profiles that start matching it.
+
+    Changed profiles are matched against saved searches as they're saved
+    (see saved_searches.py), and each new match is added to the owner's
+    `saved_search:<id>` notification.
+    """
+
+    __tablename__ = 'saved_searches'
+
+    # New matches kept in a saved search's notification; older ones drop off
+    MAX_NEW_MATCHES = 50
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+        index=True,
+    )
+
+    zip_code = db.Column(
+        db.String,
+        nullable=False,
+    )
+
+    radius = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    is_band = db.Column(
+        db.Boolean,
+        nullable=False,
+    )
+
+    match_all_instruments = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    # Instrument and genre names, as JSON lists
+    instruments_json = db.Column(
+        db.Text,
+        nullable=False,
+        default='[]',
+    )
+
+    genres_json = db.Column(
+        db.Text,
+        nullable=False,
+        default='[]',
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    user = db.relationship('User')
+
+    @property
+    def instruments(self):
+        return json.loads(self.instruments_json)
+
+    @property
+    def genres(self):
+        return json.loads(self.genres_json)
+
+    @property
+    def notification_name(self):
+        return f'saved_search:{self.id}'
+
+    @classmethod
+    def from_search(cls, user_id, search):
+        """Find or make `user_id`'s saved search with the parameters of a `save_search` search."""
+
+        values = dict(
+            user_id=user_id,
+            zip_code=search['zip_code'],
+            radius=search['radius'],
+            is_band=search['is_band'],
+            match_all_instruments=bool(search['match_all_instruments']),
+            instruments_json=json.dumps(sorted(search['instruments'])),
+            genres_json=json.dumps(sorted(search['genres'])),
+        )
+
+        saved = cls.query.filter_by(**values).first()
+        if saved is None:
+            saved = cls(**values)
+            db.session.add(saved)
+        return saved
+
+    def search_params(self):
+        """The parameters to run this search again with `save_search`."""
+
+        return dict(
+            zip_code=self.zip_code,
+            radius=self.radius,
+            is_band=self.is_band,
+            instruments=self.instruments,
+            genres=self.genres,
+            match_all_instruments=self.match_all_instruments,
+            keywords=None,
+        )
+
+    def new_matches(self):
+        """Ids of the users that started matching since the owner last looked."""
+
+        notification = Notification.query.filter_by(user_id=self.user_id, name=self.notification_name).first()
+        return notification.get_data()['user_ids'] if notification else []
+
+    def add_match(self, user_id):
+        """Add `user_id` to the owner's new matches. Returns the notification, or None if already there."""
+
+        matches = self.new_matches()
+        if user_id in matches:
+            return None
+
+        matches = (matches + [user_id])[-self.MAX_NEW_MATCHES:]
+        return self.user.add_notification(self.notification_name, {'search_id': self.id, 'user_ids': matches})
+
+    def clear_matches(self):
+        Notification.query.filter_by(user_id=self.user_id, name=self.notification_name).delete(synchronize_session=False)
+
 
 class Notification(db.Model):
     """Notifications."""
@@ -369,6 +897,24 @@ class Notification(db.Model):
         return json.loads(str(self.payload_json))
 
 
+def sync_links(model, column, user_id, ids):
+    """Add and delete `model` rows so `user_id` is linked to exactly `ids`.
+
+    Only the difference is written, one bulk statement each way, so rows that
+    stay are left alone. Returns True if anything changed.
+    """
+
+    current = {id for id, in db.session.query(column).filter(model.user_id == user_id)}
+    wanted = set(ids)
+    removed, added = current - wanted, wanted - current
+
+    if removed:
+        model.query.filter(model.user_id == user_id, column.in_(removed)).delete(synchronize_session=False)
+    if added:
+        db.session.bulk_insert_mappings(model, [{'user_id': user_id, column.key: id} for id in sorted(added)])
+    return bool(removed or added)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app"""
 
@@ -0,0 +1,55 @@
+"""Opaque cursors for keyset (seek) pagination.
+
+A cursor holds the sort key of the last row on a page. The next page asks the
+database for rows that sort after it, so page 500 costs the same as page 1.
+"""
+
+import json
+import math
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+
+def encode_cursor(*values):
+    """Encode a sort key as a URL-safe token."""
+
+    return urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, *types, max_id=None):
+    """Decode a token made by `encode_cursor`, checking each value against `types`.
+
+    e.g. `decode_cursor(token, float, int)`. Ints are row ids, so negative ones
+    (and ones over `max_id`, if given) are refused, as are infinite or NaN
+    floats. Returns None for a missing or malformed token, so a bad link just
+    starts from the first page.
+    """
+
+    if not token:
+        return None
+
+    try:
+        values = json.loads(urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except ValueError:
+        return None
+
+    if not isinstance(values, list) or len(values) != len(types):
+        return None
+
+    for value, value_type in zip(values, types):
+        if value_type is float and isinstance(value, int) and not isinstance(value, bool):
+            continue
+        if not isinstance(value, value_type) or isinstance(value, bool):
+            return None
+        if value_type is float and not math.isfinite(value):
+            return None
+        if value_type is int and (value < 0 or (max_id is not None and value > max_id)):
+            return None
+    return values
+
+
+def get_page_size(requested, default, maximum):
+    """Clamp a requested page size (e.g. from `?per_page=`) to 1..maximum."""
+
+    if not requested or requested < 1:
+        return default
+    return min(requested, maximum)
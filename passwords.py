@@ -0,0 +1,143 @@
+"""Password hashing on a small, bounded pool of threads.
+
+bcrypt is slow on purpose, and a request thread hashing a password can't
+serve anything else meanwhile. Hashes run on a few pool threads instead, and
+once those and a short queue are busy, further sign-ins get a 503 rather than
+tying up every request thread of the worker.
+
+The bcrypt cost is picked at startup as the highest that still hashes within
+`PASSWORD_HASH_TARGET_SECONDS` on this machine (unless `BCRYPT_LOG_ROUNDS`
+pins it), never below `PASSWORD_HASH_MIN_ROUNDS`. A password stored at a
+lower cost is rehashed the next time its owner logs in; hashes are never
+rehashed down, so a slow boot can't weaken them.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+import bcrypt
+from werkzeug.exceptions import ServiceUnavailable
+
+# Never calibrate below the cost Flask-Bcrypt used before, nor to something unusably slow
+MIN_ROUNDS = 12
+MAX_ROUNDS = 16
+TARGET_SECONDS = 0.25
+
+HASH_WORKERS = 2
+HASH_QUEUE = 16
+
+# bcrypt only looks at the first 72 bytes; older versions cut longer passwords off silently, newer ones refuse them
+MAX_PASSWORD_BYTES = 72
+
+
+def calibrate_rounds(target_seconds, min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS):
+    """The highest cost whose hash takes no longer than `target_seconds`, within the bounds."""
+
+    start = time.perf_counter()
+    bcrypt.hashpw(b'calibration', bcrypt.gensalt(min_rounds))
+    elapsed = time.perf_counter() - start
+
+    # Each extra round doubles the work
+    rounds = min_rounds
+    while rounds < max_rounds and elapsed * 2 <= target_seconds:
+        rounds += 1
+        elapsed *= 2
+    return rounds
+
+
+def hash_rounds(hashed):
+    """The cost a bcrypt hash (`$2b$12$...`) was made with."""
+
+    return int(hashed.split('$')[2])
+
+
+def encode_password(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded thread pool."""
+
+    def __init__(self):
+        self.configure()
+        self._executor = None
+        self._lock = Lock()
+
+    def configure(self, max_workers=HASH_WORKERS, max_waiting=HASH_QUEUE, rounds=None, target_seconds=TARGET_SECONDS,
+                  min_rounds=MIN_ROUNDS):
+        """Set the pool size and cost; with no `rounds`, the cost is calibrated on first use, from `min_rounds` up."""
+
+        self.max_workers = max_workers
+        self.target_seconds = target_seconds
+        self.min_rounds = min_rounds
+        self._rounds = rounds
+        self._slots = BoundedSemaphore(max_workers + max_waiting)
+
+    def init_app(self, app):
+        self.configure(
+            max_workers=app.config.get('PASSWORD_HASH_WORKERS', HASH_WORKERS),
+            max_waiting=app.config.get('PASSWORD_HASH_QUEUE', HASH_QUEUE),
+            rounds=app.config.get('BCRYPT_LOG_ROUNDS'),
+            target_seconds=app.config.get('PASSWORD_HASH_TARGET_SECONDS', TARGET_SECONDS),
+            min_rounds=app.config.get('PASSWORD_HASH_MIN_ROUNDS', MIN_ROUNDS))
+
+    @property
+    def rounds(self):
+        if self._rounds is None:
+            self.calibrate()
+        return self._rounds
+
+    @rounds.setter
+    def rounds(self, rounds):
+        self._rounds = rounds
+
+    def calibrate(self):
+        """Pick the cost for this machine; run before forking workers so they share the result."""
+
+        with self._lock:
+            if self._rounds is None:
+                self._rounds = calibrate_rounds(self.target_seconds, min_rounds=self.min_rounds,
+                                                max_rounds=max(self.min_rounds, MAX_ROUNDS))
+        return self._rounds
+
+    def hash(self, password):
+        """Hash `password` at the configured cost. Returns the hash as a string."""
+
+        return self._run(self._hash, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self._run(self._check, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a lower cost than the configured one?"""
+
+        return hash_rounds(hashed) < self.rounds
+
+    def _hash(self, password, rounds):
+        return bcrypt.hashpw(encode_password(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+    def _check(self, hashed, password):
+        try:
+            return bcrypt.checkpw(encode_password(password), hashed.encode('utf-8'))
+        except ValueError:
+            # Not a bcrypt hash
+            return False
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable('Too many people are signing in right now. Please try again in a moment.',
+                                     retry_after=1)
+
+        try:
+            with self._lock:
+                # Created on first use, so no threads exist yet if gunicorn forks after importing us
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='passwords')
+            return self._executor.submit(fn, *args).result()
+        finally:
+            self._slots.release()
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,124 @@
+"""Publish/subscribe for pushing notifications to open browser tabs.
+
+Subscribers wait on an in-memory queue per channel. With an `EventLog`
+behind the broker, published messages go through that log instead, and one
+background thread per worker tails it and hands new messages to that worker's
+subscribers, so a message sent from any worker reaches every open stream. The
+thread only runs while this worker has subscribers.
+"""
+
+import queue
+import threading
+import time
+
+POLL_SECONDS = 0.25
+MAX_QUEUED_MESSAGES = 100
+
+
+class Subscription:
+    """A subscriber's queue of messages for one channel."""
+
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=MAX_QUEUED_MESSAGES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # A stalled reader shouldn't hold up everyone else's delivery
+            pass
+
+    def get(self, timeout=None):
+        """Return the next message, or None if none arrives within `timeout` seconds."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Deliver messages published to a channel to everyone subscribed to it."""
+
+    def __init__(self, events=None, topic='broker', poll_interval=POLL_SECONDS):
+        """`events` is an `EventLog` shared by the workers; None keeps delivery in-process."""
+
+        self.events = events
+        self.topic = topic
+        self.poll_interval = poll_interval
+        self.subscriptions = {}
+        self._lock = threading.Lock()
+        self._tail = None
+        self._last_seq = 0
+
+    def publish(self, channel, message):
+        """Send a JSON friendly `message` to the subscribers of `channel`."""
+
+        if self.events is None:
+            self._deliver(channel, message)
+        else:
+            self.events.append(self.topic, {'channel': channel, 'message': message})
+
+    def subscribe(self, channel):
+        """Start receiving messages published to `channel` from now on."""
+
+        subscription = Subscription(self, channel)
+
+        with self._lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+
+            if self.events is not None and (self._tail is None or not self._tail.is_alive()):
+                self._last_seq = self.events.last_seq()
+                self._tail = threading.Thread(target=self._follow, name=f'{self.topic}-tail', daemon=True)
+                self._tail.start()
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self.subscriptions.get(subscription.channel)
+            if subscriptions is None:
+                return
+
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.channel]
+
+    def _deliver(self, channel, message):
+        with self._lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def _follow(self):
+        """Tail the event log until this worker has no subscribers left."""
+
+        while True:
+            with self._lock:
+                if not self.subscriptions:
+                    self._tail = None
+                    return
+
+            changes = self.events.read_since(self.topic, self._last_seq)
+            if changes is None:
+                # Fell behind the log's retention; only new messages matter to live streams
+                self._last_seq = self.events.last_seq()
+                continue
+
+            for seq, event in changes:
+                self._deliver(event['channel'], event['message'])
+                self._last_seq = seq
+
+            if not changes:
+                time.sleep(self.poll_interval)
@@ -0,0 +1,207 @@
+"""Sliding-window rate limits for logins and messages.
+
+Each key (login attempts from one IP address, messages from one user, ...)
+keeps just two counts: hits in the current fixed window and in the one before
+it. The rate over the last window's length is estimated by counting the
+previous window in proportion to how much of it still overlaps, which
+smooths out the burst a plain fixed window allows at its boundary while
+taking constant space per key.
+
+Counters are kept in process memory by default, so each gunicorn worker
+enforces the limits separately. `SharedCounters` keeps them in the SQLite
+file the workers already share (see cache.py) so they hold for the host.
+"""
+
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from cache import SQLiteFile, SHARED_CACHE_PATH
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 60 * 60, 'day': 24 * 60 * 60}
+LIMIT = re.compile(r'^\s*(\d+)\s*/\s*(\d+)?\s*(second|minute|hour|day)s?\s*$')
+
+# The least recently used keys are dropped past this many, so spraying addresses can't grow memory without bound
+MAX_KEYS = 100000
+PURGE_EVERY_HITS = 1000
+
+
+class Limit(namedtuple('Limit', 'count seconds')):
+    """At most `count` hits per `seconds`."""
+
+    @classmethod
+    def parse(cls, text):
+        """Read a limit like '5/minute' or '100/6 hours'."""
+
+        match = LIMIT.match(text)
+        if not match:
+            raise ValueError(f'Not a rate limit: {text!r}')
+        count, periods, period = match.groups()
+        count, periods = int(count), int(periods or 1)
+        if count < 1 or periods < 1:
+            raise ValueError(f'A rate limit must allow at least one hit per period: {text!r}')
+        return cls(count, periods * PERIODS[period])
+
+
+def window_counts(entry, limit, now):
+    """(window, elapsed, previous, current) for a key at `now`, given its stored (window, previous, current).
+
+    `window` numbers the current window and `elapsed` is how far into it we are.
+    """
+
+    window, elapsed = divmod(now, limit.seconds)
+    window = int(window)
+
+    if entry is None:
+        return window, elapsed, 0, 0
+    stored_window, previous, current = entry
+    if stored_window == window:
+        return window, elapsed, previous, current
+    if stored_window == window - 1:
+        return window, elapsed, current, 0
+    return window, elapsed, 0, 0
+
+
+def wait_seconds(limit, previous, current, elapsed):
+    """Seconds until one more hit fits under `limit`, or 0 if it fits now.
+
+    `elapsed` is how far into the current window we are.
+    """
+
+    remaining = limit.seconds - elapsed
+    if previous * remaining / limit.seconds + current + 1 <= limit.count:
+        return 0
+
+    if current + 1 <= limit.count:
+        # Wait for enough of the previous window to slide out
+        wait = remaining - (limit.count - current - 1) * limit.seconds / previous
+    else:
+        # Wait into the next window, until enough of this one has slid out
+        wait = remaining + limit.seconds * (1 - (limit.count - 1) / current)
+    return max(1, math.ceil(wait))
+
+
+class MemoryCounters:
+    """Rate counters in this process's memory."""
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit(self, limits, now=None):
+        """Count a hit on every key if all their limits allow it.
+
+        `limits` is a list of (key, Limit) pairs. Returns 0 if the hit was
+        counted, else the seconds until it would be.
+        """
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            counts = [(key, limit) + window_counts(self._entries.get(key), limit, now) for key, limit in limits]
+            wait = max([wait_seconds(limit, previous, current, elapsed)
+                        for key, limit, window, elapsed, previous, current in counts], default=0)
+
+            for key, limit, window, elapsed, previous, current in counts:
+                self._entries[key] = (window, previous, current if wait else current + 1)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+        return wait
+
+    def reset(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedCounters(SQLiteFile):
+    """Rate counters in a SQLite file, shared by every process on the host."""
+
+    SCHEMA = ("""CREATE TABLE IF NOT EXISTS rate_limits (
+                     key TEXT PRIMARY KEY,
+                     window INTEGER NOT NULL,
+                     previous INTEGER NOT NULL,
+                     current INTEGER NOT NULL,
+                     expires_at REAL NOT NULL)""",)
+
+    def __init__(self, path=SHARED_CACHE_PATH):
+        super().__init__(path)
+        self._hits = 0
+
+    def hit(self, limits, now=None):
+        """Count a hit on every key if all their limits allow it.
+
+        `limits` is a list of (key, Limit) pairs. Returns 0 if the hit was
+        counted, else the seconds until it would be.
+        """
+
+        now = time.time() if now is None else now
+
+        conn = self._connection()
+        # Take the write lock before reading, so two workers can't both let the last allowed hit through
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = []
+            for key, limit in limits:
+                entry = conn.execute('SELECT window, previous, current FROM rate_limits WHERE key = ?', (key,)).fetchone()
+                counts.append((key, limit) + window_counts(entry, limit, now))
+            wait = max([wait_seconds(limit, previous, current, elapsed)
+                        for key, limit, window, elapsed, previous, current in counts], default=0)
+
+            if not wait:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO rate_limits (key, window, previous, current, expires_at) VALUES (?, ?, ?, ?, ?)',
+                    [(key, window, previous, current + 1, (window + 2) * limit.seconds)
+                     for key, limit, window, elapsed, previous, current in counts])
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        self._hits += 1
+        if self._hits % PURGE_EVERY_HITS == 0:
+            self.purge_expired()
+        return wait
+
+    def purge_expired(self):
+        self._connection().execute('DELETE FROM rate_limits WHERE expires_at <= ?', (time.time(),))
+
+    def reset(self):
+        self._connection().execute('DELETE FROM rate_limits')
+
+
+class RateLimiter:
+    """Per-route limits, each counted separately for every scope (`ip`, `user`, ...) it names.
+
+    `limits` maps a route name to the limits of its scopes, e.g.
+    `{'login': {'ip': '20/minute', 'user': '5/minute'}}`.
+    """
+
+    def __init__(self, limits=None, counters=None):
+        self.counters = counters if counters is not None else MemoryCounters()
+        self.configure(limits or {})
+
+    def configure(self, limits):
+        self.limits = {route: {scope: Limit.parse(limit) for scope, limit in scopes.items()}
+                       for route, scopes in limits.items()}
+
+    def hit(self, route, **identities):
+        """Count a hit on `route` by each of the `identities`, e.g. `ip='203.0.113.9', user=42`.
+
+        The hit is only counted if every limit allows it. Returns 0 if it
+        did, else the seconds until it would. Scopes without a limit, or a
+        None identity, are skipped.
+        """
+
+        limits = self.limits.get(route, {})
+        checks = [(f'{route}:{scope}:{identity}', limits[scope])
+                  for scope, identity in identities.items() if scope in limits and identity is not None]
+        return self.counters.hit(checks) if checks else 0
+
+    def reset(self):
+        self.counters.reset()
@@ -0,0 +1,147 @@
+"""Matching changed profiles against saved searches, percolator style.
+
+Running every saved search again whenever a profile changes would cost one
+search per saved search. Instead each worker keeps the saved searches
+themselves indexed by every zip code within their radius, so a changed
+profile only has to be checked against the few searches covering its zip
+code, and then just on profile type, instruments and genres.
+
+Saved searches added or deleted by any worker reach the others through the
+`EventLog`, the same way changes to the user `SearchIndex` do.
+"""
+
+import requests
+from models import SavedSearch, User
+from synced_index import EventSyncedIndex, watch_changes
+from vocabulary import get_vocabularies
+from zip_radius import normalize_zip
+
+SAVED_SEARCH_CHANGES_TOPIC = 'saved_searches'
+
+
+class SavedSearchIndex(EventSyncedIndex):
+    """Saved searches by the zip codes they cover.
+
+    `zips_in_radius(zip_code, radius)` lists the (zip_code, distance) pairs a
+    search covers, like `find_zip_codes_in_radius`.
+    """
+
+    TOPIC = SAVED_SEARCH_CHANGES_TOPIC
+
+    def __init__(self, zips_in_radius, events=None):
+        super().__init__(events)
+        self.zips_in_radius = zips_in_radius
+        self.by_zip = {}
+        self.searches = {}
+
+    def __len__(self):
+        return len(self.searches)
+
+    def add_search(self, search_id, user_id, zip_code, radius, is_band, instrument_ids=(), genre_ids=(),
+                   match_all_instruments=False):
+        """Index a saved search, replacing whatever was indexed for it before.
+
+        Searches whose zip codes can't be looked up right now are left out.
+        The lookup may call the radius API, so it's done before the index is locked.
+        """
+
+        zips = self.zips_covered(zip_code, radius)
+        self._add_search(search_id, user_id, zips, is_band, instrument_ids, genre_ids, match_all_instruments)
+
+    def zips_covered(self, zip_code, radius):
+        """The zip codes a search within `radius` of `zip_code` covers, or None if they can't be looked up."""
+
+        try:
+            zips = self.zips_in_radius(zip_code, radius)
+        except (KeyError, requests.RequestException):
+            return None
+        return frozenset(zip_code for zip_code, distance in zips) if zips else None
+
+    def _add_search(self, search_id, user_id, zips, is_band, instrument_ids, genre_ids, match_all_instruments):
+        with self._lock:
+            self.remove_search(search_id)
+            if not zips:
+                return
+
+            for zip_code in zips:
+                self.by_zip.setdefault(zip_code, set()).add(search_id)
+            self.searches[search_id] = (user_id, zips, bool(is_band), frozenset(instrument_ids),
+                                        frozenset(genre_ids), bool(match_all_instruments))
+
+    def remove_search(self, search_id):
+        with self._lock:
+            entry = self.searches.pop(search_id, None)
+            if entry is None:
+                return
+
+            for zip_code in entry[1]:
+                self.by_zip[zip_code].discard(search_id)
+                if not self.by_zip[zip_code]:
+                    del self.by_zip[zip_code]
+
+    def percolate(self, user_id, zip_code, is_band, instrument_ids=(), genre_ids=()):
+        """Return the ids of other users' saved searches that a profile with these fields matches.
+
+        Matches the way `SearchIndex.match` does: any of a search's
+        instruments (all of them with `match_all_instruments`), any of its
+        genres, and empty filters match everyone.
+        """
+
+        if not zip_code:
+            return set()
+
+        instrument_ids = frozenset(instrument_ids)
+        genre_ids = frozenset(genre_ids)
+
+        with self._lock:
+            matches = set()
+            for search_id in self.by_zip.get(normalize_zip(zip_code), ()):
+                owner_id, zips, search_is_band, search_instruments, search_genres, match_all = self.searches[search_id]
+
+                if owner_id == user_id or search_is_band != bool(is_band):
+                    continue
+                if search_instruments:
+                    if match_all and not search_instruments <= instrument_ids:
+                        continue
+                    if not match_all and not search_instruments & instrument_ids:
+                        continue
+                if search_genres and not search_genres & genre_ids:
+                    continue
+                matches.add(search_id)
+            return matches
+
+    def _clear(self):
+        self.by_zip, self.searches = {}, {}
+
+    def _forget(self, search_id):
+        self.remove_search(search_id)
+
+    def _fetch(self, search_ids):
+        searches = SavedSearch.query
+        if search_ids is not None:
+            searches = searches.filter(SavedSearch.id.in_(search_ids))
+
+        vocabularies = get_vocabularies()
+        return [(search.id, search.user_id, self.zips_covered(search.zip_code, search.radius), search.is_band,
+                 vocabularies.instruments.ids(search.instruments), vocabularies.genres.ids(search.genres),
+                 search.match_all_instruments)
+                for search in searches]
+
+    def _load(self, searches):
+        for search in searches:
+            self._add_search(*search)
+
+
+def watch_saved_search_changes(events):
+    """Append the ids of saved searches added or deleted to `events` on commit."""
+
+    def collect_changed_searches(session):
+        changed = {obj.id for obj in list(session.new) + list(session.deleted) if isinstance(obj, SavedSearch)}
+        if any(isinstance(obj, User) for obj in session.deleted):
+            # The database deletes their saved searches without the session seeing them
+            changed.add(None)
+        return changed
+
+    # Deleting users takes their saved searches with them
+    watch_changes(events, SAVED_SEARCH_CHANGES_TOPIC, SavedSearch, 'changed_saved_search_ids',
+                  collect=collect_changed_searches, bulk_deletes=(User,))
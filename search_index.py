@@ -0,0 +1,417 @@
+"""In-memory bitmap index for instrument / genre / zip code / profile type search.
+
+Each instrument, genre and profile type maps to a bitset of user ids, stored
+as a Python int with bit `user_id` set. Narrowing a search is then a handful
+of ANDs and ORs over those ints instead of EXISTS subqueries and a long
+`zip_code IN (...)`.
+
+A bitset is as long as the highest user id in it, so zip codes and words, of
+which there are many each holding a few users, keep sets of user ids
+instead, turned into bitsets only for the zip codes or words a search asks for.
+
+The zip codes users live in are also kept in a `ZipGrid`, so a search can walk
+outward from the origin until it has enough matches instead of fixing a radius.
+
+Facet counts for an area (users per instrument, per genre and per profile
+type) are a popcount of each facet's bitset ANDed with the area's, and are
+cached per (zip code, radius) until the index next changes.
+
+Words from each user's username, city and bio are indexed too, one set of
+user ids per word, with per-user word counts kept for ranking keyword searches
+by BM25.
+
+Every worker keeps its own copy. Committed changes to users and their
+instruments or genres are appended to the shared `EventLog`, and each worker
+replays them (reloading just those users) before it answers a search.
+"""
+
+import heapq
+import sys
+from collections import Counter
+from itertools import groupby
+from sqlalchemy import inspect
+from cache import LRUCache
+from models import db, User, User_Instrument, User_Genre
+from synced_index import EventSyncedIndex, changed_ids, watch_changes
+from text_index import bm25, tokenize
+from zip_radius import ZipGrid, normalize_zip
+
+USER_CHANGES_TOPIC = 'users'
+
+# Changes to any other User column don't affect search results
+INDEXED_USER_FIELDS = ('zip_code', 'is_band', 'instruments', 'genres', 'username', 'city', 'bio')
+
+# Areas whose facet counts are kept; the cache is emptied whenever a user is indexed
+FACET_CACHE_ENTRIES = 256
+FACET_CACHE_TTL = 60 * 60
+
+
+def profile_text(username, city, bio):
+    """The text of a profile that keyword searches match against."""
+
+    return ' '.join(filter(None, (username, city, bio)))
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(bits):
+        """Number of users in a bitset."""
+
+        return bits.bit_count()
+else:
+    # int.bit_count is new in Python 3.10
+    def popcount(bits):
+        """Number of users in a bitset."""
+
+        return bin(bits).count('1')
+
+
+def to_bits(ids):
+    """The bitset of `ids`, set in a byte buffer in one pass rather than copying the int per id."""
+
+    ids = list(ids)
+    if not ids:
+        return 0
+
+    buffer = bytearray(max(ids) // 8 + 1)
+    for id in ids:
+        buffer[id >> 3] |= 1 << (id & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_ids(bits):
+    """Yield the user ids in a bitset in ascending order.
+
+    Walks it 64 bits at a time, taking the lowest set bit of each word, so
+    the cost is the bitset's length plus the ids found.
+    """
+
+    size = (bits.bit_length() + 63) // 64 * 8
+    for index, word in enumerate(memoryview(bits.to_bytes(size, sys.byteorder)).cast('Q')):
+        while word:
+            lowest = word & -word
+            yield index * 64 + lowest.bit_length() - 1
+            word ^= lowest
+
+
+class SearchIndex(EventSyncedIndex):
+    """Bitsets of user ids per instrument, genre and profile type, and sets of them per zip code and word."""
+
+    TOPIC = USER_CHANGES_TOPIC
+
+    def __init__(self, events=None, engine=None):
+        super().__init__(events)
+        self.instruments = {}
+        self.genres = {}
+        self.zips = {}
+        self.zip_grid = ZipGrid(engine)
+        self.words = {}
+        self.word_count = 0
+        self.bands = 0
+        self.everyone = 0
+        self.users = {}
+        self.facet_cache = LRUCache(max_entries=FACET_CACHE_ENTRIES, ttl=FACET_CACHE_TTL)
+
+    def __len__(self):
+        return len(self.users)
+
+    def max_user_id(self):
+        """The highest indexed user id, or -1 when nobody is indexed."""
+
+        return self.everyone.bit_length() - 1
+
+    def add_user(self, user_id, zip_code, is_band, instrument_ids=(), genre_ids=(), text=''):
+        """Index a user, replacing whatever was indexed for them before.
+
+        `text` is their profile text (see `profile_text`) for keyword searches.
+        """
+
+        self.add_users([(user_id, zip_code, is_band, instrument_ids, genre_ids, text)])
+
+    def add_users(self, users):
+        """Index one (user_id, zip_code, is_band, instrument_ids, genre_ids, text) row per user, like `add_user`.
+
+        Each bitset is ORed with the whole batch at once instead of being
+        copied for every user, so loading everyone stays linear.
+        """
+
+        with self._lock:
+            self.facet_cache.clear()
+            everyone, bands, instruments, genres = [], [], {}, {}
+
+            for user_id, zip_code, is_band, instrument_ids, genre_ids, text in users:
+                self.remove_user(user_id)
+
+                zip_code = normalize_zip(zip_code) if zip_code else None
+                instrument_ids = frozenset(instrument_ids)
+                genre_ids = frozenset(genre_ids)
+                words = Counter(tokenize(text))
+
+                everyone.append(user_id)
+                if is_band:
+                    bands.append(user_id)
+                if zip_code:
+                    if zip_code not in self.zips:
+                        self.zips[zip_code] = set()
+                        self.zip_grid.add(zip_code)
+                    self.zips[zip_code].add(user_id)
+                for instrument_id in instrument_ids:
+                    instruments.setdefault(instrument_id, []).append(user_id)
+                for genre_id in genre_ids:
+                    genres.setdefault(genre_id, []).append(user_id)
+                for word in words:
+                    self.words.setdefault(word, set()).add(user_id)
+                self.word_count += sum(words.values())
+
+                self.users[user_id] = (zip_code, bool(is_band), instrument_ids, genre_ids, words)
+
+            self.everyone |= to_bits(everyone)
+            self.bands |= to_bits(bands)
+            for instrument_id, ids in instruments.items():
+                self.instruments[instrument_id] = self.instruments.get(instrument_id, 0) | to_bits(ids)
+            for genre_id, ids in genres.items():
+                self.genres[genre_id] = self.genres.get(genre_id, 0) | to_bits(ids)
+
+    def remove_user(self, user_id):
+        """Clear a user's bits from every bitset and their id from every set."""
+
+        with self._lock:
+            entry = self.users.pop(user_id, None)
+            if entry is None:
+                return
+
+            self.facet_cache.clear()
+            zip_code, is_band, instrument_ids, genre_ids, words = entry
+            mask = ~(1 << user_id)
+
+            self.everyone &= mask
+            self.bands &= mask
+            if zip_code:
+                self.zips[zip_code].discard(user_id)
+                if not self.zips[zip_code]:
+                    del self.zips[zip_code]
+                    self.zip_grid.discard(zip_code)
+            for instrument_id in instrument_ids:
+                self.instruments[instrument_id] &= mask
+            for genre_id in genre_ids:
+                self.genres[genre_id] &= mask
+            for word in words:
+                self.words[word].discard(user_id)
+                if not self.words[word]:
+                    del self.words[word]
+            self.word_count -= sum(words.values())
+
+    def match(self, instrument_ids=(), genre_ids=(), is_band=None, match_all_instruments=False):
+        """Return the bitset of users matching the given filters, anywhere.
+
+        Users match if they play any of `instrument_ids` (all of them with
+        `match_all_instruments`) and any of `genre_ids`. Empty filters match
+        everyone; `is_band=None` matches both bands and musicians.
+        """
+
+        bits = self.everyone
+
+        if is_band is not None:
+            bits &= self.bands if is_band else ~self.bands
+
+        if instrument_ids:
+            combined = self.everyone if match_all_instruments else 0
+            for instrument_id in instrument_ids:
+                if match_all_instruments:
+                    combined &= self.instruments.get(instrument_id, 0)
+                else:
+                    combined |= self.instruments.get(instrument_id, 0)
+            bits &= combined
+
+        if genre_ids:
+            combined = 0
+            for genre_id in genre_ids:
+                combined |= self.genres.get(genre_id, 0)
+            bits &= combined
+
+        return bits
+
+    def in_zips(self, zip_codes):
+        """Return the bitset of users living in any of `zip_codes`."""
+
+        return to_bits(self._ids_in_zips(zip_codes))
+
+    def _ids_in_zips(self, zip_codes):
+        ids = set()
+        for zip_code in zip_codes:
+            ids.update(self.zips.get(zip_code, ()))
+        return ids
+
+    def facet_counts(self, bits):
+        """Count the users in `bits` per instrument id, per genre id, and as bands or musicians.
+
+        Facets nobody in `bits` has are left out.
+        """
+
+        with self._lock:
+            instruments = {id: popcount(bits & facet) for id, facet in self.instruments.items()}
+            genres = {id: popcount(bits & facet) for id, facet in self.genres.items()}
+            bands = popcount(bits & self.bands)
+
+            return {
+                'instruments': {id: count for id, count in instruments.items() if count},
+                'genres': {id: count for id, count in genres.items() if count},
+                'bands': bands,
+                'musicians': popcount(bits) - bands,
+            }
+
+    def area_facet_counts(self, zip_code, radius, zips):
+        """`facet_counts` for everyone living in `zips`, the zip codes within `radius` of `zip_code`.
+
+        Cached per (zip code, radius), so paging through or refining a search
+        of the same area counts once.
+        """
+
+        key = (normalize_zip(zip_code), radius)
+
+        with self._lock:
+            counts = self.facet_cache.get(key)
+            if counts is None:
+                counts = self.facet_counts(self.in_zips(zip for zip, distance in zips))
+                self.facet_cache.set(key, counts)
+            return counts
+
+    def nearby_zips(self, zip_code):
+        """Yield (zip_code, distance) for every zip code a user lives in, nearest first.
+
+        Lazy, so passing it to `nearest_first` only searches as far out as it
+        takes to fill the page.
+        """
+
+        return self.zip_grid.nearest(zip_code)
+
+    def nearest_first(self, zips, bits, after=None, limit=None):
+        """List (user_id, distance) for users in `bits`, ordered by distance then id.
+
+        `zips` is an iterable of (zip_code, distance) pairs sorted by distance,
+        as returned by the radius engine or `nearby_zips`. `after` is a
+        (distance, user_id) cursor; only users that sort after it are returned.
+        Stops after `limit` users, so the cost depends on the page size rather
+        than the number of matches.
+        """
+
+        results = []
+
+        with self._lock:
+            for distance, group in groupby(zips, key=lambda pair: pair[1]):
+                if after and distance < after[0]:
+                    continue
+
+                for user_id in sorted(self._ids_in_zips(zip_code for zip_code, _ in group)):
+                    if after and distance == after[0] and user_id <= after[1]:
+                        continue
+                    if not bits >> user_id & 1:
+                        continue
+                    results.append((user_id, distance))
+                    if limit and len(results) >= limit:
+                        return results
+
+        return results
+
+    def ranked(self, keywords, bits, after=None, limit=None):
+        """List (user_id, score) for users in `bits` matching any word of `keywords`, best first.
+
+        Scores are BM25 over profile text, rounded so they survive a round trip
+        through a page cursor; ties go to the lower id. `after` is a
+        (score, user_id) cursor; only users ranked below it are returned.
+        """
+
+        terms = set(tokenize(keywords))
+
+        with self._lock:
+            users = len(self.users)
+            if not terms or not users:
+                return []
+
+            candidates = set()
+            document_frequency = {}
+            for term in terms:
+                user_ids = self.words.get(term, ())
+                candidates.update(user_ids)
+                document_frequency[term] = len(user_ids)
+            candidates = to_bits(candidates) & bits
+
+            average_length = max(self.word_count / users, 1)
+            keys = []
+            for user_id in iter_ids(candidates):
+                entry = self.users.get(user_id)
+                if entry is None:
+                    continue
+                words = entry[4]
+                length = sum(words.values())
+                score = round(sum(bm25(words[term], length, document_frequency[term], users, average_length)
+                                  for term in terms if term in words), 4)
+                key = (-score, user_id)
+                if after is None or key > (-after[0], after[1]):
+                    keys.append(key)
+
+        keys = heapq.nsmallest(limit, keys) if limit else sorted(keys)
+        return [(user_id, -score) for score, user_id in keys]
+
+    def _clear(self):
+        self.instruments, self.genres, self.zips = {}, {}, {}
+        self.zip_grid.clear()
+        self.words, self.word_count = {}, 0
+        self.bands = self.everyone = 0
+        self.users = {}
+        self.facet_cache.clear()
+
+    def _forget(self, user_id):
+        self.remove_user(user_id)
+
+    def _load(self, user_ids):
+        users = db.session.query(User.id, User.zip_code, User.is_band, User.username, User.city, User.bio)
+        instruments = db.session.query(User_Instrument.user_id, User_Instrument.instrument_id)
+        genres = db.session.query(User_Genre.user_id, User_Genre.genre_id)
+
+        if user_ids is not None:
+            users = users.filter(User.id.in_(user_ids))
+            instruments = instruments.filter(User_Instrument.user_id.in_(user_ids))
+            genres = genres.filter(User_Genre.user_id.in_(user_ids))
+
+        instruments_by_user = {}
+        for user_id, instrument_id in instruments:
+            instruments_by_user.setdefault(user_id, set()).add(instrument_id)
+
+        genres_by_user = {}
+        for user_id, genre_id in genres:
+            genres_by_user.setdefault(user_id, set()).add(genre_id)
+
+        self.add_users((user_id, zip_code, is_band, instruments_by_user.get(user_id, ()),
+                        genres_by_user.get(user_id, ()), profile_text(username, city, bio))
+                       for user_id, zip_code, is_band, username, city, bio in users)
+
+
+def mark_users_changed(session, user_ids):
+    """Record users whose search fields changed in ways the ORM can't see (bulk statements)."""
+
+    changed_ids(session, 'changed_user_ids').update(user_id for user_id in user_ids if user_id is not None)
+
+
+def watch_user_changes(events):
+    """Append the ids of users whose search fields change to `events` on commit."""
+
+    def collect_changed_users(session):
+        changed = set()
+        for obj in list(session.new) + list(session.deleted):
+            if isinstance(obj, User):
+                changed.add(obj.id)
+            elif isinstance(obj, (User_Instrument, User_Genre)):
+                changed.add(obj.user_id)
+
+        for obj in session.dirty:
+            if isinstance(obj, User):
+                state = inspect(obj)
+                if any(state.attrs[field].history.has_changes() for field in INDEXED_USER_FIELDS):
+                    changed.add(obj.id)
+            elif isinstance(obj, (User_Instrument, User_Genre)):
+                changed.add(obj.user_id)
+
+        changed.discard(None)
+        return changed
+
+    watch_changes(events, USER_CHANGES_TOPIC, User, 'changed_user_ids', collect=collect_changed_users)
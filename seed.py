@@ -24,6 +24,7 @@ with open('generator/users.csv') as users:
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    Follows.recount()
     db.session.commit()
 
 with open('generator/users_instruments.csv') as users_instruments:
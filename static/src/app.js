@@ -10,7 +10,6 @@ const loadingContainer = document.getElementById('loading_container')
 const contentContainer = document.getElementById('content_container')
 
 const VIDEO_PLAY_SPEED = .6
-const BASE_URL = 'http://127.0.0.1:5000/'
 
 
 //Slow down the home page bg video
@@ -30,8 +29,9 @@ if(navMenuBtn){
 
 if(messageCount){
     function setMessageCount(n){
-        messageCount.text(n);
+        messageCount.textContent = n;
         messageCount.style.visibility = n ? 'visible' : 'hidden';
+        messageCount.style.display = n ? 'inline' : 'none';
     }
 }
 
@@ -42,25 +42,39 @@ window.addEventListener('DOMContentLoaded', (e) => {
     contentContainer.style.display = 'block';
 });
 
-// Update message notifications
+// Update message notifications as the server pushes them
 window.addEventListener('load', (e) => {
     // The navMenu is only present when a user is logged in. 
     // So, in order to prevent errors, return if the navMenu is not present.
-    if(!navMenu)return;
+    if(!navMenu || !messageCount)return;
 
     let since = 0;
-    setInterval( async function(){
 
-        const res = await axios.get('BASE_URL/notifications?since=' + since)
-        const notifications = res.data
+    function showNotification(notification){
+        if (notification.name == 'unread_message_count')
+            setMessageCount(notification.data);
+        since = notification.timestamp;
+    }
 
-        for (var i = 0; i < notifications.length; i++) {
-            if (notifications[i].name == 'unread_message_count')
-                setMessageCount(notifications[i].data);
-            since = notifications[i].timestamp;
-        }
-            
-    }, 10000);
+    // The stream starts with the latest stored notifications, then pushes new ones.
+    // EventSource reconnects on its own, resuming from the last notification it saw.
+    const notifications = new EventSource('/notifications/stream');
+
+    notifications.addEventListener('notification', function(e){
+        showNotification(JSON.parse(e.data));
+    });
+
+    // A busy server answers 503, which closes the stream for good; poll instead
+    notifications.addEventListener('error', function(e){
+        if (notifications.readyState != EventSource.CLOSED) return;
+
+        setInterval(async function(){
+            const res = await fetch('/notifications?since=' + since);
+            if (!res.ok || !(res.headers.get('Content-Type') || '').startsWith('application/json')) return;
+
+            (await res.json()).forEach(showNotification);
+        }, 10000);
+    });
 })
 
 body.addEventListener('click', closeFlashedMsg)
@@ -0,0 +1,139 @@
+"""Per-worker indexes kept in step with every other worker through the `EventLog`.
+
+Each index is loaded from the database once, then catches up before use by
+reading the ids its topic logged since it last looked and reloading just
+those rows. `watch_changes` is the other half: it logs the ids of rows a
+session changed once the session commits. A None id means there's no telling
+what changed (a bulk delete), and makes readers rebuild from scratch, as does
+falling behind the log's trim horizon.
+"""
+
+from threading import RLock
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class EventSyncedIndex:
+    """Base for an in-process index of database rows, synced through the `EventLog`.
+
+    Subclasses set `TOPIC` and implement `_clear()` to empty the index,
+    `_forget(id)` to drop one row and `_load(ids)` to index rows from the
+    database (all of them when `ids` is None). A subclass whose rows need slow
+    lookups can do them in `_fetch(ids)`, which runs before the index is
+    locked, and index what it returns in `_load`.
+    """
+
+    TOPIC = None
+
+    def __init__(self, events=None):
+        self.events = events
+        self.loaded = False
+        self.last_seq = 0
+        self._lock = RLock()
+        # Held for a whole sync, so one thread catches up at a time without holding up searches
+        self._sync_lock = RLock()
+
+    def _clear(self):
+        raise NotImplementedError
+
+    def _forget(self, id):
+        raise NotImplementedError
+
+    def _load(self, ids):
+        raise NotImplementedError
+
+    def _fetch(self, ids):
+        return ids
+
+    def rebuild(self):
+        """Index every row from the database."""
+
+        with self._sync_lock:
+            last_seq = self.events.last_seq() if self.events else 0
+            rows = self._fetch(None)
+            with self._lock:
+                self._clear()
+                self._load(rows)
+                self.last_seq = last_seq
+                self.loaded = True
+
+    def reload(self, ids):
+        """Re-index the given rows from the database, dropping any that were deleted."""
+
+        rows = self._fetch(ids)
+        with self._lock:
+            for id in ids:
+                self._forget(id)
+            self._load(rows)
+
+    def sync(self):
+        """Catch up with changes committed by any worker since the last sync.
+
+        Once the index is loaded, a thread that finds another one already
+        catching up doesn't wait for it, and answers from the index as it is.
+        """
+
+        if not self._sync_lock.acquire(blocking=not self.loaded):
+            return
+
+        try:
+            if not self.loaded:
+                self.rebuild()
+                return
+
+            if self.events is None:
+                return
+
+            changes = self.events.read_since(self.TOPIC, self.last_seq)
+            if changes is None:
+                self.rebuild()
+            elif changes:
+                ids = {id for seq, id in changes}
+                if None in ids:
+                    self.rebuild()
+                else:
+                    self.reload(ids)
+                    self.last_seq = changes[-1][0]
+        finally:
+            self._sync_lock.release()
+
+
+def changed_ids(session, info_key):
+    """The set of ids collected under `info_key` for `session`'s next commit."""
+
+    return session.info.setdefault(info_key, set())
+
+
+def watch_changes(events, topic, model, info_key, collect=None, bulk_deletes=()):
+    """Append the ids of `model` rows a session adds or deletes to `topic` in `events` on commit.
+
+    Ids are gathered in `session.info[info_key]` at each flush, by
+    `collect(session)` if given. Bulk deletes of `model` or any of the
+    `bulk_deletes` models (whose rows take `model` rows with them) log None.
+    """
+
+    if collect is None:
+        def collect(session):
+            return {obj.id for obj in list(session.new) + list(session.deleted) if isinstance(obj, model)}
+
+    @event.listens_for(Session, 'after_flush')
+    def collect_changes(session, flush_context):
+        changed_ids(session, info_key).update(collect(session))
+
+    @event.listens_for(Session, 'after_bulk_delete')
+    def collect_bulk_deletes(delete_context):
+        if delete_context.mapper.class_ is model or delete_context.mapper.class_ in bulk_deletes:
+            changed_ids(delete_context.session, info_key).add(None)
+
+    @event.listens_for(Session, 'after_commit')
+    def publish_changes(session):
+        changed = session.info.pop(info_key, ())
+        if None in changed:
+            events.append(topic, None)
+        else:
+            for id in changed:
+                events.append(topic, id)
+
+    @event.listens_for(Session, 'after_rollback')
+    def forget_changes(session):
+        session.info.pop(info_key, None)
@@ -0,0 +1,26 @@
+"""Helper for asserting how many SQL statements a block of code runs."""
+
+from contextlib import contextmanager
+from sqlalchemy import event
+from models import db
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside the `with` block.
+
+        with count_queries() as queries:
+            client.get('/results')
+        self.assertLessEqual(len(queries), 8)
+    """
+
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
@@ -0,0 +1,98 @@
+"""Two-tier cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from cache import LRUCache, SharedStore, TwoTierCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process tier."""
+
+    def test_eviction(self):
+        """Is the least recently used entry evicted first?"""
+
+        cache = LRUCache(max_entries=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expiry(self):
+        """Do entries disappear once their TTL has passed?"""
+
+        cache = LRUCache(ttl=60)
+        cache.set('a', 1, ttl=0.01)
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get('a'))
+
+
+class TwoTierCacheTestCase(TestCase):
+    """Test the shared tier and single-flight loading."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_shared_tier(self):
+        """Can a second cache (another worker) read what the first one stored?"""
+
+        TwoTierCache('radius', store=SharedStore(self.path)).set('36830:10', [['36830', 0]])
+        other = TwoTierCache('radius', store=SharedStore(self.path))
+
+        self.assertEqual(other.get('36830:10'), [['36830', 0]])
+        self.assertEqual(other.stats()['shared_hits'], 1)
+        self.assertIsNone(TwoTierCache('other', store=SharedStore(self.path)).get('36830:10'))
+
+    def test_shared_file_private(self):
+        """Is the shared file readable by its owner only?"""
+
+        os.chmod(self.path, 0o644)
+        SharedStore(self.path).set('user', '1', {'username': 'testuser1'}, ttl=60)
+
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+    def test_get_or_load_coalesces_misses(self):
+        """Do concurrent misses for one key call the loader only once?"""
+
+        cache = TwoTierCache('radius', store=SharedStore(self.path))
+        calls = []
+
+        def loader():
+            calls.append(1)
+            time.sleep(0.1)
+            return [('36830', 0)]
+
+        threads = [threading.Thread(target=cache.get_or_load, args=('36830:10', loader)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.get_or_load('36830:10', loader), [['36830', 0]])
+        self.assertEqual(cache.stats()['loads'], 1)
+        self.assertGreaterEqual(cache.stats()['coalesced'], 1)
+
+    def test_cached_none(self):
+        """Are None results cached rather than reloaded?"""
+
+        cache = TwoTierCache('radius', store=SharedStore(self.path))
+        cache.set('00000:10', None)
+
+        self.assertIsNone(cache.get_or_load('00000:10', lambda: 1 / 0))
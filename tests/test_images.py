@@ -0,0 +1,77 @@
+"""Image variant tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+import os
+import tempfile
+from unittest import TestCase
+from PIL import Image
+from images import ImagePipeline, make_variants, PROFILE_VARIANTS
+
+
+class ImageVariantsTestCase(TestCase):
+    """Test resized copies of uploads."""
+
+    def setUp(self):
+        """Save a large JPEG in a scratch upload folder."""
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = self.tmp.name + '/static/uploads/'
+        os.makedirs(self.folder)
+        Image.new('RGB', (2000, 1000), 'red').save(self.folder + 'photo.jpg')
+        with open(self.folder + 'notes.jpg', 'wb') as f:
+            f.write(b'not an image')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_make_variants(self):
+        """Are variants cropped to their fixed size and saved as WebP?"""
+
+        written = make_variants(self.folder + 'photo.jpg', ['avatar', 'header'])
+
+        self.assertEqual([os.path.basename(path) for path in written], ['photo.jpg.avatar.webp', 'photo.jpg.header.webp'])
+        with Image.open(written[0]) as avatar:
+            self.assertEqual((avatar.format, avatar.size), ('WEBP', (192, 192)))
+        with Image.open(written[1]) as header:
+            self.assertEqual(header.size, (1792, 448))
+        self.assertFalse([name for name in os.listdir(self.folder) if name.endswith('.tmp')])
+
+    def test_too_many_pixels(self):
+        """Are images over the pixel cap refused, and failed uploads never retried?"""
+
+        with self.assertRaises(Image.DecompressionBombError):
+            make_variants(self.folder + 'photo.jpg', ['avatar'], max_pixels=1000 * 1000)
+
+        # Uploads that can't be processed are remembered, and keep their original URL
+        pipeline = ImagePipeline(self.folder)
+        url = 'https://example.com' + self.folder + 'notes.jpg'
+        self.assertEqual(pipeline.submit('notes.jpg', PROFILE_VARIANTS).result(), [])
+        self.assertTrue(pipeline.failed.get('notes.jpg'))
+        self.assertEqual(pipeline.url(url, 'avatar'), url)
+
+    def test_pipeline(self):
+        """Do URLs switch to a variant once it's made, and stay on the original otherwise?"""
+
+        pipeline = ImagePipeline(self.folder)
+        url = 'https://example.com' + self.folder + 'photo.jpg'
+
+        self.assertEqual(pipeline.url(url, 'avatar'), url)
+
+        pipeline.submit('photo.jpg', PROFILE_VARIANTS).result()
+        self.assertEqual(pipeline.url(url, 'avatar'), url + '.avatar.webp')
+        self.assertEqual(pipeline.url(url, 'card'), url + '.card.webp')
+        self.assertEqual(pipeline.url(url, 'header'), url)
+        self.assertEqual(pipeline.url('/static/img/default-pic.png', 'avatar'), '/static/img/default-pic.png')
+
+        self.assertEqual(pipeline.submit('notes.jpg', PROFILE_VARIANTS).result(), [])
+
+        # Another worker's pipeline finds the variants on disk, once it looks again
+        other = ImagePipeline(self.folder)
+        self.assertEqual(other.url(url, 'header'), url)
+        make_variants(self.folder + 'photo.jpg', ['header'])
+        self.assertEqual(other.url(url, 'header'), url)
+        other.missing.clear()
+        self.assertEqual(other.url(url, 'header'), url + '.header.webp')
+        self.assertEqual(other.url(url, 'card'), url + '.card.webp')
@@ -0,0 +1,77 @@
+"""Message search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_message_search.py
+from datetime import datetime
+from unittest import TestCase
+from message_search import MessageSearchIndex
+from text_index import InvertedIndex, tokenize
+
+
+class InvertedIndexTestCase(TestCase):
+    """Test word lookups."""
+
+    def test_tokenize(self):
+        """Is text split into lowercase words?"""
+
+        self.assertEqual(tokenize("Drummer needed, Saturday's gig!"), ['drummer', 'needed', 'saturday', 's', 'gig'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_search(self):
+        """Do documents have to contain every word, and are removed documents forgotten?"""
+
+        index = InvertedIndex()
+        index.add(1, 'Drummer needed for a jazz gig')
+        index.add(2, 'Jazz trio looking for bass')
+        index.add(3, 'Rock gig')
+
+        self.assertEqual(index.search('jazz'), {1, 2})
+        self.assertEqual(index.search('GIG jazz'), {1})
+        self.assertEqual(index.search('jazz polka'), set())
+        self.assertEqual(index.search('  '), set())
+
+        index.add(1, 'Drummer found')
+        index.remove(3)
+        self.assertEqual(index.search('gig'), set())
+        self.assertNotIn('gig', index.postings)
+        self.assertEqual(len(index), 2)
+
+
+class MessageSearchIndexTestCase(TestCase):
+    """Test per-user message search."""
+
+    def setUp(self):
+        """Index messages between three users, two per minute."""
+
+        self.index = MessageSearchIndex()
+        for message_id in range(1, 26):
+            self.index.add_message(message_id, 1, 2, datetime(2022, 1, 1, 12, message_id // 2),
+                                   f'gig {message_id}', 'bring your drums')
+        self.index.add_message(26, 3, 1, datetime(2022, 1, 2), 'gig', 'no drums needed')
+
+    def test_search_scoped_to_user(self):
+        """Are only the user's own sent and received messages searched?"""
+
+        self.assertEqual(self.index.search(3, 'gig'), [26])
+        self.assertEqual(len(self.index.search(1, 'gig drums')), 26)
+        self.assertEqual(self.index.search(2, 'needed'), [])
+        self.assertEqual(self.index.search(4, 'gig'), [])
+
+    def test_search_pages(self):
+        """Are pages newest first, cut at the cursor and limited?"""
+
+        self.assertEqual(self.index.search(2, 'drums', limit=3), [25, 24, 23])
+
+        after = (datetime(2022, 1, 1, 12, 11), 23)
+        self.assertEqual(self.index.search(2, 'drums', after=after, limit=3), [22, 21, 20])
+        self.assertEqual(self.index.search(2, 'drums', before=after, limit=3), [24, 25])
+
+    def test_remove_message(self):
+        """Do deleted messages stop matching for both users?"""
+
+        self.index.remove_message(26)
+
+        self.assertEqual(self.index.search(1, 'needed'), [])
+        self.assertNotIn(3, self.index.mailboxes)
+        self.assertEqual(len(self.index), 25)
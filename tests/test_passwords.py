@@ -0,0 +1,77 @@
+"""Password hashing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+from threading import Event, Thread
+from unittest import TestCase
+from werkzeug.exceptions import ServiceUnavailable
+from passwords import PasswordHasher, calibrate_rounds, hash_rounds
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing passwords on a bounded pool."""
+
+    def setUp(self):
+        # The lowest cost bcrypt allows, to keep the tests quick
+        self.hasher = PasswordHasher()
+        self.hasher.configure(max_workers=1, max_waiting=1, rounds=4)
+
+    def test_hash_and_check(self):
+        """Do hashes check out against the right password only, and record their cost?"""
+
+        hashed = self.hasher.hash('secret password')
+
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(self.hasher.check(hashed, 'secret password'))
+        self.assertFalse(self.hasher.check(hashed, 'wrong password'))
+        self.assertFalse(self.hasher.check('not a hash', 'secret password'))
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
+
+        # Hashes are only ever upgraded
+        self.hasher.rounds = 4
+        self.assertFalse(self.hasher.needs_rehash(self.hasher._hash('secret password', 5)))
+
+    def test_long_password(self):
+        """Are passwords past bcrypt's 72 byte limit accepted, as they were before?"""
+
+        hashed = self.hasher.hash('x' * 100)
+        self.assertTrue(self.hasher.check(hashed, 'x' * 72))
+
+    def test_busy(self):
+        """Are hashes refused with a 503 once the pool and its queue are full?"""
+
+        started, release = Event(), Event()
+
+        def hold():
+            started.set()
+            release.wait(5)
+
+        # One hash running and one waiting fill a pool of one worker with a queue of one
+        running = Thread(target=self.hasher._run, args=(hold,))
+        running.start()
+        started.wait(5)
+        self.hasher._slots.acquire()
+
+        try:
+            with self.assertRaises(ServiceUnavailable):
+                self.hasher.hash('secret password')
+        finally:
+            release.set()
+            running.join()
+            self.hasher._slots.release()
+
+        self.assertTrue(self.hasher.check(self.hasher.hash('secret password'), 'secret password'))
+
+    def test_calibrate_rounds(self):
+        """Does calibration stay within its bounds and raise the cost when there's time to spare?"""
+
+        self.assertEqual(calibrate_rounds(0, min_rounds=4, max_rounds=6), 4)
+        self.assertEqual(calibrate_rounds(60, min_rounds=4, max_rounds=6), 6)
+
+        hasher = PasswordHasher()
+        hasher.configure(target_seconds=0, min_rounds=5)
+        self.assertEqual(hasher.calibrate(), 5)
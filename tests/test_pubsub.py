@@ -0,0 +1,44 @@
+"""Publish/subscribe tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+import os, tempfile
+from unittest import TestCase
+from events import EventLog
+from pubsub import Broker
+
+
+class BrokerTestCase(TestCase):
+    """Test delivering messages to channel subscribers."""
+
+    def test_in_process(self):
+        """Are messages only delivered to subscribers of their channel?"""
+
+        broker = Broker()
+
+        with broker.subscribe('user:1') as one, broker.subscribe('user:2') as two:
+            broker.publish('user:1', {'name': 'unread_message_count', 'data': 3})
+
+            self.assertEqual(one.get(timeout=1), {'name': 'unread_message_count', 'data': 3})
+            self.assertIsNone(two.get(timeout=0.01))
+
+        self.assertEqual(broker.subscriptions, {})
+
+    def test_shared_event_log(self):
+        """Do messages published by one broker reach another broker's subscribers?"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            events = EventLog(os.path.join(tmp, 'events.sqlite3'))
+            sender = Broker(events=events, topic='notifications')
+            receiver = Broker(events=events, topic='notifications', poll_interval=0.01)
+
+            sender.publish('user:1', 'before subscribing')
+
+            with receiver.subscribe('user:1') as subscription:
+                sender.publish('user:1', 'after subscribing')
+
+                self.assertEqual(subscription.get(timeout=2), 'after subscribing')
+                self.assertIsNone(subscription.get(timeout=0.05))
+
+            self.assertEqual(receiver.subscriptions, {})
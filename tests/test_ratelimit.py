@@ -0,0 +1,87 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+import os
+import tempfile
+from unittest import TestCase
+from ratelimit import Limit, MemoryCounters, RateLimiter, SharedCounters
+
+
+class RateLimitTestCase(TestCase):
+    """Test sliding-window counters."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse(self):
+        """Are limits read from their config strings?"""
+
+        self.assertEqual(Limit.parse('5/minute'), Limit(5, 60))
+        self.assertEqual(Limit.parse('100 / 6 hours'), Limit(100, 6 * 60 * 60))
+        with self.assertRaises(ValueError):
+            Limit.parse('5 per minute')
+        with self.assertRaises(ValueError):
+            Limit.parse('0/minute')
+        with self.assertRaises(ValueError):
+            Limit.parse('5/0 hours')
+
+    def check_sliding_window(self, counters):
+        limit = Limit(4, 60)
+
+        # Four hits late in one window fill the limit
+        self.assertEqual([counters.hit([('key', limit)], now=50 + i) for i in range(4)], [0, 0, 0, 0])
+        wait = counters.hit([('key', limit)], now=55)
+        self.assertEqual(wait, 20)
+
+        # Early in the next window most of them still count...
+        self.assertGreater(counters.hit([('key', limit)], now=70), 0)
+
+        # ...but they slide out as it goes on, without the rejected hits having counted
+        self.assertEqual(counters.hit([('key', limit)], now=75), 0)
+        self.assertEqual(counters.hit([('other key', limit)], now=75), 0)
+
+        # Two windows later, nothing is left
+        self.assertEqual([counters.hit([('key', limit)], now=200 + i) for i in range(4)], [0, 0, 0, 0])
+
+    def test_memory_counters(self):
+        """Does the in-process counter allow the limit in any window's length, and no more?"""
+
+        self.check_sliding_window(MemoryCounters())
+
+        counters = MemoryCounters(max_keys=2)
+        for key in ('a', 'b', 'c'):
+            counters.hit([(key, Limit(1, 60))], now=0)
+        self.assertEqual(len(counters), 2)
+        self.assertEqual(counters.hit([('a', Limit(1, 60))], now=1), 0)
+
+    def test_shared_counters(self):
+        """Do counters in the shared file behave the same, and persist across instances?"""
+
+        path = os.path.join(self.tmp.name, 'shared.sqlite3')
+        self.check_sliding_window(SharedCounters(path))
+
+        SharedCounters(path).hit([('key', Limit(1, 60))], now=300)
+        self.assertGreater(SharedCounters(path).hit([('key', Limit(1, 60))], now=301), 0)
+
+    def test_rate_limiter(self):
+        """Is each scope counted separately, and are unlimited scopes ignored?"""
+
+        limiter = RateLimiter({'login': {'ip': '3/minute', 'user': '2/minute'}})
+
+        self.assertEqual(limiter.hit('login', ip='10.0.0.1', user='alice'), 0)
+        self.assertEqual(limiter.hit('login', ip='10.0.0.1', user='alice'), 0)
+        self.assertGreater(limiter.hit('login', ip='10.0.0.1', user='alice'), 0)
+
+        # The refused hit didn't count against the address, so another user still has one left there
+        self.assertEqual(limiter.hit('login', ip='10.0.0.1', user='bob'), 0)
+        self.assertGreater(limiter.hit('login', ip='10.0.0.1', user='carol'), 0)
+
+        self.assertEqual(limiter.hit('search', ip='10.0.0.1'), 0)
+
+        limiter.reset()
+        self.assertEqual(limiter.hit('login', ip='10.0.0.1', user='alice'), 0)
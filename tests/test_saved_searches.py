@@ -0,0 +1,87 @@
+"""Saved search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_saved_searches.py
+from threading import Thread
+from unittest import TestCase
+import requests
+from saved_searches import SavedSearchIndex
+
+ZIPS = {
+    ('11111', 10): [('11111', 0.0), ('22222', 8.0)],
+    ('11111', 50): [('11111', 0.0), ('22222', 8.0), ('33333', 40.0)],
+}
+
+
+def zips_in_radius(zip_code, radius):
+    if zip_code == '99999':
+        raise requests.RequestException()
+    return ZIPS.get((zip_code, radius))
+
+
+class SavedSearchIndexTestCase(TestCase):
+    """Test matching profiles against saved searches."""
+
+    def setUp(self):
+        """Index searches by two users around the same zip code."""
+
+        self.index = SavedSearchIndex(zips_in_radius)
+        self.index.add_search(1, 100, '11111', 10, False)
+        self.index.add_search(2, 100, '11111', 50, False, instrument_ids=[1, 2])
+        self.index.add_search(3, 200, '11111', 50, False, instrument_ids=[1, 2], match_all_instruments=True)
+        self.index.add_search(4, 200, '11111', 10, True, genre_ids=[7])
+
+    def test_percolate(self):
+        """Are only searches covering the zip code, with matching filters, returned?"""
+
+        self.assertEqual(self.index.percolate(1, '22222', False), {1})
+        self.assertEqual(self.index.percolate(1, '22222', False, instrument_ids=[2]), {1, 2})
+        self.assertEqual(self.index.percolate(1, '22222', False, instrument_ids=[1, 2, 3]), {1, 2, 3})
+        self.assertEqual(self.index.percolate(1, '33333', False, instrument_ids=[1]), {2})
+        self.assertEqual(self.index.percolate(1, '44444', False, instrument_ids=[1]), set())
+        self.assertEqual(self.index.percolate(1, None, False), set())
+
+        self.assertEqual(self.index.percolate(1, '11111', True), set())
+        self.assertEqual(self.index.percolate(1, '11111', True, genre_ids=[7, 8]), {4})
+
+    def test_own_searches_skipped(self):
+        """Don't users' own profiles match their own searches?"""
+
+        self.assertEqual(self.index.percolate(100, '22222', False, instrument_ids=[1, 2]), {3})
+        self.assertEqual(self.index.percolate(200, '22222', False, instrument_ids=[1, 2]), {1, 2})
+
+    def test_remove_search(self):
+        """Are removed searches forgotten, and unknown zip codes left out?"""
+
+        self.index.remove_search(1)
+        self.index.remove_search(2)
+        self.assertEqual(self.index.percolate(1, '22222', False, instrument_ids=[1]), set())
+        self.assertEqual(self.index.by_zip['33333'], {3})
+        self.assertEqual(self.index.by_zip['11111'], {3, 4})
+
+        self.index.add_search(5, 100, '00000', 10, False)
+        self.index.add_search(6, 100, '99999', 10, False)
+        self.assertEqual(len(self.index), 2)
+
+    def test_lookup_outside_lock(self):
+        """Are a search's zip codes looked up without holding the index lock, so a slow API can't block it?"""
+
+        lock_free = []
+
+        def try_lock():
+            acquired = index._lock.acquire(timeout=1)
+            if acquired:
+                index._lock.release()
+            lock_free.append(acquired)
+
+        def slow_zips_in_radius(zip_code, radius):
+            probe = Thread(target=try_lock)
+            probe.start()
+            probe.join()
+            return zips_in_radius(zip_code, radius)
+
+        index = SavedSearchIndex(slow_zips_in_radius)
+        index.add_search(1, 100, '11111', 10, False)
+        self.assertEqual(lock_free, [True])
+        self.assertEqual(index.percolate(1, '22222', False), {1})
@@ -0,0 +1,165 @@
+"""Search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search_index.py
+from unittest import TestCase
+from search_index import SearchIndex, iter_ids, popcount, to_bits
+from zip_radius import ZipRadiusEngine
+
+GUITAR, DRUMS, BASS = 1, 2, 3
+ROCK, JAZZ = 1, 2
+
+
+class SearchIndexTestCase(TestCase):
+    """Test bitmap candidate selection."""
+
+    def setUp(self):
+        """Index a few users around two zip codes."""
+
+        self.engine = ZipRadiusEngine({
+            '36830': (32.5578, -85.4799),
+            '36832': (32.5707, -85.5754),
+            '36117': (32.3734, -86.1827),
+            '35242': (33.3863, -86.6745),
+            '99501': (61.2181, -149.9003),
+        })
+        self.index = SearchIndex(engine=self.engine)
+        self.index.add_user(1, '36830', False, [GUITAR], [ROCK])
+        self.index.add_user(2, '36830', False, [GUITAR, DRUMS], [ROCK, JAZZ])
+        self.index.add_user(3, '36832', False, [DRUMS], [JAZZ])
+        self.index.add_user(4, '36832', True, [GUITAR, BASS], [ROCK])
+        self.index.add_user(5, 36117, False, [GUITAR], [ROCK])
+        self.index.loaded = True
+
+    def test_bit_helpers(self):
+        """Do the bitset helpers find the right ids?"""
+
+        self.assertEqual(list(iter_ids(0b101010)), [1, 3, 5])
+        self.assertEqual(popcount(0b101010), 3)
+        self.assertEqual(list(iter_ids(0)), [])
+        self.assertEqual(list(iter_ids((1 << 100000) | 1)), [0, 100000])
+        self.assertEqual(popcount((1 << 100000) | 1), 2)
+        self.assertEqual(to_bits([5, 0, 64, 100000]), (1 << 100000) | (1 << 64) | 0b100001)
+        self.assertEqual(to_bits([]), 0)
+
+    def test_match(self):
+        """Are any-of and all-of instrument filters applied?"""
+
+        self.assertEqual(list(iter_ids(self.index.match([GUITAR], [ROCK], False))), [1, 2, 5])
+        self.assertEqual(list(iter_ids(self.index.match([GUITAR], [ROCK], True))), [4])
+        self.assertEqual(list(iter_ids(self.index.match([GUITAR, DRUMS], [JAZZ], False))), [2, 3])
+        self.assertEqual(list(iter_ids(self.index.match([GUITAR, DRUMS], [], False, match_all_instruments=True))), [2])
+        self.assertEqual(popcount(self.index.match()), 5)
+
+    def test_nearest_first(self):
+        """Are users returned by distance, then id, and paged with a cursor?"""
+
+        zips = [('36830', 0), ('36832', 5.7), ('36117', 43.4)]
+        matches = self.index.match([GUITAR, DRUMS], [ROCK, JAZZ], False)
+
+        self.assertEqual(self.index.nearest_first(zips, matches),
+                         [(1, 0), (2, 0), (3, 5.7), (5, 43.4)])
+        self.assertEqual(self.index.nearest_first(zips, matches, limit=3),
+                         [(1, 0), (2, 0), (3, 5.7)])
+        self.assertEqual(self.index.nearest_first(zips, matches, after=(0, 1), limit=2),
+                         [(2, 0), (3, 5.7)])
+        self.assertEqual(self.index.nearest_first(zips[:2], matches, after=(5.7, 3)), [])
+
+    def test_update_and_remove_user(self):
+        """Do profile edits move a user between bitsets?"""
+
+        self.index.add_user(1, '36117', False, [BASS], [JAZZ])
+
+        self.assertEqual(list(iter_ids(self.index.match([GUITAR], [ROCK], False))), [2, 5])
+        self.assertEqual(list(iter_ids(self.index.in_zips(['36117']))), [1, 5])
+
+        self.index.remove_user(5)
+
+        self.assertEqual(list(iter_ids(self.index.in_zips(['36117']))), [1])
+        self.assertEqual(len(self.index), 4)
+        self.assertEqual(self.index.zips, {'36830': {2}, '36832': {3, 4}, '36117': {1}})
+
+        self.index.remove_user(1)
+        self.assertNotIn('36117', self.index.zips)
+
+    def test_add_users(self):
+        """Does indexing a batch of users match indexing them one at a time?"""
+
+        batch = SearchIndex(engine=self.engine)
+        batch.add_users([(1, '36830', False, [GUITAR], [ROCK], ''),
+                         (2, '36830', False, [GUITAR, DRUMS], [ROCK, JAZZ], ''),
+                         (3, '36832', False, [DRUMS], [JAZZ], ''),
+                         (4, '36832', True, [GUITAR, BASS], [ROCK], ''),
+                         (5, 36117, False, [GUITAR], [ROCK], '')])
+
+        for attr in ('everyone', 'bands', 'instruments', 'genres', 'zips', 'users'):
+            self.assertEqual(getattr(batch, attr), getattr(self.index, attr))
+        self.assertEqual(batch.max_user_id(), 5)
+
+    def test_facet_counts(self):
+        """Are users counted per facet within the candidates, and are area counts cached until a change?"""
+
+        nearby = self.index.in_zips(['36830', '36832'])
+        self.assertEqual(self.index.facet_counts(nearby), {
+            'instruments': {GUITAR: 3, DRUMS: 2, BASS: 1},
+            'genres': {ROCK: 3, JAZZ: 2},
+            'bands': 1,
+            'musicians': 3,
+        })
+        self.assertEqual(self.index.facet_counts(0), {'instruments': {}, 'genres': {}, 'bands': 0, 'musicians': 0})
+
+        zips = [('36830', 0), ('36832', 5.7)]
+        counts = self.index.area_facet_counts('36830', 10, zips)
+        self.assertIs(self.index.area_facet_counts('36830', 10, zips), counts)
+
+        self.index.add_user(6, '36832', False, [BASS], [JAZZ])
+        counts = self.index.area_facet_counts('36830', 10, zips)
+        self.assertEqual(counts['instruments'][BASS], 2)
+        self.assertEqual(counts['musicians'], 4)
+
+    def test_nearby_zips(self):
+        """Are occupied zip codes walked outward from the origin, nearest first?"""
+
+        self.assertEqual([zip for zip, distance in self.index.nearby_zips('36830')],
+                         ['36830', '36832', '36117'])
+        self.assertEqual([zip for zip, distance in self.index.nearby_zips('36117')],
+                         ['36117', '36832', '36830'])
+        self.assertEqual(list(self.index.nearby_zips('00000')), [])
+
+        self.index.add_user(6, '99501', False, [GUITAR], [ROCK])
+        self.index.remove_user(5)
+
+        zips = list(self.index.nearby_zips('35242'))
+        self.assertEqual([zip for zip, distance in zips], ['36832', '36830', '99501'])
+        self.assertEqual(zips, sorted(zips, key=lambda pair: pair[1]))
+
+    def test_nearest_first_closest_matches(self):
+        """Does a closest-match search stop once the page is full?"""
+
+        matches = self.index.match([GUITAR], [ROCK], False)
+
+        self.assertEqual([id for id, distance in self.index.nearest_first(self.index.nearby_zips('36117'), matches, limit=2)],
+                         [5, 1])
+
+    def test_ranked(self):
+        """Are keyword matches ranked by relevance, filtered by the bitset and paged?"""
+
+        self.index.add_user(1, '36830', False, [GUITAR], [ROCK], 'guitarist Auburn Rock covers on weekends')
+        self.index.add_user(2, '36830', False, [GUITAR, DRUMS], [ROCK, JAZZ], 'drummer Auburn Jazz trio looking for upright bass')
+        self.index.add_user(3, '36832', False, [DRUMS], [JAZZ], 'jazzcat Opelika Jazz jazz jazz')
+        everyone = self.index.match()
+
+        ranked = self.index.ranked('jazz trio looking for upright bass', everyone)
+        self.assertEqual([user_id for user_id, score in ranked], [2, 3])
+        self.assertGreater(ranked[0][1], ranked[1][1])
+
+        self.assertEqual([user_id for user_id, score in self.index.ranked('auburn', self.index.match([DRUMS]))], [2])
+
+        user_id, score = ranked[0]
+        self.assertEqual(self.index.ranked('jazz trio looking for upright bass', everyone, after=(score, user_id)), ranked[1:])
+        self.assertEqual(self.index.ranked('polka', everyone), [])
+
+        self.index.remove_user(2)
+        self.assertEqual(self.index.ranked('trio', everyone), [])
+        self.assertNotIn('trio', self.index.words)
@@ -3,14 +3,20 @@
 # run these tests like:
 #
 #    FLASK_ENV=production python -m unittest test_user_views.py
-import os
+import os, re, tempfile
 from unittest import TestCase
 from models import db, connect_db, User, Instrument, Genre
 from multiselect_options import INSTRUMENT_CHOICES, GENRE_CHOICES
+from query_count import count_queries
+from pagination import encode_cursor, decode_cursor
 
 
 os.environ['DATABASE_URL'] = "postgresql:///hook-find-musicians-test"
-from app import app, CURR_USER_KEY
+
+# Keep test radius data, searches and events out of the shared cache file real servers use
+SHARED_CACHE = tempfile.TemporaryDirectory()
+os.environ['SHARED_CACHE_PATH'] = os.path.join(SHARED_CACHE.name, 'shared-cache.sqlite3')
+from app import app, CURR_USER_KEY, radius_cache, save_search
 
 db.create_all()
 
@@ -90,9 +96,29 @@ class SearchViewTestCase(TestCase):
             self.assertIn('<label for="is_band-0">Musicians</label>',html )
             self.assertIn('<label class="text-xl" for="instruments-search">Instrument Played</label>',html )
             self.assertIn('<label class="text-xl" for="genres-search">Genre Played</label>',html )
+            self.assertIn('<select class="rounded border-1 border-slate-400 placeholder:text-xs placeholder:font-extrabold placeholder:uppercase placeholder:text-slate-400 mb-3" id="instruments-search" multiple name="instruments"',html )
             self.assertIn('<input class="radius_slider" id="radius" max="100" min="0" name="radius" step="10" type="range" value="10"',html )
             
 
+    def test_cache_stats_debug_only(self):
+        """Are the radius cache counters hidden outside debug mode?"""
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            self.assertEqual(c.get("/search/cache-stats").status_code, 404)
+
+            app.debug = True
+            try:
+                resp = c.get("/search/cache-stats")
+            finally:
+                app.debug = False
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('hit_rate', resp.json)
+
+
     def test_search_results(self):
         """Does the search form render?"""
 
@@ -101,11 +127,9 @@ class SearchViewTestCase(TestCase):
             with c.session_transaction() as sess:
                 sess[CURR_USER_KEY] = self.testuser1.id
 
-                #Simulating the form submission
-                sess["searching_for_band"] = 'False'
-                sess["searching_instrument"] = 'acoustic guitar'
-                sess["searching_genre"] = 'rock'
-                sess['response_zip_codes'] = ['11111','22222','33333','99999']
+            #Simulating the form submission
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['33333', 2], ['99999', 3]])
+            search_id = save_search(zip_code='11111', radius=10, is_band=False, instruments=['acoustic guitar'], genres=['rock'], match_all_instruments=False)
 
             band1 = User.query.filter(User.username == 'testband1').first()
             user1 = User.query.filter(User.username == 'testuser1').first()
@@ -136,7 +160,7 @@ class SearchViewTestCase(TestCase):
             user3.genres = [rock,metal,alt_metal]
             db.session.commit()
 
-            resp = c.get("/results")          
+            resp = c.get(f"/results?search={search_id}")          
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -146,17 +170,16 @@ class SearchViewTestCase(TestCase):
             self.assertNotIn('Testuser2',html )
             self.assertIn('Testuser3',html )
 
+            # Everyone within the radius is counted, whatever the filters
+            self.assertIn('Within this radius: 3 musicians, 1 band', html)
+            self.assertIn('Acoustic Guitar (3), Lead Guitar (3), Drums (1)', html)
+            self.assertIn('Rock (3)', html)
 
-            with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser1.id
 
-                #Simulating the form submission
-                sess["searching_for_band"] = 'True'
-                sess["searching_instrument"] = 'acoustic guitar'
-                sess["searching_genre"] = 'rock'
-                sess['response_zip_codes'] = ['11111','22222','33333','99999']
+            #Simulating the form submission
+            search_id = save_search(zip_code='11111', radius=10, is_band=True, instruments=['acoustic guitar'], genres=['rock'], match_all_instruments=False)
 
-            resp = c.get("/results")          
+            resp = c.get(f"/results?search={search_id}")          
             html = resp.get_data(as_text=True)
 
             self.assertEqual(resp.status_code, 200)
@@ -167,7 +190,193 @@ class SearchViewTestCase(TestCase):
             self.assertNotIn('Testuser3',html )
 
 
+    def test_search_results_expired(self):
+        """Does an unknown search id send the user back to the search form?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.get("/results?search=doesnotexist")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn('/search', resp.location)
+            
+
+    def test_search_results_pagination(self):
+        """Are results paged nearest first with a cursor link to the next page?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            acoustic_guitar = Instrument.query.filter(Instrument.name == 'acoustic guitar').first()
+            rock = Genre.query.filter(Genre.name == 'rock').first()
+
+            for user in User.query.filter(User.is_band == False).all():
+                user.instruments = [acoustic_guitar]
+                user.genres = [rock]
+            db.session.commit()
+
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['33333', 2], ['99999', 3]])
+            search_id = save_search(zip_code='11111', radius=10, is_band=False, instruments=['acoustic guitar'], genres=['rock'], match_all_instruments=False)
+
+            resp = c.get(f"/results?search={search_id}&per_page=2")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Testuser1',html )
+            self.assertIn('Testuser2',html )
+            self.assertNotIn('Testuser3',html )
+            self.assertIn('More results',html )
+
+            next_url = re.search(r'href="(/results\?[^"]*after=[^"]*)"', html).group(1)
+
+            resp = c.get(next_url.replace('&amp;', '&'))
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn('Testuser1',html )
+            self.assertNotIn('Testuser2',html )
+            self.assertIn('Testuser3',html )
+            self.assertNotIn('More results',html )
+
+    def test_search_results_bad_cursor(self):
+        """Do negative, out of range or non-finite cursors start from the first page?"""
+
+        self.assertIsNone(decode_cursor(encode_cursor(0, -5), float, int))
+        self.assertIsNone(decode_cursor(encode_cursor(0.0, 10**10), float, int, max_id=100))
+        self.assertIsNone(decode_cursor(encode_cursor(float('nan'), 1), float, int))
+        self.assertIsNone(decode_cursor(encode_cursor(float('inf'), 1), float, int))
+        self.assertEqual(decode_cursor(encode_cursor(1, 100), float, int, max_id=100), [1, 100])
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['33333', 2], ['99999', 3]])
+            search_id = save_search(zip_code='11111', radius=10, is_band=False, instruments=[], genres=[], match_all_instruments=False)
+
+            for cursor in (encode_cursor(0, -5), encode_cursor(0.0, 10**10), encode_cursor(float('nan'), 1)):
+                resp = c.get(f"/results?search={search_id}&after={cursor}")
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Testuser1',html )
+
+
+    def test_search_results_query_count(self):
+        """Are instruments and genres loaded for all result cards at once?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            instruments = Instrument.query.filter(Instrument.name.in_(['acoustic guitar', 'drums'])).all()
+            genres = Genre.query.filter(Genre.name.in_(['rock', 'blues'])).all()
+
+            for user in User.query.filter(User.is_band == False).all():
+                user.instruments = instruments
+                user.genres = genres
+            db.session.commit()
+
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['33333', 2], ['99999', 3]])
+            search_id = save_search(zip_code='11111', radius=10, is_band=False, instruments=['acoustic guitar'], genres=['rock'], match_all_instruments=False)
+
+            # The first request also brings the search index up to date
+            c.get(f"/results?search={search_id}")
+
+            with count_queries() as queries:
+                resp = c.get(f"/results?search={search_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Testuser3',html )
+            self.assertIn('Drums',html )
+            # Instrument and genre ids come from the vocabulary cache, not the database
+            self.assertFalse([q for q in queries if 'FROM instruments' in q or 'FROM genres' in q])
+            self.assertLessEqual(len(queries), 5)
+
+
+    def test_search_results_nearest(self):
+        """Does a closest-match search list the nearest users without a radius?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            acoustic_guitar = Instrument.query.filter(Instrument.name == 'acoustic guitar').first()
+            rock = Genre.query.filter(Genre.name == 'rock').first()
+
+            for username, zip_code in [('testuser1', '36117'), ('testuser2', '36832'), ('testuser3', '35242')]:
+                user = User.query.filter(User.username == username).first()
+                user.zip_code = zip_code
+                user.instruments = [acoustic_guitar]
+                user.genres = [rock]
+            db.session.commit()
+
+            search_id = save_search(zip_code='36830', radius=None, is_band=False, instruments=['acoustic guitar'], genres=['rock'], match_all_instruments=False)
+
+            resp = c.get(f"/results?search={search_id}&per_page=2")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Testuser2',html )
+            self.assertIn('Testuser1',html )
+            self.assertNotIn('Testuser3',html )
+            self.assertLess(html.index('Testuser2'), html.index('Testuser1'))
+            self.assertIn('More results',html )
+
+
+    def test_search_results_keywords(self):
+        """Are keyword searches ranked by profile text, within the radius and filters?"""
 
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            acoustic_guitar = Instrument.query.filter(Instrument.name == 'acoustic guitar').first()
+            rock = Genre.query.filter(Genre.name == 'rock').first()
+
+            bios = {'testuser1': 'Rock covers on weekends',
+                    'testuser2': 'Jazz trio looking for upright bass',
+                    'testuser3': 'Jazz jazz jazz and more jazz',
+                    'testband1': 'Jazz trio looking for upright bass'}
+            for user in User.query.all():
+                user.bio = bios[user.username]
+                user.instruments = [acoustic_guitar]
+                user.genres = [rock]
+            db.session.commit()
 
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['99999', 3]])
+            search_id = save_search(zip_code='11111', radius=10, is_band=False, instruments=['acoustic guitar'], genres=['rock'],
+                                    match_all_instruments=False, keywords='jazz trio looking for upright bass')
 
-            
\ No newline at end of file
+            resp = c.get(f"/results?search={search_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Testuser2',html )
+            self.assertNotIn('Testuser1',html )
+            self.assertNotIn('Testuser3',html )
+            self.assertNotIn('Testband1',html )
+
+            radius_cache.set('11111:10', [['11111', 0], ['22222', 1], ['33333', 2], ['99999', 3]])
+            resp = c.get(f"/results?search={search_id}&per_page=1")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('Testuser2',html )
+            self.assertNotIn('Testuser3',html )
+
+            next_url = re.search(r'href="(/results\?[^"]*after=[^"]*)"', html).group(1)
+            html = c.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+
+            self.assertIn('Testuser3',html )
+            self.assertNotIn('Testuser2',html )
+            self.assertNotIn('More results',html )
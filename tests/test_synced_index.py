@@ -0,0 +1,104 @@
+"""Event-synced index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_synced_index.py
+import os
+import tempfile
+from threading import Thread
+from unittest import TestCase
+from events import EventLog
+from synced_index import EventSyncedIndex
+
+
+class RowIndex(EventSyncedIndex):
+    """Indexes the ids in `rows`, a stand-in for a table."""
+
+    TOPIC = 'rows'
+
+    def __init__(self, rows, events=None):
+        super().__init__(events)
+        self.rows = rows
+        self.ids = set()
+        self.rebuilds = 0
+
+    def _clear(self):
+        self.ids = set()
+        self.rebuilds += 1
+
+    def _forget(self, id):
+        self.ids.discard(id)
+
+    def _load(self, ids):
+        self.ids |= self.rows if ids is None else self.rows & set(ids)
+
+
+class FetchingRowIndex(RowIndex):
+    """A `RowIndex` that looks its rows up in `_fetch`, noting whether the index was locked meanwhile."""
+
+    def __init__(self, rows, events=None):
+        super().__init__(rows, events)
+        self.fetched_unlocked = []
+
+    def _fetch(self, ids):
+        def try_lock():
+            acquired = self._lock.acquire(timeout=1)
+            if acquired:
+                self._lock.release()
+            self.fetched_unlocked.append(acquired)
+
+        probe = Thread(target=try_lock)
+        probe.start()
+        probe.join()
+        return ids
+
+
+class EventSyncedIndexTestCase(TestCase):
+    """Test catching up with the event log."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.events = EventLog(self.path)
+
+    def tearDown(self):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_sync(self):
+        """Are logged ids reloaded, and does a None id or a trimmed log force a rebuild?"""
+
+        rows = {1, 2}
+        index = RowIndex(rows, self.events)
+        index.sync()
+        self.assertEqual((index.ids, index.rebuilds), ({1, 2}, 1))
+
+        rows.discard(1)
+        rows.add(3)
+        self.events.append('rows', 1)
+        self.events.append('rows', 3)
+        self.events.append('other', 2)
+        index.sync()
+        self.assertEqual((index.ids, index.rebuilds), ({2, 3}, 1))
+
+        rows.clear()
+        self.events.append('rows', None)
+        index.sync()
+        self.assertEqual((index.ids, index.rebuilds), (set(), 2))
+
+        self.events.retention = -1
+        self.events.append('rows', 4)
+        self.events.trim()
+        rows.add(4)
+        index.sync()
+        self.assertEqual((index.ids, index.rebuilds), ({4}, 3))
+
+    def test_fetch_unlocked(self):
+        """Is `_fetch` run before the index is locked, on rebuilds and reloads?"""
+
+        index = FetchingRowIndex({1, 2}, self.events)
+        index.sync()
+        self.events.append('rows', 2)
+        index.sync()
+        self.assertEqual((index.ids, index.fetched_unlocked), ({1, 2}, [True, True]))
@@ -0,0 +1,88 @@
+"""Upload storage tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_uploads.py
+import hashlib
+import io
+import os
+import tempfile
+from unittest import TestCase
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+from uploads import UploadStore, filename_from_url, sniff_extension, upload_url
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class UploadStoreTestCase(TestCase):
+    """Test storing uploads by their content."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = UploadStore(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_save(self):
+        """Is a file named by its hash, and stored once however often it's uploaded?"""
+
+        picture = PNG + b'picture'
+        filename = hashlib.sha256(picture).hexdigest() + '.png'
+
+        self.assertEqual(self.store.save(io.BytesIO(picture)), (filename, 15, True))
+        self.assertEqual(self.store.save(io.BytesIO(picture)), (filename, 15, False))
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), [filename])
+
+        with open(self.store.path(filename), 'rb') as f:
+            self.assertEqual(f.read(), picture)
+
+    def test_rejected(self):
+        """Are files that aren't images or are too large refused, without leaving anything behind?"""
+
+        with self.assertRaises(UnsupportedMediaType):
+            self.store.save(io.BytesIO(b'MZ' + b'\0' * 100))
+        with self.assertRaises(UnsupportedMediaType):
+            self.store.save(io.BytesIO(b'GIF'))
+
+        incoming = self.store.incoming(max_bytes=100)
+        incoming.write(PNG + b'\0' * 50)
+        with self.assertRaises(RequestEntityTooLarge):
+            incoming.write(b'\0' * 50)
+
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_sniff_extension(self):
+        """Are images recognized by their first bytes?"""
+
+        self.assertEqual(sniff_extension(b'\xff\xd8\xff\xe0\0\x10JFIF\0\x01'), '.jpg')
+        self.assertEqual(sniff_extension(PNG + b'\0\0\0\r'), '.png')
+        self.assertEqual(sniff_extension(b'GIF89a\x01\0\x01\0\0\0'), '.gif')
+        self.assertEqual(sniff_extension(b'RIFF\x24\0\0\0WEBP'), '.webp')
+        self.assertIsNone(sniff_extension(b'RIFF\x24\0\0\0WAVE'))
+        self.assertIsNone(sniff_extension(b'<svg xmlns="'))
+
+    def test_delete(self):
+        """Are a file's variants deleted along with it, and other files left alone?"""
+
+        filename, size, is_new = self.store.save(io.BytesIO(PNG + b'one'))
+        other, size, is_new = self.store.save(io.BytesIO(PNG + b'two'))
+        with open(self.store.path(filename + '.avatar.webp'), 'wb') as f:
+            f.write(b'variant')
+
+        self.assertEqual(sorted(self.store.stored_files()), sorted([filename, other]))
+
+        self.store.delete(filename)
+        self.assertEqual(os.listdir(self.tmp.name), [other])
+
+    def test_urls(self):
+        """Are only well-formed upload URLs mapped back to stored files?"""
+
+        filename = hashlib.sha256(b'picture').hexdigest() + '.jpg'
+
+        self.assertEqual(upload_url(filename), '/uploads/' + filename)
+        self.assertEqual(filename_from_url(upload_url(filename)), filename)
+        self.assertEqual(filename_from_url(upload_url(filename + '.card.webp')), filename + '.card.webp')
+        self.assertIsNone(filename_from_url('/static/img/default-pic.png'))
+        self.assertIsNone(filename_from_url('/uploads/../app.py'))
+        self.assertIsNone(filename_from_url(None))
@@ -2,12 +2,17 @@
 
 #    python -m unittest test_user_model.py
 
-import os
+import os, tempfile
 from unittest import TestCase
 from models import db, User, Follows, Instrument, User_Instrument, Genre, User_Genre
+from passwords import password_hasher, hash_rounds
 
 os.environ['DATABASE_URL'] = "postgresql:///hook-find-musicians-test"
 
+# Keep test radius data, searches and events out of the shared cache file real servers use
+SHARED_CACHE = tempfile.TemporaryDirectory()
+os.environ['SHARED_CACHE_PATH'] = os.path.join(SHARED_CACHE.name, 'shared-cache.sqlite3')
+
 from app import app
 
 db.create_all()
@@ -135,6 +140,28 @@ class UserModelTestCase(TestCase):
         self.assertEqual(auth_fail_user2, False)
 
 
+    def test_authenticate_rehash(self):
+        """Is a password hashed at an old cost rehashed at the new one when its owner logs in?"""
+
+        rounds = password_hasher.rounds
+        password_hasher.rounds = 4
+        try:
+            User.signup(username='testuser', email='test@test.com', password='HASHED_PASSWORD', city='Test City',
+                        state='ST', zip_code='36832', is_band=True, profile_image=None, header_image=None)
+            db.session.commit()
+
+            password_hasher.rounds = 5
+            self.assertFalse(User.authenticate('testuser', 'WRONG_PASSWORD'))
+            self.assertEqual(hash_rounds(User.query.one().password), 4)
+
+            user = User.authenticate('testuser', 'HASHED_PASSWORD')
+            db.session.commit()
+            self.assertEqual(hash_rounds(user.password), 5)
+            self.assertEqual(User.authenticate('testuser', 'HASHED_PASSWORD'), user)
+        finally:
+            password_hasher.rounds = rounds
+
+
     def test_user_relationship(self):
         """Test ."""
          
@@ -3,14 +3,20 @@
 # run these tests like:
 #
 #    FLASK_ENV=production python -m unittest test_user_views.py
-import os, io
+import os, io, re, hashlib, tempfile
+from datetime import datetime
 from unittest import TestCase
-from models import db, connect_db, Message, User, Instrument, Genre, Notification
+from models import db, connect_db, Message, User, Instrument, Genre, Notification, Follows, Thread, ThreadSummary, Upload, SavedSearch, User_Instrument, User_Genre
 from multiselect_options import INSTRUMENT_CHOICES, GENRE_CHOICES
+from query_count import count_queries
 
 
 os.environ['DATABASE_URL'] = "postgresql:///hook-find-musicians-test"
-from app import app, CURR_USER_KEY
+
+# Keep test radius data, searches and events out of the shared cache file real servers use
+SHARED_CACHE = tempfile.TemporaryDirectory()
+os.environ['SHARED_CACHE_PATH'] = os.path.join(SHARED_CACHE.name, 'shared-cache.sqlite3')
+from app import app, CURR_USER_KEY, search_index, rate_limiter, save_search, user_cache, notification_stream_slots, upload_store, image_pipeline
 
 db.create_all()
 
@@ -19,6 +25,14 @@ app.config['WTF_CSRF_ENABLED'] = False
 app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
+# Keep uploaded test images out of the real upload folder
+UPLOADS = tempfile.TemporaryDirectory()
+upload_store.folder = image_pipeline.folder = UPLOADS.name
+
+# Enough of a JPEG to pass the upload checks
+JPEG = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00abcdef"
+PNG = b"\x89PNG\r\n\x1a\n"
+
 class UserViewTestCase(TestCase):
     """Test views for users."""
 
@@ -26,7 +40,13 @@ class UserViewTestCase(TestCase):
         """Create test client, add sample data."""
 
         User.query.delete()
+        Follows.query.delete()
         Message.query.delete()
+        ThreadSummary.query.delete()
+        Thread.query.delete()
+        Upload.query.delete()
+        SavedSearch.query.delete()
+        rate_limiter.reset()
     
 
         self.client = app.test_client()
@@ -116,8 +136,8 @@ class UserViewTestCase(TestCase):
 
             #Does updated form submit and redirect to profile page with updated info?
             form_data = {"username":"testuser1 edited","email":"test1edited@test.com", "city":"Test Edited", "state":"ED", "zip_code":"11111","bio":"Test bio."}
-            form_data['header_image'] = (io.BytesIO(b"abcdef"), 'test_header_image.jpg')
-            form_data['profile_image'] = (io.BytesIO(b"abcdef"), 'test_profile_image.jpg')
+            form_data['header_image'] = (io.BytesIO(JPEG), 'test_header_image.jpg')
+            form_data['profile_image'] = (io.BytesIO(JPEG), 'test_profile_image.jpg')
             form_data['instruments'] = ['acoustic guitar']
             form_data['genres'] = ['rock']
             form_data['password'] = "testuser"
@@ -134,9 +154,213 @@ class UserViewTestCase(TestCase):
             self.assertNotIn('Lead Guitar',html )
             self.assertIn('Rock',html )
             self.assertNotIn('Alt Metal',html )
-            self.assertIn('test_profile_image.jpg alt=testuser1 edited',html )
+            # Both images have the same content, so they are stored once and used twice
+            filename = hashlib.sha256(JPEG).hexdigest() + '.jpg'
+            self.assertIn(f'/uploads/{filename} alt=testuser1 edited',html )
             self.assertIn('<p class="">Test bio.</p>',html )
+            self.assertEqual([(upload.filename, upload.size, upload.ref_count) for upload in Upload.query], [(filename, len(JPEG), 2)])
+
+
+
+    def test_edit_user_profile_links(self):
+        """Are only added and removed instruments and genres written, in a fixed number of statements?"""
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            user_id = self.testuser1.id
+            form_data = {"username":"testuser1","email":"test1@test.com", "city":"Test", "state":"AL", "zip_code":"36830",
+                         "bio":"", "password":"testuser"}
+
+            def save(instruments, genres):
+                with count_queries() as queries:
+                    resp = c.post("/users/edit", data=dict(form_data, instruments=instruments, genres=genres,
+                                                           header_image=(io.BytesIO(b""), ""), profile_image=(io.BytesIO(b""), "")))
+                self.assertEqual(resp.status_code, 302)
+                return queries
+
+            def link_rows():
+                return ({(row.instrument_id, row.id) for row in User_Instrument.query.filter_by(user_id=user_id)},
+                        {(row.genre_id, row.id) for row in User_Genre.query.filter_by(user_id=user_id)})
+
+            save([], [])
+            few = save(['acoustic guitar'], ['rock'])
+            instruments, genres = link_rows()
+
+            many = save(['acoustic guitar', 'drums', 'lead guitar', 'bass guitar'], ['rock', 'jazz', 'blues'])
+            self.assertEqual(len(many), len(few))
+
+            # The rows that stayed keep their ids
+            new_instruments, new_genres = link_rows()
+            self.assertEqual(len(new_instruments), 4)
+            self.assertEqual(len(new_genres), 3)
+            self.assertLessEqual(instruments, new_instruments)
+            self.assertLessEqual(genres, new_genres)
+
+            unchanged = save(['acoustic guitar', 'drums', 'lead guitar', 'bass guitar'], ['rock', 'jazz', 'blues'])
+            self.assertFalse([q for q in unchanged if q.lstrip().upper().startswith(('INSERT INTO USERS_', 'DELETE FROM USERS_'))])
+            self.assertEqual(link_rows(), (new_instruments, new_genres))
+
+            save(['drums'], ['jazz'])
+            instruments, genres = link_rows()
+            self.assertEqual({instrument_id for instrument_id, id in instruments},
+                             {Instrument.query.filter_by(name='drums').first().id})
+            self.assertLessEqual(instruments, new_instruments)
+
+            # The search index still hears about the change
+            search_index.sync()
+            self.assertEqual(search_index.users[user_id][2], {instrument_id for instrument_id, id in instruments})
+
+
+    def test_uploads(self):
+        """Are uploads served with immutable caching, counted as profiles change, and collected once unused?"""
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            form_data = {"username":"testuser1","email":"test1@test.com", "city":"Test", "state":"AL", "zip_code":"36830",
+                         "bio":"", "password":"testuser", "instruments":['drums'], "genres":['jazz']}
+
+            def save(header, profile):
+                resp = c.post("/users/edit", data=dict(form_data, header_image=(io.BytesIO(header), "header.jpg" if header else ""),
+                                                       profile_image=(io.BytesIO(profile), "profile.png" if profile else "")))
+                self.assertEqual(resp.status_code, 302)
 
+            def ref_counts():
+                return {upload.filename: upload.ref_count for upload in Upload.query}
+
+            header = hashlib.sha256(JPEG + b"upload header").hexdigest() + '.jpg'
+            first = hashlib.sha256(PNG + b"upload first").hexdigest() + '.png'
+            second = hashlib.sha256(PNG + b"upload second").hexdigest() + '.png'
+
+            save(JPEG + b"upload header", PNG + b"upload first")
+            self.assertEqual(ref_counts(), {header: 1, first: 1})
+
+            resp = c.get(f"/uploads/{first}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_data(), PNG + b"upload first")
+            self.assertEqual(resp.headers['Content-Type'], 'image/png')
+            self.assertEqual(resp.headers['ETag'], f'"{first}"')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+            self.assertEqual(c.get(f"/uploads/{first}", headers={"If-None-Match": f'"{first}"'}).status_code, 304)
+            self.assertEqual(c.get("/uploads/default-pic.png").status_code, 404)
+
+            save(b"", PNG + b"upload second")
+            self.assertEqual(ref_counts(), {header: 1, first: 0, second: 1})
+
+            # Recently changed files are kept, in case a profile is about to use them
+            runner = app.test_cli_runner()
+            runner.invoke(args=['gc-uploads'])
+            self.assertTrue(os.path.exists(upload_store.path(first)))
+
+            result = runner.invoke(args=['gc-uploads', '--grace-hours', '0'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertNotIn(first, ref_counts())
+            self.assertFalse(os.path.exists(upload_store.path(first)))
+            self.assertTrue(os.path.exists(upload_store.path(header)))
+            self.assertTrue(os.path.exists(upload_store.path(second)))
+
+
+    def test_rejected_uploads(self):
+        """Are uploads that aren't images, or are too large, refused without saving anything?"""
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            form_data = {"username":"testuser1 edited","email":"test1@test.com", "city":"Test", "state":"AL", "zip_code":"36830",
+                         "bio":"", "password":"testuser"}
+
+            def incoming_files():
+                return [name for name in os.listdir(upload_store.folder) if name.startswith("incoming.")]
+
+            resp = c.post("/users/edit", data=dict(form_data, header_image=(io.BytesIO(b""), ""), profile_image=(io.BytesIO(b"<svg onload=alert(1)>"), "face.jpg")))
+            self.assertEqual(resp.status_code, 415)
+            self.assertIn('Please upload a JPEG, PNG, GIF or WebP image.', resp.get_data(as_text=True))
+
+            max_content_length = app.config['MAX_CONTENT_LENGTH']
+            app.config['MAX_CONTENT_LENGTH'] = 1024
+            try:
+                resp = c.post("/users/edit", data=dict(form_data, header_image=(io.BytesIO(b""), ""), profile_image=(io.BytesIO(JPEG + b"\0" * 2048), "face.jpg")))
+            finally:
+                app.config['MAX_CONTENT_LENGTH'] = max_content_length
+            self.assertEqual(resp.status_code, 413)
+
+            self.assertEqual(User.query.get(self.testuser1.id).username, 'testuser1')
+            self.assertEqual(Upload.query.count(), 0)
+            self.assertEqual(incoming_files(), [])
+
+
+    def test_saved_searches(self):
+        """Are owners of saved searches told about new and updated profiles that start matching them?"""
+
+        owner_id, member_id = self.testuser1.id, self.testuser2.id
+
+        with self.client as c:
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = owner_id
+            params = dict(zip_code='36830', radius=10, is_band=False, genres=[], match_all_instruments=False, keywords=None)
+
+            resp = c.post("/searches", data={"search": save_search(instruments=[], **params)})
+            self.assertEqual(resp.status_code, 302)
+            resp = c.post("/searches", data={"search": save_search(instruments=['drums'], **params)})
+            anyone, drummers = SavedSearch.query.order_by(SavedSearch.id).all()
+            self.assertEqual(drummers.instruments, ['drums'])
+
+            # Nearest-first searches have no radius to keep watching
+            resp = c.post("/searches", data={"search": save_search(instruments=[], **dict(params, radius=None))},
+                          follow_redirects=True)
+            self.assertIn('Only searches within a radius', resp.get_data(as_text=True))
+            self.assertEqual(SavedSearch.query.count(), 2)
+
+            # A musician signing up nearby matches the search for anyone, but not the one for drummers
+            with c.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+            c.post("/signup", data={"username":"testuser4","email":"test4@test.com","password":"testuser4",
+                                    "city":"Auburn", "state":"AL","zip_code":"36832"})
+            newcomer_id = User.query.filter_by(username='testuser4').first().id
+
+            self.assertEqual(anyone.new_matches(), [newcomer_id])
+            self.assertEqual(drummers.new_matches(), [])
+
+            # Taking up the drums matches the drummers search; the search for anyone matched already
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = member_id
+            c.post("/users/edit", data={"username":"testuser2","email":"test2@test.com", "city":"Test", "state":"AL",
+                                        "zip_code":"36830", "bio":"", "password":"testuser", "instruments":['drums'],
+                                        "header_image":(io.BytesIO(b""), ""), "profile_image":(io.BytesIO(b""), "")})
+
+            self.assertEqual(anyone.new_matches(), [newcomer_id])
+            self.assertEqual(drummers.new_matches(), [member_id])
+            notification = Notification.query.filter_by(user_id=owner_id, name=f'saved_search:{drummers.id}').first()
+            self.assertEqual(notification.get_data(), {'search_id': drummers.id, 'user_ids': [member_id]})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = owner_id
+
+            html = c.get("/searches").get_data(as_text=True)
+            self.assertIn('1 new', html)
+
+            # Looking at the matches clears them
+            html = c.get(f"/searches/{drummers.id}").get_data(as_text=True)
+            self.assertIn('Testuser2', html)
+            self.assertEqual(drummers.new_matches(), [])
+
+            resp = c.post(f"/searches/{anyone.id}/delete")
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(SavedSearch.query.count(), 1)
+            self.assertEqual(anyone.new_matches(), [])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = member_id
+            self.assertEqual(c.get(f"/searches/{drummers.id}").status_code, 404)
 
 
     def test_user_login(self):
@@ -165,6 +389,49 @@ class UserViewTestCase(TestCase):
             self.assertNotIn('field_error',html )
             self.assertIn('<h1 class="text-5xl leading-tight font-light lg:mt-6 lg:text-6xl">Find Musicians!</h1>',html )
             self.assertIn('<input class="rounded border-1 border-slate-400 placeholder:text-xs placeholder:font-extrabold placeholder:uppercase placeholder:text-slate-400 mb-3" id="zip_code" max="99999" min="0" name="zip_code" placeholder="Zip Code" required type="number" value="">',html )
+
+
+    def test_login_rate_limit(self):
+        """Are repeated logins to one account refused before the password is checked?"""
+
+        with self.client as c:
+
+            for attempt in range(5):
+                resp = c.post("/login", data={"username":"testuser2","password":"wrong password"})
+                self.assertEqual(resp.status_code, 200)
+
+            with count_queries() as queries:
+                resp = c.post("/login", data={"username":"TestUser2","password":"testuser"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertTrue(resp.headers['Retry-After'].isdigit())
+            self.assertIn('Too many requests.', resp.get_data(as_text=True))
+            self.assertFalse([q for q in queries if 'FROM users' in q])
+
+            # Other accounts can still log in from the same address
+            resp = c.post("/login", data={"username":"testuser3","password":"testuser"})
+            self.assertEqual(resp.status_code, 302)
+
+
+    def test_message_rate_limit(self):
+        """Is a user sending too many messages refused before anything is written?"""
+
+        with self.client as c:
+
+            user_id, recipient_id = self.testuser1.id, self.testuser2.id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            for i in range(10):
+                resp = c.post(f"/messages/{recipient_id}", data={"subject":f"spam {i}","body":"spam"})
+                self.assertEqual(resp.status_code, 302)
+
+            resp = c.post(f"/messages/{recipient_id}", data={"subject":"spam","body":"spam"})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(Message.query.count(), 10)
+
+            # Reading messages isn't limited
+            self.assertEqual(c.get(f"/messages/{recipient_id}").status_code, 200)
             
     def test_user_registration(self):
         """Does the signup form render and redirect to profile on submit?"""
@@ -233,17 +500,17 @@ class UserViewTestCase(TestCase):
 
         with self.client as c:
             
+            user2_id = self.testuser2.id
+
             with c.session_transaction() as sess:
-                sess[CURR_USER_KEY] = self.testuser2.id
+                sess[CURR_USER_KEY] = self.testuser1.id
 
-            user1 = User.query.filter(User.username == 'testuser1').first()
-            user2 = User.query.filter(User.username == 'testuser2').first()
+            c.post(f"/messages/{user2_id}", data={"subject":"testing the subject line","body":"testing the body of the message"})
 
-            msg = Message(sender_id=user1.id,recipient_id=user2.id,subject='testing the subject line',body='testing the body of the message')
-            db.session.add(msg)
-            db.session.commit()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
 
-            resp = c.get(f"/users/{user2.id}")          
+            resp = c.get(f"/users/{user2_id}")          
             html = resp.get_data(as_text=True)
 
 
@@ -260,6 +527,21 @@ class UserViewTestCase(TestCase):
             self.assertIn('testing the subject line',html)
             self.assertIn('testing the body of the message',html)
             self.assertNotIn('No messages.',html)
+
+            #Is the conversation listed as unread until it is opened?
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 1)
+            thread_url = re.search(r'href="(/messages/thread/\d+)"', html).group(1)
+
+            resp = c.get(thread_url)
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('testing the body of the message',html)
+
+            #Is the unread counter reset, with the notification updated in place?
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 0)
+            notifications = Notification.query.filter_by(user_id=user2_id, name='unread_message_count').all()
+            self.assertEqual([n.get_data() for n in notifications], [0])
            
             
      
@@ -268,4 +550,349 @@ class UserViewTestCase(TestCase):
 
 
 
-            
\ No newline at end of file
+            
+
+
+    def test_message_threads(self):
+        """Are conversations listed by latest activity, and does opening one mark it read?"""
+
+        with self.client as c:
+
+            user1_id, user2_id, user3_id = self.testuser1.id, self.testuser2.id, self.testuser3.id
+
+            for sender_id, subject in ((user1_id, 'first from one'), (user3_id, 'from three'), (user1_id, 'second from one')):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = sender_id
+                c.post(f"/messages/{user2_id}", data={"subject": subject, "body": "body"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            with count_queries() as queries:
+                html = c.get("/messages").get_data(as_text=True)
+            self.assertEqual(len([q for q in queries if 'FROM thread_summaries' in q]), 1)
+
+            # One card per conversation, the most recently active first
+            self.assertNotIn('first from one', html)
+            self.assertLess(html.index('second from one'), html.index('from three'))
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 3)
+
+            thread = Thread.between(user1_id, user2_id)
+            html = c.get(f"/messages/thread/{thread.id}").get_data(as_text=True)
+            self.assertIn('first from one', html)
+            self.assertIn('second from one', html)
+            self.assertNotIn('from three', html)
+
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 1)
+            summary = ThreadSummary.query.get((user2_id, thread.id))
+            self.assertEqual(summary.unread_count, 0)
+
+            # Deleting the latest message points the summary back at the one before it
+            latest = Message.query.filter_by(subject='second from one').one()
+            c.get(f"/messages/{latest.id}/delete")
+            summary = ThreadSummary.query.get((user2_id, thread.id))
+            self.assertEqual(summary.last_message.subject, 'first from one')
+
+            # Threads are only visible to the two people in them
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user3_id
+            resp = c.get(f"/messages/thread/{thread.id}")
+            self.assertEqual(resp.status_code, 302)
+
+
+    def test_delete_unread_message(self):
+        """Does deleting an unread message take it out of the recipient's unread counts, and a read one not?"""
+
+        with self.client as c:
+
+            user1_id, user2_id = self.testuser1.id, self.testuser2.id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+            for subject in ('first', 'second'):
+                c.post(f"/messages/{user2_id}", data={"subject": subject, "body": "body"})
+
+            thread = Thread.between(user1_id, user2_id)
+            first = Message.query.filter_by(subject='first').one()
+            c.get(f"/messages/{first.id}/delete")
+
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 1)
+            self.assertEqual(ThreadSummary.query.get((user2_id, thread.id)).unread_count, 1)
+
+            # Once read, deleting older messages leaves a newer unread one counted
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            c.get(f"/messages/thread/{thread.id}")
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+            c.post(f"/messages/{user2_id}", data={"subject": "third", "body": "body"})
+
+            second = Message.query.filter_by(subject='second').one()
+            c.get(f"/messages/{second.id}/delete")
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 1)
+
+            # Deleting the last message empties the thread and the count with it
+            third = Message.query.filter_by(subject='third').one()
+            c.get(f"/messages/{third.id}/delete")
+            self.assertEqual(User.query.get(user2_id).unread_message_count, 0)
+            self.assertEqual(ThreadSummary.query.filter_by(user_id=user2_id).count(), 0)
+
+
+    def test_backfill_threads_command(self):
+        """Does the upgrade command move messages sent before threads existed into threads?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        db.session.add(Message(sender_id=user1_id, recipient_id=user2_id, subject='old', body='from before threads'))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['backfill-threads'])
+
+        self.assertIn('Moved 1 messages into threads.', result.output)
+        message = Message.query.filter_by(subject='old').one()
+        self.assertEqual(message.thread_id, Thread.between(user1_id, user2_id).id)
+        self.assertEqual(ThreadSummary.query.filter_by(user_id=user2_id, thread_id=message.thread_id).count(), 1)
+
+
+    def test_message_search(self):
+        """Does message search find the current user's sent and received messages, and only theirs?"""
+
+        with self.client as c:
+
+            user1_id, user2_id, user3_id = self.testuser1.id, self.testuser2.id, self.testuser3.id
+
+            for sender_id, recipient_id, subject, body in ((user1_id, user2_id, 'Drummer wanted', 'Jazz gig on Saturday'),
+                                                           (user2_id, user1_id, 'Re: Drummer wanted', 'I play jazz'),
+                                                           (user3_id, user2_id, 'Bass player', 'Rock gig on Saturday')):
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = sender_id
+                c.post(f"/messages/{recipient_id}", data={"subject": subject, "body": body})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            html = c.get("/messages/search?q=jazz").get_data(as_text=True)
+            self.assertIn('Jazz gig on Saturday', html)
+            self.assertIn('I play jazz', html)
+            self.assertNotIn('Rock gig', html)
+
+            html = c.get("/messages/search?q=saturday+gig").get_data(as_text=True)
+            self.assertIn('Jazz gig on Saturday', html)
+            self.assertNotIn('I play jazz', html)
+            self.assertNotIn('Rock gig', html)
+
+            html = c.get("/messages/search?q=bass").get_data(as_text=True)
+            self.assertIn('No messages.', html)
+
+            # Deleted messages stop matching
+            message = Message.query.filter_by(subject='Re: Drummer wanted').one()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+            c.get(f"/messages/{message.id}/delete")
+
+            html = c.get("/messages/search?q=jazz").get_data(as_text=True)
+            self.assertIn('Jazz gig on Saturday', html)
+            self.assertNotIn('I play jazz', html)
+
+
+    def test_follow_lists_query_count(self):
+        """Do the following and followers pages load every card in a fixed number of queries?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            user1 = User.query.filter(User.username == 'testuser1').first()
+            instruments = [Instrument(name='banjo'), Instrument(name='cello')]
+            genres = [Genre(name='folk'), Genre(name='jazz')]
+
+            for user in User.query.filter(User.username.in_(['testuser2', 'testuser3'])).all():
+                user.instruments = instruments
+                user.genres = genres
+                db.session.add(Follows(user_being_followed_id=user.id, user_following_id=user1.id))
+                db.session.add(Follows(user_being_followed_id=user1.id, user_following_id=user.id))
+            db.session.commit()
+
+            for url in [f"/following/{user1.id}", f"/followers/{user1.id}"]:
+                with count_queries() as queries:
+                    resp = c.get(url)
+                html = resp.get_data(as_text=True)
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn('Testuser2',html )
+                self.assertIn('Testuser3',html )
+                self.assertIn('Banjo',html )
+                self.assertLessEqual(len(queries), 6)
+
+
+    def test_current_user_cache(self):
+        """Is the logged in user only read from the users table when the cache is cold?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            with count_queries() as queries:
+                resp = c.get("/notifications")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse([q for q in queries if 'FROM users' in q])
+
+            c.get("/users/update-password")
+
+            with count_queries() as queries:
+                resp = c.get("/users/update-password")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse([q for q in queries if 'FROM users' in q])
+
+            # Password hashes stay out of the file every worker shares
+            self.assertNotIn('password', user_cache.get(str(self.testuser1.id)))
+
+            resp = c.post("/users/update-password", data={"old_password": "testuser", "new_password": "changed", "confirm_password": "changed"})
+            user1 = User.query.filter(User.username == 'testuser1').first()
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(User.authenticate(user1.username, "changed"))
+
+            with count_queries() as queries:
+                c.get("/users/update-password")
+
+            self.assertTrue([q for q in queries if 'FROM users' in q])
+
+
+    def test_recount_users_command(self):
+        """Does the upgrade command fix follow and unread counts that drifted from the rows they count?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        db.session.add(Follows(user_following_id=user1_id, user_being_followed_id=user2_id))
+        db.session.add(Message(sender_id=user1_id, recipient_id=user2_id, subject='old', body='from before the count'))
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['recount-users'])
+
+        self.assertIn('Recounted', result.output)
+        db.session.expire_all()
+        self.assertEqual((User.query.get(user1_id).following_count, User.query.get(user2_id).follower_count), (1, 1))
+        self.assertEqual((User.query.get(user1_id).unread_message_count, User.query.get(user2_id).unread_message_count), (0, 1))
+
+
+    def test_follow_counts(self):
+        """Do follow and unfollow keep both users' counters in step?"""
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            user1 = User.query.filter(User.username == 'testuser1').first()
+            user2 = User.query.filter(User.username == 'testuser2').first()
+            user1_id, user2_id = user1.id, user2.id
+
+            c.get(f"/follow/{user2_id}")
+            c.get(f"/follow/{user2_id}")
+
+            user1, user2 = User.query.get(user1_id), User.query.get(user2_id)
+            self.assertEqual((user1.following_count, user2.follower_count), (1, 1))
+            self.assertTrue(user1.is_following(user2))
+            self.assertTrue(user2.is_followed_by(user1_id))
+            self.assertFalse(user2.is_following(user1))
+
+            resp = c.get(f"/users/{user2_id}")
+            html = resp.get_data(as_text=True)
+            self.assertIn('Unfollow',html )
+
+            c.get(f"/unfollow/{user2_id}")
+            c.get(f"/unfollow/{user2_id}")
+
+            user1, user2 = User.query.get(user1_id), User.query.get(user2_id)
+            self.assertEqual((user1.following_count, user2.follower_count), (0, 0))
+            self.assertFalse(user1.is_following(user2))
+
+
+    def test_notification_stream(self):
+        """Does the stream replay stored notifications and push new ones from sent messages?"""
+
+        app.config['NOTIFICATION_STREAM_MAX_SECONDS'] = 1
+
+        with self.client as c:
+            
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            recipient_id = User.query.filter(User.username == 'testuser2').first().id
+            c.post(f"/messages/{recipient_id}", data={"subject":"Testing Subject Line","body":"Testing message body"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = recipient_id
+
+            resp = c.get("/notifications/stream")
+            stream = resp.get_data(as_text=True)
+            # As the server would once the stream ends, giving its slot back
+            resp.close()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            self.assertIn('event: notification\ndata: {"name": "unread_message_count", "data": 1,', stream)
+
+        with app.test_client() as c:
+            resp = c.get("/notifications/stream")
+            self.assertEqual(resp.status_code, 204)
+
+        # Once every stream slot is taken, the browser is told to poll instead
+        slots = app.config['NOTIFICATION_STREAMS_PER_WORKER']
+        for i in range(slots):
+            notification_stream_slots.acquire()
+        try:
+            with self.client as c:
+                resp = c.get("/notifications/stream")
+                self.assertEqual(resp.status_code, 503)
+                self.assertEqual(resp.headers['Retry-After'], '30')
+        finally:
+            for i in range(slots):
+                notification_stream_slots.release()
+
+        app.config['NOTIFICATION_STREAM_MAX_SECONDS'] = 5 * 60
+
+
+    def test_message_pagination(self):
+        """Are inbox and sent messages paged newest first with cursor links both ways?"""
+
+        with self.client as c:
+            
+            user1_id, user2_id = self.testuser1.id, self.testuser2.id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2_id
+
+            # Two messages share each timestamp, so the id has to break ties
+            for i in range(25):
+                db.session.add(Message(sender_id=user1_id, recipient_id=user2_id, subject=f'subject {i:02}', body='body',
+                                       timestamp=datetime(2022, 1, 1, 12, i // 2)))
+            db.session.commit()
+
+            subjects = lambda html: re.findall(r'subject (\d\d)', html)
+
+            html = c.get("/messages/received").get_data(as_text=True)
+            self.assertEqual(subjects(html), [f'{i:02}' for i in range(24, 14, -1)])
+
+            older = re.search(r'href="(/messages/received\?after=[^"]*)"', html).group(1)
+            html = c.get(older).get_data(as_text=True)
+            self.assertEqual(subjects(html), [f'{i:02}' for i in range(14, 4, -1)])
+
+            html = c.get(re.search(r'href="(/messages/received\?after=[^"]*)"', html).group(1)).get_data(as_text=True)
+            self.assertEqual(subjects(html), [f'{i:02}' for i in range(4, -1, -1)])
+            self.assertNotIn('/messages/received?after=', html)
+
+            newer = re.search(r'href="(/messages/received\?before=[^"]*)"', html).group(1)
+            html = c.get(newer).get_data(as_text=True)
+            self.assertEqual(subjects(html), [f'{i:02}' for i in range(14, 4, -1)])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            html = c.get("/messages/sent").get_data(as_text=True)
+            self.assertEqual(subjects(html), [f'{i:02}' for i in range(24, 14, -1)])
+            self.assertIn('Testuser2', html)
+            self.assertIn('/messages/sent?after=', html)
@@ -0,0 +1,40 @@
+"""Vocabulary tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_vocabulary.py
+from unittest import TestCase
+from vocabulary import Vocabulary
+
+
+class VocabularyTestCase(TestCase):
+    """Test the id/name maps."""
+
+    def setUp(self):
+        self.vocabulary = Vocabulary([(3, 'drums'), (1, 'acoustic guitar'), (2, 'bass guitar')])
+
+    def test_lookups(self):
+        """Are names and ids mapped both ways, skipping unknown ones?"""
+
+        self.assertEqual(self.vocabulary.ids(['drums', 'kazoo', 'acoustic guitar']), [3, 1])
+        self.assertEqual(self.vocabulary.names([2, 99]), ['bass guitar'])
+        self.assertIn('drums', self.vocabulary)
+        self.assertEqual(len(self.vocabulary), 3)
+
+    def test_choices(self):
+        """Are select choices listed in id order with title case labels?"""
+
+        self.assertEqual(self.vocabulary.choices(),
+                         [('acoustic guitar', 'Acoustic Guitar'), ('bass guitar', 'Bass Guitar'), ('drums', 'Drums')])
+
+    def test_read_only(self):
+        """Can the shared maps not be changed?"""
+
+        with self.assertRaises(TypeError):
+            self.vocabulary.by_name['kazoo'] = 4
+
+    def test_duplicate_names(self):
+        """Does a duplicated name map to its first id?"""
+
+        vocabulary = Vocabulary([(5, 'drums'), (2, 'drums')])
+        self.assertEqual(vocabulary.ids(['drums']), [2])
@@ -0,0 +1,79 @@
+"""Zip radius engine tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_zip_radius.py
+from unittest import TestCase
+from zip_radius import ZipRadiusEngine, get_engine, haversine_miles, normalize_zip
+
+
+class ZipRadiusEngineTestCase(TestCase):
+    """Test offline zip code radius lookups."""
+
+    def setUp(self):
+        """Create an engine over a few Alabama zip codes."""
+
+        self.engine = ZipRadiusEngine({
+            '36830': (32.5578, -85.4799),
+            '36832': (32.5707, -85.5754),
+            '36117': (32.3734, -86.1827),
+            '35242': (33.3863, -86.6745),
+        })
+
+    def test_normalize_zip(self):
+        """Are integer zip codes padded back to five digits?"""
+
+        self.assertEqual(normalize_zip(2134), '02134')
+        self.assertEqual(normalize_zip(' 36830 '), '36830')
+
+    def test_haversine_miles(self):
+        """Is the distance between two points about right?"""
+
+        self.assertEqual(haversine_miles(32.5578, -85.4799, 32.5578, -85.4799), 0)
+        self.assertAlmostEqual(haversine_miles(32.5578, -85.4799, 32.3734, -86.1827), 43.4, places=0)
+
+    def test_zips_within(self):
+        """Are zip codes inside the radius returned nearest first?"""
+
+        zips = self.engine.zips_within('36830', 50)
+
+        self.assertEqual([zip for zip, distance in zips], ['36830', '36832', '36117'])
+        self.assertEqual(zips[0][1], 0)
+        self.assertTrue(zips[1][1] < zips[2][1] <= 50)
+
+    def test_zips_within_unknown_zip(self):
+        """Do unknown zip codes return None instead of an empty list?"""
+
+        self.assertIsNone(self.engine.zips_within('00000', 50))
+        self.assertNotIn('00000', self.engine)
+        self.assertIn(36830, self.engine)
+
+    def test_bundled_dataset(self):
+        """Does the bundled dataset load and answer radius queries?"""
+
+        engine = get_engine()
+
+        self.assertGreater(len(engine), 40000)
+        zips = engine.zips_within('36830', 10)
+
+        self.assertEqual(zips[0], ('36830', 0))
+        self.assertIn('36832', [zip for zip, distance in zips])
+
+    def test_popular_origin_distance_vector(self):
+        """Do popular origins answer from a cached distance vector with the same results?"""
+
+        engine = ZipRadiusEngine(self.engine.centroids, popular_after=2)
+
+        first = engine.zips_within('36830', 50)
+        self.assertEqual(len(engine.distance_vectors), 0)
+
+        second = engine.zips_within('36830', 50)
+        self.assertEqual(len(engine.distance_vectors), 1)
+        self.assertEqual(first, second)
+
+        self.assertEqual(len(engine.distance_vector('36830')), len(engine))
+        self.assertIsNone(engine.distance_vector('00000'))
+
+        # The cached path draws the radius exactly where the uncached one does
+        edge = dict(first)['36832']
+        self.assertEqual(engine.zips_within('36830', edge), self.engine.zips_within('36830', edge))
@@ -0,0 +1,84 @@
+"""A small in-process inverted index for free text, and BM25 scoring.
+
+Text is split into lowercase words and each word maps to the set of
+documents containing it, so finding the documents with every word of a query
+is an intersection of a few sets, smallest first, rather than a scan.
+"""
+
+import math
+import re
+
+WORD = re.compile(r'\w+')
+
+# Okapi BM25 parameters: how quickly repeated words stop counting, and how much long documents are discounted
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """Return the lowercase words in `text`, in order."""
+
+    return WORD.findall(text.lower()) if text else []
+
+
+def bm25(tf, length, df, documents, average_length, k1=BM25_K1, b=BM25_B):
+    """Score one query word for a document.
+
+    `tf` is how often the word appears in the document, `length` the
+    document's length in words, `df` how many of the `documents` contain the
+    word and `average_length` their mean length. Rare words score higher than
+    common ones, and a word's score levels off the more often it repeats.
+    """
+
+    idf = math.log(1 + (documents - df + 0.5) / (df + 0.5))
+    return idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / average_length))
+
+
+class InvertedIndex:
+    """Documents by the words they contain."""
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.documents
+
+    def add(self, doc_id, text):
+        """Index a document, replacing whatever was indexed for it before."""
+
+        self.remove(doc_id)
+
+        terms = frozenset(tokenize(text))
+        for term in terms:
+            self.postings.setdefault(term, set()).add(doc_id)
+        self.documents[doc_id] = terms
+
+    def remove(self, doc_id):
+        terms = self.documents.pop(doc_id, None)
+        if terms is None:
+            return
+
+        for term in terms:
+            postings = self.postings[term]
+            postings.discard(doc_id)
+            if not postings:
+                del self.postings[term]
+
+    def search(self, text):
+        """Return the set of documents containing every word of `text`."""
+
+        terms = set(tokenize(text))
+        if not terms:
+            return set()
+
+        postings = sorted((self.postings.get(term, ()) for term in terms), key=len)
+        matches = set(postings[0])
+        for other in postings[1:]:
+            if not matches:
+                break
+            matches &= other
+        return matches
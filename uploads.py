@@ -0,0 +1,191 @@
+"""Content-addressed storage for uploaded images.
+
+An upload is stored once, named by the SHA-256 of its bytes, so the same
+picture uploaded twice takes the space of one, and a file's name changes
+whenever its content does. That lets `/uploads/` tell browsers to keep files
+forever. How many profiles use each file is counted on its `Upload` row, and
+`flask gc-uploads` deletes files nothing uses any more.
+
+Uploads are streamed to disk a chunk at a time as the request body is parsed
+(see `UploadRequest` in app.py), hashed on the way, and rejected as soon as
+their first bytes show they aren't an image or they grow past the size limit,
+so a worker never holds more than a chunk of any upload in memory.
+"""
+
+import hashlib
+import os
+import re
+import uuid
+from werkzeug.exceptions import RequestEntityTooLarge, UnsupportedMediaType
+
+UPLOADS_URL = '/uploads/'
+COPY_CHUNK_BYTES = 64 * 1024
+
+# A stored file is `<sha256>.<extension>`; its variants from images.py add `.<variant>.webp`
+ORIGINAL_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+STORED_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+(\.[a-z]+\.webp)?$')
+
+# What the first bytes of each accepted image format look like; None matches any byte
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    ((b'RIFF', None, None, None, None, b'WEBP'), '.webp'),
+)
+SNIFF_BYTES = 12
+
+
+def upload_url(filename):
+    return UPLOADS_URL + filename
+
+
+def filename_from_url(url):
+    """The stored file an upload URL points at, or None for other images."""
+
+    if not url or not url.startswith(UPLOADS_URL):
+        return None
+    filename = url[len(UPLOADS_URL):]
+    return filename if STORED_NAME.match(filename) else None
+
+
+def sniff_extension(head):
+    """The extension for an image starting with the bytes `head`, or None if it isn't one we accept."""
+
+    for signature, extension in IMAGE_SIGNATURES:
+        if isinstance(signature, bytes):
+            if head.startswith(signature):
+                return extension
+        elif head.startswith(signature[0]) and head[8:12] == signature[-1]:
+            return extension
+    return None
+
+
+class IncomingFile:
+    """An upload being written to a temporary file in the store's folder.
+
+    Werkzeug writes each chunk of the request body here as it arrives, then
+    reads the finished file back like any other upload stream.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.extension = None
+        self.kept = False
+        self._head = b''
+        self._digest = hashlib.sha256()
+        self._file = open(path, 'w+b')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge()
+
+        if self.extension is None and len(self._head) < SNIFF_BYTES:
+            self._head += data[:SNIFF_BYTES - len(self._head)]
+            if len(self._head) == SNIFF_BYTES:
+                self._sniff()
+
+        self._digest.update(data)
+        return self._file.write(data)
+
+    def _sniff(self):
+        self.extension = sniff_extension(self._head)
+        if self.extension is None:
+            self.close()
+            raise UnsupportedMediaType()
+
+    def seek(self, offset, whence=0):
+        # Werkzeug rewinds the file once the whole part is written; a file too short to have been sniffed yet is checked now
+        if self.extension is None and self.size:
+            self._sniff()
+        return self._file.seek(offset, whence)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self, size=-1):
+        return self._file.readline(size)
+
+    def tell(self):
+        return self._file.tell()
+
+    @property
+    def digest(self):
+        return self._digest.hexdigest()
+
+    def close(self):
+        """Close the file, deleting it unless it was kept by the store."""
+
+        self._file.close()
+        if not self.kept and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class UploadStore:
+    """Files in one folder, named by their content."""
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def incoming(self, max_bytes=None):
+        """A new temporary file to stream an upload into."""
+
+        return IncomingFile(self.path(f'incoming.{uuid.uuid4().hex}.tmp'), max_bytes)
+
+    def add(self, incoming):
+        """Keep a finished incoming upload. Returns (filename, size, is_new)."""
+
+        try:
+            if incoming.extension is None:
+                raise UnsupportedMediaType()
+
+            filename = incoming.digest + incoming.extension
+            if os.path.exists(self.path(filename)):
+                # Counts as new for `flask gc-uploads`, which spares recently touched files
+                os.utime(self.path(filename))
+                return filename, incoming.size, False
+
+            os.replace(incoming.path, self.path(filename))
+            incoming.kept = True
+            return filename, incoming.size, True
+        finally:
+            incoming.close()
+
+    def save(self, stream, max_bytes=None):
+        """Copy an image from `stream` into the store. Returns (filename, size, is_new)."""
+
+        incoming = self.incoming(max_bytes)
+        try:
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_BYTES), b''):
+                incoming.write(chunk)
+            incoming.seek(0)
+            return self.add(incoming)
+        finally:
+            incoming.close()
+
+    def stored_files(self):
+        """Names of the stored originals (not variants) in the folder."""
+
+        for name in os.listdir(self.folder):
+            if ORIGINAL_NAME.match(name):
+                yield name
+
+    def modified_at(self, filename):
+        return os.path.getmtime(self.path(filename))
+
+    def delete(self, filename):
+        """Remove a stored file and its variants."""
+
+        for name in os.listdir(self.folder):
+            if name == filename or name.startswith(filename + '.'):
+                try:
+                    os.remove(self.path(name))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,103 @@
+"""Instrument and genre names and ids, read from the database once per process.
+
+The instruments and genres tables only ever hold the fixed lists in
+`multiselect_options.py` that `seed.py` inserts, so there's no need to look
+names up per request. Under gunicorn the maps are loaded in the master
+before it forks (see `gunicorn.conf.py`), so every worker shares one copy.
+
+Adding or deleting rows in this process (seeding, tests) drops the cached
+copy so it is read again; other processes keep theirs until restarted.
+"""
+
+from threading import Lock
+from types import MappingProxyType
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Instrument, Genre
+
+
+class Vocabulary:
+    """A read-only map between the ids and names of one table's rows."""
+
+    def __init__(self, rows):
+        by_id, by_name = {}, {}
+        for id, name in sorted(rows):
+            by_id[id] = name
+            by_name.setdefault(name, id)
+
+        self.by_id = MappingProxyType(by_id)
+        self.by_name = MappingProxyType(by_name)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def ids(self, names):
+        """Ids for `names`, skipping any that aren't in the table."""
+
+        return [self.by_name[name] for name in names if name in self.by_name]
+
+    def names(self, ids):
+        return [self.by_id[id] for id in ids if id in self.by_id]
+
+    def choices(self):
+        """(name, label) pairs for a select field, in id order."""
+
+        return [(name, name.title()) for name in self.by_name]
+
+
+class Vocabularies:
+    """The instrument and genre vocabularies, loaded together."""
+
+    def __init__(self, instruments, genres):
+        self.instruments = instruments
+        self.genres = genres
+
+
+_vocabularies = None
+_lock = Lock()
+
+
+def load_vocabularies():
+    """Read both tables and replace the cached vocabularies."""
+
+    global _vocabularies
+
+    with _lock:
+        _vocabularies = Vocabularies(
+            Vocabulary(db.session.query(Instrument.id, Instrument.name)),
+            Vocabulary(db.session.query(Genre.id, Genre.name)))
+        return _vocabularies
+
+
+def get_vocabularies():
+    """Return the cached vocabularies, loading them on first use.
+
+    Empty vocabularies (read before the tables were seeded) are read again.
+    """
+
+    vocabularies = _vocabularies
+    if vocabularies is None or not len(vocabularies.instruments) or not len(vocabularies.genres):
+        vocabularies = load_vocabularies()
+    return vocabularies
+
+
+def forget_vocabularies():
+    global _vocabularies
+
+    with _lock:
+        _vocabularies = None
+
+
+@event.listens_for(Session, 'after_flush')
+def forget_changed_vocabularies(session, flush_context):
+    if any(isinstance(obj, (Instrument, Genre)) for obj in list(session.new) + list(session.deleted)):
+        forget_vocabularies()
+
+
+@event.listens_for(Session, 'after_bulk_delete')
+def forget_deleted_vocabularies(delete_context):
+    if delete_context.mapper.class_ in (Instrument, Genre):
+        forget_vocabularies()
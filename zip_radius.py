@@ -0,0 +1,319 @@
+"""Offline ZIP code radius lookups.
+
+ZIP centroids are loaded from the bundled `data/zip_centroids.csv` into NumPy
+arrays and bucketed into a grid of lat/lon cells. A radius query gathers the
+ZIP codes in the cells that overlap the search circle and measures them all
+in one vectorized haversine pass.
+
+Origins that are searched often get their distance to every ZIP code cached,
+so their radius queries become a single comparison over that vector.
+
+`ZipGrid` indexes a changing subset of ZIP codes (the ones users live in) on
+the same kind of grid and walks it outward ring by ring, for searches that ask
+for the closest matches rather than everything inside a fixed radius.
+"""
+
+import csv
+import heapq
+import math
+import os
+from threading import Lock
+import numpy as np
+from cache import LRUCache
+
+EARTH_RADIUS_MILES = 3958.8
+MILES_PER_DEGREE_LAT = 69.0
+GRID_CELL_DEGREES = 0.5
+
+# Distance vectors are cached for origins searched at least this many times
+POPULAR_ORIGIN_SEARCHES = 3
+DISTANCE_CACHE_ORIGINS = 64
+DISTANCE_CACHE_TTL = 24 * 60 * 60
+
+ZIP_CENTROIDS_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'data', 'zip_centroids.csv')
+
+
+def normalize_zip(zip_code):
+    """Return `zip_code` as a 5 character string (form fields hand us ints)."""
+
+    return str(zip_code).strip().zfill(5)
+
+
+def haversine_miles(lat1, lon1, lat2, lon2):
+    """Great-circle distance in miles between two lat/lon points."""
+
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_miles_vector(lat, lon, lats, lons):
+    """Distances in miles from one point (degrees) to arrays of points (radians)."""
+
+    lat, lon = math.radians(lat), math.radians(lon)
+    a = (np.sin((lats - lat) / 2) ** 2
+         + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2)
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class ZipRadiusEngine:
+    """Answer "which ZIP codes are within N miles of Z?" in-process."""
+
+    def __init__(self, centroids, cell_degrees=GRID_CELL_DEGREES,
+                 cache_origins=DISTANCE_CACHE_ORIGINS, popular_after=POPULAR_ORIGIN_SEARCHES):
+        """`centroids` maps a ZIP code to its (latitude, longitude).
+
+        `cache_origins` is how many origin distance vectors to keep (0 turns
+        the cache off), and `popular_after` how many searches from an origin
+        it takes before its vector is cached.
+        """
+
+        self.centroids = centroids
+        self.cell_degrees = cell_degrees
+        self.zip_codes = np.array(sorted(centroids))
+        self.positions = {zip_code: i for i, zip_code in enumerate(self.zip_codes)}
+        self.lats = np.radians([centroids[zip_code][0] for zip_code in self.zip_codes])
+        self.lons = np.radians([centroids[zip_code][1] for zip_code in self.zip_codes])
+
+        cells = {}
+        for i, zip_code in enumerate(self.zip_codes):
+            cells.setdefault(self._cell(*centroids[zip_code]), []).append(i)
+        self.grid = {cell: np.array(positions) for cell, positions in cells.items()}
+
+        self.popular_after = popular_after
+        self.distance_vectors = LRUCache(max_entries=cache_origins, ttl=DISTANCE_CACHE_TTL)
+        self.origin_searches = LRUCache(max_entries=max(cache_origins, 1) * 16, ttl=DISTANCE_CACHE_TTL)
+
+    @classmethod
+    def from_csv(cls, path=ZIP_CENTROIDS_PATH, **kwargs):
+        """Build an engine from a `zip_code,latitude,longitude` CSV file."""
+
+        with open(path) as f:
+            centroids = {
+                row['zip_code']: (float(row['latitude']), float(row['longitude']))
+                for row in csv.DictReader(f)
+            }
+        return cls(centroids, **kwargs)
+
+    def __contains__(self, zip_code):
+        return normalize_zip(zip_code) in self.centroids
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def location(self, zip_code):
+        """Return (latitude, longitude) for `zip_code`, or None if it is unknown."""
+
+        return self.centroids.get(normalize_zip(zip_code))
+
+    def distance(self, zip_code, other_zip_code):
+        """Miles between two zip codes, or None if either is unknown."""
+
+        origin, destination = self.location(zip_code), self.location(other_zip_code)
+        if origin is None or destination is None:
+            return None
+        return round(haversine_miles(*origin, *destination), 3)
+
+    def distance_vector(self, zip_code):
+        """Distances in miles from `zip_code` to every ZIP code, in `self.zip_codes` order.
+
+        Vectors are cached per origin, in float64 like the uncached path, so
+        both answer the same at the radius boundary. Returns None for an
+        unknown zip code.
+        """
+
+        zip_code = normalize_zip(zip_code)
+        vector = self.distance_vectors.get(zip_code)
+
+        if vector is None:
+            origin = self.centroids.get(zip_code)
+            if origin is None:
+                return None
+            vector = haversine_miles_vector(*origin, self.lats, self.lons)
+            self.distance_vectors.set(zip_code, vector)
+
+        return vector
+
+    def _is_popular(self, zip_code):
+        searches = self.origin_searches.get(zip_code, 0) + 1
+        self.origin_searches.set(zip_code, searches)
+        return searches >= self.popular_after
+
+    def zips_within(self, zip_code, miles):
+        """List (zip_code, distance) pairs within `miles` of `zip_code`, nearest first.
+
+        Returns None when `zip_code` is not in the dataset, so callers can
+        decide whether to fall back to another source.
+        """
+
+        zip_code = normalize_zip(zip_code)
+        origin = self.centroids.get(zip_code)
+        if origin is None:
+            return None
+
+        cached = self.distance_vectors.get(zip_code)
+        if cached is None and self.distance_vectors.max_entries and self._is_popular(zip_code):
+            cached = self.distance_vector(zip_code)
+
+        if cached is not None:
+            positions = np.flatnonzero(cached <= miles)
+            distances = cached[positions]
+        else:
+            positions = self._candidate_positions(*origin, miles)
+            distances = haversine_miles_vector(*origin, self.lats[positions], self.lons[positions])
+            inside = distances <= miles
+            positions, distances = positions[inside], distances[inside]
+
+        distances = np.round(distances, 3)
+        order = np.lexsort((positions, distances))
+        return [(str(zip_code), float(distance))
+                for zip_code, distance in zip(self.zip_codes[positions[order]], distances[order])]
+
+    def _candidate_positions(self, lat, lon, miles):
+        """Positions of the ZIP codes in grid cells overlapping the search circle."""
+
+        lat_span = miles / MILES_PER_DEGREE_LAT
+        lon_scale = math.cos(math.radians(min(abs(lat) + lat_span, 89.0)))
+        lon_span = min(180.0, lat_span / max(lon_scale, 0.01))
+
+        min_row, min_col = self._cell(lat - lat_span, lon - lon_span)
+        max_row, max_col = self._cell(lat + lat_span, lon + lon_span)
+
+        cells = [self.grid[(row, col)]
+                 for row in range(min_row, max_row + 1)
+                 for col in range(min_col, max_col + 1)
+                 if (row, col) in self.grid]
+        return np.concatenate(cells) if cells else np.array([], dtype=np.int64)
+
+
+class ZipGrid:
+    """Spatial index over a changing set of ZIP codes, searched nearest first."""
+
+    def __init__(self, engine=None, cell_degrees=GRID_CELL_DEGREES):
+        """`engine` supplies the centroids; the bundled dataset is used if it is None."""
+
+        self._engine = engine
+        self.cell_degrees = cell_degrees
+        self.cells = {}
+        self.zip_cells = {}
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = get_engine()
+        return self._engine
+
+    def __contains__(self, zip_code):
+        return normalize_zip(zip_code) in self.zip_cells
+
+    def __len__(self):
+        return len(self.zip_cells)
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / self.cell_degrees), math.floor(lon / self.cell_degrees))
+
+    def add(self, zip_code):
+        """Index `zip_code`. ZIP codes without a known centroid are ignored."""
+
+        zip_code = normalize_zip(zip_code)
+        location = self.engine.location(zip_code)
+        if location is None or zip_code in self.zip_cells:
+            return
+
+        cell = self._cell(*location)
+        self.cells.setdefault(cell, set()).add(zip_code)
+        self.zip_cells[zip_code] = cell
+
+    def clear(self):
+        self.cells = {}
+        self.zip_cells = {}
+
+    def discard(self, zip_code):
+        """Stop indexing `zip_code`, if it was indexed."""
+
+        zip_code = normalize_zip(zip_code)
+        cell = self.zip_cells.pop(zip_code, None)
+        if cell is None:
+            return
+
+        self.cells[cell].discard(zip_code)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def nearest(self, zip_code):
+        """Yield (zip_code, distance) for every indexed ZIP code, nearest first.
+
+        Cells are visited in rings around the origin. A ZIP code is only
+        yielded once nothing in the unvisited rings can be closer, so callers
+        that stop early (e.g. after K matching users) never pay for the rest.
+        Yields nothing for an unknown origin.
+        """
+
+        origin = self.engine.location(zip_code)
+        if origin is None:
+            return
+
+        lat, lon = origin
+        row, col = self._cell(lat, lon)
+        cells = list(self.cells)
+        last_ring = max((max(abs(r - row), abs(c - col)) for r, c in cells), default=-1)
+
+        heap = []
+        for ring in range(last_ring + 1):
+            for cell in self._ring(row, col, ring):
+                for other in tuple(self.cells.get(cell, ())):
+                    distance = round(haversine_miles(lat, lon, *self.engine.centroids[other]), 3)
+                    heapq.heappush(heap, (distance, other))
+
+            bound = self._outside_ring_miles(lat, lon, row, col, ring) if ring < last_ring else math.inf
+            while heap and heap[0][0] <= bound:
+                distance, other = heapq.heappop(heap)
+                yield other, distance
+
+    def _ring(self, row, col, ring):
+        """Cells exactly `ring` steps (Chebyshev distance) from (row, col)."""
+
+        if ring == 0:
+            yield row, col
+            return
+
+        for c in range(col - ring, col + ring + 1):
+            yield row - ring, c
+            yield row + ring, c
+        for r in range(row - ring + 1, row + ring):
+            yield r, col - ring
+            yield r, col + ring
+
+    def _outside_ring_miles(self, lat, lon, row, col, ring):
+        """Lower bound on the distance from (lat, lon) to any cell beyond `ring`."""
+
+        lat_gap = min(lat - (row - ring) * self.cell_degrees, (row + ring + 1) * self.cell_degrees - lat)
+        lon_gap = min(lon - (col - ring) * self.cell_degrees, (col + ring + 1) * self.cell_degrees - lon)
+
+        # Anything further east or west lies beyond a meridian, so it is at
+        # least the cross-track distance to that meridian away
+        lat_miles = EARTH_RADIUS_MILES * math.radians(lat_gap)
+        lon_miles = EARTH_RADIUS_MILES * math.asin(
+            min(1.0, math.cos(math.radians(lat)) * math.sin(math.radians(min(lon_gap, 90.0)))))
+        return min(lat_miles, lon_miles)
+
+
+_engine = None
+_engine_lock = Lock()
+
+
+def get_engine():
+    """Return the shared engine, loading the bundled dataset on first use."""
+
+    global _engine
+
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = ZipRadiusEngine.from_csv()
+    return _engine